@@ -14,16 +14,76 @@ __all__ = [
     "FILTER_LZMA1", "FILTER_LZMA2", "FILTER_DELTA", "FILTER_X86", "FILTER_IA64",
     "FILTER_ARM", "FILTER_ARMTHUMB", "FILTER_POWERPC", "FILTER_SPARC",
     "FORMAT_AUTO", "FORMAT_XZ", "FORMAT_ALONE", "FORMAT_RAW",
+    "FLUSH_SYNC", "FLUSH_FULL", "FLUSH_BLOCK", "FLUSH_FINISH",
     "MF_HC3", "MF_HC4", "MF_BT2", "MF_BT3", "MF_BT4",
     "MODE_FAST", "MODE_NORMAL", "PRESET_DEFAULT", "PRESET_EXTREME",
 
     "LZMACompressor", "LZMADecompressor", "LZMAFile", "LZMAError",
-    "open", "compress", "decompress", "is_check_supported",
+    "FilterChain",
+    "open", "compress", "decompress", "compress_many", "decompress_many",
+    "CompressorPool", "BlockCache", "decompress_file", "decompress_range",
+    "is_check_supported",
+    "read_index", "XZIndex",
 ]
 
+import contextlib
 import io
+import os
+import sys
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6 has no OrderedDict. This provides just what CompressorPool
+    # and BlockCache need of one.
+    from collections import deque
+
+    class OrderedDict(dict):
+
+        def __init__(self):
+            dict.__init__(self)
+            self._order = deque()
+
+        def __setitem__(self, key, value):
+            if key not in self:
+                self._order.append(key)
+            dict.__setitem__(self, key, value)
+
+        def __delitem__(self, key):
+            dict.__delitem__(self, key)
+            self._order.remove(key)
+
+        def __iter__(self):
+            return iter(self._order)
+
+        def pop(self, key, *default):
+            if key in self:
+                self._order.remove(key)
+            return dict.pop(self, key, *default)
+
+        def popitem(self, last=True):
+            if not self:
+                raise KeyError("dictionary is empty")
+            key = self._order.pop() if last else self._order.popleft()
+            return key, dict.pop(self, key)
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from ._lzma import *
 from ._lzma import _encode_filter_properties, _decode_filter_properties
+from ._lzma import _compress_buffer, _decompress_buffer
+from ._lzma import _compress_many, _decompress_many
+from ._index import read_index, XZIndex, _round_up4
+from ._pipeline import _PipelinedWriter, _cpu_count
+from ._prefetch import _Prefetcher
+from ._mapped import _MappedFile
+
+if sys.version_info >= (3, 5):
+    from ._async import AsyncLZMAFile, aopen
+    __all__ += ["AsyncLZMAFile", "aopen"]
 
 
 _MODE_CLOSED   = 0
@@ -33,6 +93,29 @@ _MODE_WRITE    = 3
 
 _BUFFER_SIZE = 8192
 
+_XZ_MAGIC = b"\xfd7zXZ\x00"
+
+# Upper bound on the decompressed data produced by each call to the
+# decompressor, so that reads use bounded memory however well the
+# input compresses.
+_MAX_OUTPUT_SIZE = 65536
+
+# Default size of the blocks compressed in parallel by pipelined writes.
+_PIPELINE_BLOCK_SIZE = 1 << 22
+
+# Default number of decompressed chunks queued by prefetch=True.
+_PREFETCH_DEPTH = 16
+
+# Upper bound on the compression ratio believed when sizing an output
+# buffer from the sizes recorded in .xz indexes, which have not been
+# checked against the data yet. LZMA2 does not compress much beyond
+# 7000:1.
+_MAX_COMPRESSION_RATIO = 8192
+
+# Default size of the slices of a memory-mapped file fed to the
+# decompressor. Slicing the mapping copies nothing, so they can be large.
+_MMAP_READ_SIZE = 1 << 20
+
 
 __version__ = "0.0.14"
 
@@ -48,7 +131,10 @@ class LZMAFile(io.BufferedIOBase):
     """
 
     def __init__(self, filename=None, mode="r",
-                 format=None, check=-1, preset=None, filters=None):
+                 format=None, check=-1, preset=None, filters=None,
+                 threads=1, block_size=0, buffer_size=None,
+                 max_buffer_size=None, pipeline=False, prefetch=0,
+                 mmap=False, block_cache=None):
         """Open an LZMA-compressed file in binary mode.
 
         filename can be either an actual file name (given as a str, unicode
@@ -88,9 +174,53 @@ class LZMAFile(io.BufferedIOBase):
 
         filters (if provided) should be a sequence of dicts. Each dict
         should have an entry for "id" indicating ID of the filter, plus
-        additional entries for options to the filter.
+        additional entries for options to the filter, or a FilterChain.
+
+        threads specifies the number of worker threads to use, as for
+        LZMACompressor and LZMADecompressor. block_size (as for
+        LZMACompressor) can only be used when opening a file for writing.
+        It splits the file into independent blocks of block_size
+        uncompressed bytes, like "xz --block-size", so that readers can
+        later seek in it, or decompress it in parallel, a block at a time.
+
+        buffer_size is the number of bytes of compressed data read from
+        the underlying file at a time (8192 by default). If max_buffer_size
+        is larger, the read size doubles with each sequential read, up to
+        max_buffer_size, and drops back to buffer_size after a seek; this
+        suits high-latency storage, where each read is costly. These
+        arguments can only be used when opening a file for reading.
+
+        If pipeline is true (only allowed when writing with FORMAT_XZ),
+        write() just queues its data: the data is cut into blocks of
+        block_size bytes (4 MiB by default), which threads worker threads
+        compress in parallel (0 means one per available CPU core), and a
+        background thread writes them to the underlying file in order, as
+        a single .xz stream. The caller only waits when the queue of
+        blocks is full. Errors in the background threads are raised by
+        the next call to write() or close().
+
+        If prefetch is non-zero (only allowed when reading), a background
+        thread reads and decompresses the file ahead of the caller,
+        keeping up to prefetch chunks of up to 64 KiB of decompressed
+        data queued (prefetch=True queues up to 16). This overlaps I/O and
+        decompression with the caller's own work when reading sequentially.
+
+        If mmap is true (only allowed when reading), the file is memory-
+        mapped, and the decompressor is fed directly from the mapping,
+        1 MiB at a time unless buffer_size is given. filename must then
+        be a file name, or a file object with a fileno() method.
+
+        block_cache (only allowed when reading) is a BlockCache. When
+        seek() or read_at() moves into a block of an .xz file, the whole
+        block is then decompressed and kept in the cache, and later reads
+        of that block are served from memory. Cached blocks are tied to
+        the file's device, inode, size and modification and change times;
+        a file rewritten in place without changing any of them (within the
+        file system's timestamp resolution) may be served stale blocks.
         """
         self._fp = None
+        self._pipeline = None
+        self._prefetcher = None
         self._closefp = False
         self._mode = _MODE_CLOSED
         self._pos = 0
@@ -103,25 +233,110 @@ class LZMAFile(io.BufferedIOBase):
             if preset is not None:
                 raise ValueError("Cannot specify a preset compression "
                                  "level when opening a file for reading")
+            if block_size:
+                raise ValueError("Cannot specify a block size "
+                                 "when opening a file for reading")
+            if buffer_size is None:
+                buffer_size = _MMAP_READ_SIZE if mmap else _BUFFER_SIZE
+            if max_buffer_size is None:
+                max_buffer_size = buffer_size
+            if buffer_size <= 0:
+                raise ValueError("buffer_size must be positive")
+            if max_buffer_size < buffer_size:
+                raise ValueError("max_buffer_size must not be less than "
+                                 "buffer_size")
+            if pipeline:
+                raise ValueError("Cannot use a pipeline "
+                                 "when opening a file for reading")
+            if prefetch is True:
+                prefetch = _PREFETCH_DEPTH
+            if prefetch < 0:
+                raise ValueError("prefetch must not be negative")
             if format is None:
                 format = FORMAT_AUTO
             mode_code = _MODE_READ
+            self._block_cache = block_cache
             # Save the args to pass to the LZMADecompressor initializer.
-            # If the file contains multiple compressed streams, each
-            # stream will need a separate decompressor object.
-            self._init_args = {"format":format, "filters":filters}
+            # The decompressor walks through concatenated streams itself,
+            # except for FORMAT_RAW, where it is reset at the start of each
+            # one.
+            self._init_args = {"format":format, "filters":filters,
+                               "threads":threads,
+                               "concatenated":format != FORMAT_RAW}
             self._decompressor = LZMADecompressor(**self._init_args)
-            self._buffer = None
+            # Decompressed data not yet returned starts at _buffer_offset,
+            # so that small reads do not copy the rest of the buffer.
+            self._buffer = b""
+            self._buffer_offset = 0
+            # The .xz index used for seeking; loaded on the first seek.
+            self._index = None
+            # After seeking into the middle of a stream, the number of bytes
+            # of block data left in it, and the offset of the next stream.
+            self._block_data_left = None
+            self._stream_end = None
+            # Size of the next read from _fp; see _read_raw().
+            self._buffer_size = buffer_size
+            self._max_buffer_size = max_buffer_size
+            self._read_size = buffer_size
+            # Maximum number of chunks queued by the prefetch thread, and
+            # chunks it had queued when it was last stopped.
+            self._prefetch = prefetch
+            self._prefetched = []
+            # Used by read_at(): a pool of block decoders, and locks for
+            # loading the index and for reading the underlying file where
+            # os.pread() cannot be used.
+            self._decoders = CompressorPool()
+            self._index_lock = threading.Lock()
+            self._fp_lock = threading.Lock()
         elif mode in ("w", "wb", "a", "ab"):
+            if buffer_size is not None or max_buffer_size is not None:
+                raise ValueError("Cannot specify a buffer size "
+                                 "when opening a file for writing")
+            if prefetch:
+                raise ValueError("Cannot prefetch "
+                                 "when opening a file for writing")
+            if mmap:
+                raise ValueError("Cannot memory-map a file "
+                                 "opened for writing")
+            if block_cache is not None:
+                raise ValueError("Cannot use a block cache "
+                                 "when opening a file for writing")
             if format is None:
                 format = FORMAT_XZ
             mode_code = _MODE_WRITE
-            self._compressor = LZMACompressor(format=format, check=check,
-                                              preset=preset, filters=filters)
+            if pipeline:
+                if format != FORMAT_XZ:
+                    raise ValueError("Pipelined writing is only supported "
+                                     "by FORMAT_XZ")
+                if threads < 0:
+                    raise ValueError("Number of threads must not be negative")
+                if block_size < 0:
+                    raise ValueError("block_size must not be negative")
+                # This checks the settings before the file is opened, and
+                # becomes the first worker's compressor.
+                compressor = LZMACompressor(format=format, check=check,
+                                            preset=preset, filters=filters)
+                pipeline = (compressor, check, preset, filters, threads,
+                            block_size or _PIPELINE_BLOCK_SIZE)
+            else:
+                self._compressor = LZMACompressor(format=format, check=check,
+                                                  preset=preset,
+                                                  filters=filters,
+                                                  threads=threads,
+                                                  block_size=block_size)
+                # Set when flush(FLUSH_FINISH) has ended a stream; the
+                # compressor is reset if more data is written.
+                self._finished = False
         else:
             raise ValueError("Invalid mode: {!r}".format(mode))
 
-        if hasattr(filename, "read") or hasattr(filename, "write"):
+        if mmap:
+            # The mapping is always closed, but a file object passed in
+            # is left open, as usual.
+            self._fp = _MappedFile(filename)
+            self._closefp = True
+            self._mode = mode_code
+        elif hasattr(filename, "read") or hasattr(filename, "write"):
             self._fp = filename
             self._mode = mode_code
         else:
@@ -130,6 +345,12 @@ class LZMAFile(io.BufferedIOBase):
             self._fp = io.open(filename, mode)
             self._closefp = True
             self._mode = mode_code
+        if pipeline and mode_code == _MODE_WRITE:
+            self._pipeline = _PipelinedWriter(self._fp, *pipeline)
+        if mode_code == _MODE_READ:
+            self._cache_key = (None if block_cache is None
+                               else _file_identity(self._fp))
+            self._fd = _pread_fd(self._fp)
 
     def close(self):
         """Flush and close the file.
@@ -141,10 +362,17 @@ class LZMAFile(io.BufferedIOBase):
             return
         try:
             if self._mode in (_MODE_READ, _MODE_READ_EOF):
+                self._stop_prefetch()
+                self._prefetched = []
                 self._decompressor = None
-                self._buffer = None
+                self._decoders.clear()
+                self._buffer = b""
+            elif self._pipeline is not None:
+                self._pipeline, pipeline = None, self._pipeline
+                pipeline.close()
             elif self._mode == _MODE_WRITE:
-                self._fp.write(self._compressor.flush())
+                if not self._finished:
+                    self._fp.write(self._compressor.flush())
                 self._compressor = None
         finally:
             try:
@@ -201,63 +429,158 @@ class LZMAFile(io.BufferedIOBase):
             raise io.UnsupportedOperation("The underlying file object "
                                           "does not support seeking")
 
-    # Fill the readahead buffer if it is empty. Returns False on EOF.
-    def _fill_buffer(self):
+    # Read a chunk of compressed data, stopping at the end of the block data
+    # of the current stream if we seeked into it. Reads between seeks are
+    # sequential, so each one is twice the size of the last (up to
+    # _max_buffer_size).
+    def _read_raw(self):
+        size = self._read_size
+        if self._read_size < self._max_buffer_size:
+            self._read_size = min(self._read_size * 2, self._max_buffer_size)
+        if self._block_data_left is None:
+            return self._fp.read(size)
+        rawblock = self._fp.read(min(size, self._block_data_left))
+        self._block_data_left -= len(rawblock)
+        return rawblock
+
+    # Decompress rawblock, writing the output into out if it is given.
+    # Returns the decompressed data, or the number of bytes written to out.
+    def _decompress(self, rawblock, out):
+        if out is None:
+            return self._decompressor.decompress(rawblock, _MAX_OUTPUT_SIZE)
+        return self._decompressor.decompress_into(rawblock, out)
+
+    # Start decompressing the next stream. Returns None on EOF.
+    def _start_next_stream(self, rawblock, out):
+        if not rawblock:
+            return None
+        if self._decompressor.eof and self._init_args["concatenated"]:
+            # The decompressor carries on with the next stream by itself.
+            return self._decompress(rawblock, out)
+        self._decompressor.reset()
+        try:
+            return self._decompress(rawblock, out)
+        except LZMAError:
+            # Trailing data isn't a valid compressed stream; ignore it.
+            return None
+
+    # Decompress more data, as for _decompress(). Returns None on EOF, and
+    # otherwise at least one byte of output. This only touches the state
+    # of the underlying file and the decompressor (not the position or
+    # the buffer), so that the prefetch thread can call it.
+    def _decompress_more(self, out=None):
         # Depending on the input data, our call to the decompressor may not
         # return any data. In this case, try again after reading another block.
         while True:
-            if self._buffer:
-                return True
-
-            if self._decompressor.unused_data:
-                rawblock = self._decompressor.unused_data
-            else:
-                rawblock = self._fp.read(_BUFFER_SIZE)
-
-            if not rawblock:
-                if self._decompressor.eof:
-                    self._mode = _MODE_READ_EOF
-                    self._size = self._pos
-                    return False
+            if self._decompressor.eof:
+                if (self._init_args["concatenated"] and
+                        self._decompressor.unused_data):
+                    # Trailing data isn't a valid compressed stream.
+                    return None
+                rawblock = self._decompressor.unused_data or self._read_raw()
+                result = self._start_next_stream(rawblock, out)
+                if result is None:
+                    return None
+            elif self._decompressor.needs_input:
+                rawblock = self._read_raw()
+                if rawblock:
+                    result = self._decompress(rawblock, out)
+                elif self._block_data_left == 0:
+                    # All blocks of the stream we seeked into have been
+                    # decompressed. Skip its index and footer.
+                    self._fp.seek(self._stream_end)
+                    self._block_data_left = None
+                    result = self._start_next_stream(self._read_raw(), out)
+                    if result is None:
+                        return None
                 else:
                     raise EOFError("Compressed file ended before the "
                                    "end-of-stream marker was reached")
-
-            if self._decompressor.eof:
-                # Continue to next stream.
-                self._decompressor = LZMADecompressor(**self._init_args)
-                try:
-                    self._buffer = self._decompressor.decompress(rawblock)
-                except LZMAError:
-                    # Trailing data isn't a valid compressed stream; ignore it.
-                    self._mode = _MODE_READ_EOF
-                    self._size = self._pos
-                    return False
             else:
-                self._buffer = self._decompressor.decompress(rawblock)
+                # Collect output still pending from the previous input.
+                result = self._decompress(b"", out)
+            if result:
+                return result
+
+    def _set_eof(self):
+        self._mode = _MODE_READ_EOF
+        self._size = self._pos
+
+    # Return the next chunk of decompressed data, or None on EOF.
+    def _next_chunk(self):
+        if not self._prefetch:
+            return self._decompress_more()
+        if self._prefetched:
+            chunk, error = self._prefetched.pop(0)
+        else:
+            if self._prefetcher is None:
+                self._prefetcher = _Prefetcher(self._decompress_more,
+                                               self._prefetch)
+            chunk, error = self._prefetcher.get()
+            if chunk is None:
+                self._prefetcher = None  # The thread has exited.
+        if error is not None:
+            raise error
+        return chunk
+
+    # Stop the prefetch thread, keeping the chunks it queued in
+    # _prefetched, so that the caller may use the underlying file and
+    # the decompressor.
+    def _stop_prefetch(self):
+        if self._prefetcher is not None:
+            self._prefetched.extend(self._prefetcher.stop())
+            self._prefetcher = None
+
+    # Fill the readahead buffer if it is empty. Returns False on EOF.
+    def _fill_buffer(self):
+        if self._buffer_offset < len(self._buffer):
+            return True
+        self._buffer = self._next_chunk() or b""
+        self._buffer_offset = 0
+        if not self._buffer:
+            self._set_eof()
+            return False
+        return True
+
     # Read data until EOF.
     # If return_data is false, consume the data without returning it.
     def _read_all(self, return_data=True):
+        # The loop assumes that _buffer_offset is 0. Ensure that this is true.
+        self._buffer = self._buffer[self._buffer_offset:]
+        self._buffer_offset = 0
+
         blocks = []
         while self._fill_buffer():
             if return_data:
                 blocks.append(self._buffer)
             self._pos += len(self._buffer)
-            self._buffer = None
+            self._buffer = b""
         if return_data:
             return b"".join(blocks)
 
     # Read a block of up to n bytes.
     # If return_data is false, consume the data without returning it.
     def _read_block(self, n, return_data=True):
+        # If we have enough data buffered, return immediately.
+        end = self._buffer_offset + n
+        if end <= len(self._buffer):
+            data = self._buffer[self._buffer_offset:end]
+            self._buffer_offset = end
+            self._pos += len(data)
+            return data if return_data else None
+
+        # The loop assumes that _buffer_offset is 0. Ensure that this is true.
+        self._buffer = self._buffer[self._buffer_offset:]
+        self._buffer_offset = 0
+
         blocks = []
         while n > 0 and self._fill_buffer():
             if n < len(self._buffer):
                 data = self._buffer[:n]
-                self._buffer = self._buffer[n:]
+                self._buffer_offset = n
             else:
                 data = self._buffer
-                self._buffer = None
+                self._buffer = b""
             if return_data:
                 blocks.append(data)
             self._pos += len(data)
@@ -274,7 +597,7 @@ class LZMAFile(io.BufferedIOBase):
         self._check_can_read()
         if self._mode == _MODE_READ_EOF or not self._fill_buffer():
             return b""
-        return self._buffer
+        return self._buffer[self._buffer_offset:]
 
     def read(self, size=-1):
         """Read up to size uncompressed bytes from the file.
@@ -311,15 +634,70 @@ class LZMAFile(io.BufferedIOBase):
         if (size == 0 or self._mode == _MODE_READ_EOF or
             not self._fill_buffer()):
             return b""
-        if 0 < size < len(self._buffer):
-            data = self._buffer[:size]
-            self._buffer = self._buffer[size:]
+        if size > 0:
+            data = self._buffer[self._buffer_offset:
+                                self._buffer_offset + size]
+            self._buffer_offset += len(data)
         else:
-            data = self._buffer
-            self._buffer = None
+            data = self._buffer[self._buffer_offset:]
+            self._buffer = b""
+            self._buffer_offset = 0
         self._pos += len(data)
         return data
 
+    def readinto(self, b):
+        """Read up to len(b) uncompressed bytes into the writable buffer b.
+
+        Data is decompressed directly into b where possible. Returns the
+        number of bytes read (0 for EOF).
+        """
+        self._check_can_read()
+        return self._readinto(b, read1=False)
+
+    def readinto1(self, b):
+        """Read up to len(b) uncompressed bytes into the writable buffer b,
+        while trying to avoid making multiple reads from the underlying
+        stream.
+
+        Returns the number of bytes read (0 for EOF).
+        """
+        self._check_can_read()
+        return self._readinto(b, read1=True)
+
+    def _readinto(self, b, read1):
+        view = memoryview(b)
+        if hasattr(view, "cast") and view.format != "B":
+            view = view.cast("B")
+        size = len(view)
+        if size == 0 or self._mode == _MODE_READ_EOF:
+            return 0
+        n = 0
+        if self._buffer_offset < len(self._buffer):
+            # Hand out data that is already buffered first.
+            n = min(size, len(self._buffer) - self._buffer_offset)
+            view[:n] = memoryview(self._buffer)[self._buffer_offset:
+                                                self._buffer_offset + n]
+            self._buffer_offset += n
+            self._pos += n
+        while n < size and not (read1 and n):
+            if self._prefetch:
+                # Copy from the chunks queued by the prefetch thread.
+                if not self._fill_buffer():
+                    break
+                written = min(size - n,
+                              len(self._buffer) - self._buffer_offset)
+                view[n:n + written] = memoryview(self._buffer)[
+                    self._buffer_offset:self._buffer_offset + written]
+                self._buffer_offset += written
+            else:
+                written = self._decompress_more(view[n:])
+                if not written:
+                    self._set_eof()
+                    break
+            self._pos += written
+            n += written
+        return n
+
     def write(self, data):
         """Write a bytes object to the file.
 
@@ -328,18 +706,368 @@ class LZMAFile(io.BufferedIOBase):
         may not reflect the data written until close() is called.
         """
         self._check_can_write()
-        compressed = self._compressor.compress(data)
-        self._fp.write(compressed)
+        if self._pipeline is not None:
+            self._pipeline.write(data)
+        else:
+            if self._finished:
+                self._compressor.reset()
+                self._finished = False
+            compressed = self._compressor.compress(data)
+            self._fp.write(compressed)
         self._pos += len(data)
         return len(data)
 
+    def flush(self, mode=None):
+        """Flush the file.
+
+        Without a mode, this does nothing. Otherwise, the file must be
+        open for writing, and all the data written so far is compressed
+        and written to the underlying file (which is then flushed itself),
+        so that a reader on the other end of a pipe or socket can
+        decompress it right away.
+
+        mode is as for LZMACompressor.flush(). FLUSH_SYNC keeps the
+        compressor's dictionary, and FLUSH_FULL and FLUSH_BLOCK start a
+        new .xz block; in all three cases the stream carries on. With
+        FLUSH_FINISH, the stream is ended, and any data written afterwards
+        goes in a new stream following it in the file. Flushing is not
+        supported when writing with pipeline=True.
+        """
+        if mode is None:
+            return super(LZMAFile, self).flush()
+        self._check_can_write()
+        if self._pipeline is not None:
+            raise io.UnsupportedOperation("Cannot flush a pipelined file")
+        if not self._finished:
+            self._fp.write(self._compressor.flush(mode))
+            self._finished = mode == FLUSH_FINISH
+        if hasattr(self._fp, "flush"):
+            self._fp.flush()
+
     # Rewind the file to the beginning of the data stream.
     def _rewind(self):
         self._fp.seek(0, 0)
         self._mode = _MODE_READ
         self._pos = 0
-        self._decompressor = LZMADecompressor(**self._init_args)
-        self._buffer = None
+        self._decompressor.reset()
+        self._buffer = b""
+        self._buffer_offset = 0
+        self._prefetched = []
+        self._block_data_left = None
+        self._read_size = self._buffer_size
+
+    # Return the index of the underlying .xz file, or None if it cannot be
+    # used for seeking. fp is the file to read it from, if not _fp.
+    def _load_index(self, fp=None):
+        if self._index is None:
+            self._index = False
+            if self._init_args["format"] in (FORMAT_AUTO, FORMAT_XZ):
+                try:
+                    index = read_index(self._fp if fp is None else fp)
+                except LZMAError:
+                    pass
+                else:
+                    # Sequential reads treat stream padding like trailing
+                    # garbage, so only use an index describing exactly the
+                    # data they would return.
+                    if not index.has_padding:
+                        self._index = index
+                        self._size = index.uncompressed_size
+        return self._index or None
+
+    # Move to the start of the block holding offset, unless reading forward
+    # from the current position gets there without leaving that block.
+    def _seek_block(self, index, offset):
+        block = index.find_block(max(offset, 0))
+        if block is None:
+            # At or beyond the end of the data.
+            self._mode = _MODE_READ_EOF
+            self._pos = self._size = index.uncompressed_size
+            self._buffer = b""
+            self._buffer_offset = 0
+            self._prefetched = []
+            return
+        start = int(index.block_uncompressed_offsets[block])
+        if self._mode == _MODE_READ and start <= self._pos <= offset:
+            return
+        stream = index.block_stream(block)
+        raw_offset = int(index.block_compressed_offsets[block])
+        buffer = b""
+        if self._cacheable(index, block):
+            # Serve the block from the buffer, and carry on decompressing
+            # from the next one.
+            buffer = self._cached_block(index, block)
+            raw_offset += _round_up4(int(index.block_unpadded_sizes[block]))
+        self._fp.seek(raw_offset)
+        self._mode = _MODE_READ
+        self._pos = start
+        self._buffer = buffer
+        self._buffer_offset = 0
+        self._prefetched = []
+        # Prime the decompressor with the stream header, so that it can
+        # pick up decoding from the start of the block.
+        self._decompressor.reset()
+        self._decompressor.decompress(stream.header)
+        self._block_data_left = stream.index_offset - raw_offset
+        self._stream_end = stream.end
+        self._read_size = self._buffer_size
+
+    # Return whether the given block may be kept in the block cache. Larger
+    # blocks are never decompressed whole, so memory use stays bounded.
+    def _cacheable(self, index, block):
+        return (self._block_cache is not None and
+                index.block_uncompressed_sizes[block] <=
+                self._block_cache.max_bytes)
+
+    # Return the decompressed data of the given block, from the block cache
+    # if possible.
+    def _cached_block(self, index, block):
+        key = (self._cache_key, int(index.block_compressed_offsets[block]))
+        data = self._block_cache._get(key)
+        if data is None:
+            data = self._decode_block(index, block)
+            self._block_cache._put(key, data)
+        return data
+
+    # Decompress the given block with a decoder from _decoders, into out if
+    # given (which must be the size of the block). The whole block is
+    # decoded, so that its integrity check is verified. Reads the block
+    # with _pread(), so this is safe to call from any thread.
+    def _decode_block(self, index, block, out=None):
+        size = _round_up4(int(index.block_unpadded_sizes[block]))
+        rawblock = self._pread(int(index.block_compressed_offsets[block]),
+                               size)
+        expected = int(index.block_uncompressed_sizes[block])
+        # Corrupt data can decompress to any size, so stop one byte past
+        # the size of the block.
+        with self._decoders.decompressor(FORMAT_XZ) as decomp:
+            decomp.decompress(index.block_stream(block).header)
+            if out is None:
+                data = decomp.decompress(rawblock, expected + 1)
+                length = len(data)
+            else:
+                data = out
+                length = decomp.decompress_into(rawblock, out)
+                if not decomp.needs_input:
+                    # out is full; let the decoder finish the block.
+                    length += len(decomp.decompress(b"", 1))
+        if length != expected:
+            raise LZMAError("Corrupt input data")
+        return data
+
+    # Return bytes lo to hi of the decompressed data of the given block, for
+    # read_at() and read_range(). Blocks that fit in the block cache are
+    # decompressed whole and cached; otherwise just the bytes up to hi are.
+    def _block_part(self, index, block, lo, hi):
+        if self._cacheable(index, block):
+            return self._cached_block(index, block)[lo:hi]
+        return self._decode_block_part(index, block, lo, hi)
+
+    # Decompress bytes lo to hi of the given block with a decoder from
+    # _decoders, reading the block a chunk at a time with _pread(), so that
+    # memory use is bounded by the size of the result. The block's
+    # integrity check is only verified if hi is the end of the block.
+    def _decode_block_part(self, index, block, lo, hi):
+        raw_pos = int(index.block_compressed_offsets[block])
+        raw_end = raw_pos + _round_up4(int(index.block_unpadded_sizes[block]))
+        whole = hi == index.block_uncompressed_sizes[block]
+        chunks = []
+        pos = 0
+        with self._decoders.decompressor(FORMAT_XZ) as decomp:
+            decomp.decompress(index.block_stream(block).header)
+            while pos < hi or (whole and (raw_pos < raw_end or
+                                          not decomp.needs_input)):
+                rawblock = b""
+                if decomp.needs_input:
+                    if raw_pos >= raw_end:
+                        break
+                    rawblock = self._pread(raw_pos,
+                                           min(self._max_buffer_size,
+                                               raw_end - raw_pos))
+                    if not rawblock:
+                        break
+                    raw_pos += len(rawblock)
+                if pos < lo:
+                    # Decompress and discard the data before lo.
+                    data = decomp.decompress(
+                        rawblock, min(lo - pos, _MAX_OUTPUT_SIZE))
+                elif pos < hi:
+                    data = decomp.decompress(rawblock, hi - pos)
+                    chunks.append(data)
+                else:
+                    # The rest of the block must not produce any output.
+                    data = decomp.decompress(rawblock, 1)
+                    if data:
+                        break
+                pos += len(data)
+        if pos != hi:
+            raise LZMAError("Corrupt input data")
+        return b"".join(chunks)
+
+    # Read up to size bytes of the underlying file from offset, leaving its
+    # position unchanged.
+    def _pread(self, offset, size):
+        fp = self._fp
+        if isinstance(fp, _MappedFile):
+            return fp.data[offset:offset + size]
+        if self._fd is not None:
+            chunks = []
+            while size > 0:
+                chunk = os.pread(self._fd, size, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+                size -= len(chunk)
+            return b"".join(chunks)
+        with self._fp_lock:
+            pos = fp.tell()
+            try:
+                fp.seek(offset)
+                return fp.read(size)
+            finally:
+                fp.seek(pos)
+
+    # Return the size of the underlying file, as for _pread().
+    def _raw_size(self):
+        fp = self._fp
+        if isinstance(fp, _MappedFile):
+            return len(fp.data)
+        if self._fd is not None:
+            return os.fstat(self._fd).st_size
+        with self._fp_lock:
+            pos = fp.tell()
+            try:
+                fp.seek(0, 2)
+                return fp.tell()
+            finally:
+                fp.seek(pos)
+
+    def read_at(self, offset, size):
+        """Read up to size bytes of decompressed data, starting at offset.
+
+        Unlike read(), read_at() does not use or change the file position,
+        and can be called from any number of threads at once. Each call
+        uses the index of the .xz file to find the blocks holding the
+        data, and decompresses just those (the GIL is released while it
+        does so), with decompressors from a pool kept by the file. Each
+        block is only decompressed as far as the end of the data, so
+        memory use is bounded by size, and a block's integrity check is
+        only verified if the data reaches its end. The block cache is
+        used, if the file has one, for blocks small enough to fit in it;
+        those are decompressed whole.
+
+        Fewer than size bytes are returned only at the end of the data.
+        io.UnsupportedOperation is raised unless the file is a seekable
+        .xz file with a usable index (as for fast seeking).
+
+        The underlying file is read with os.pread(), or from the mapping
+        if mmap is true. Other file objects are read under a lock, with
+        their position restored afterwards; read_at() must then not be
+        used at the same time as read(), seek() or prefetching.
+        """
+        index = self._positional_index(offset, size)
+        end = min(offset + size, index.uncompressed_size)
+        chunks = []
+        while offset < end:
+            block = index.find_block(offset)
+            start = int(index.block_uncompressed_offsets[block])
+            stop = start + int(index.block_uncompressed_sizes[block])
+            chunks.append(self._block_part(index, block, offset - start,
+                                           min(stop, end) - start))
+            offset = stop
+        return b"".join(chunks)
+
+    def read_range(self, offset, size, threads=0):
+        """Read up to size bytes of decompressed data, starting at offset,
+        decompressing the blocks holding them in parallel.
+
+        threads is the number of worker threads to use (0 means one per
+        available CPU core). The data is returned as a bytearray, which
+        each block is decompressed straight into, so even a large range is
+        not copied once decompressed. The blocks at either end of the range
+        are decompressed as for read_at(), and may come from the block
+        cache; the others bypass it.
+
+        This suits extracting large ranges of files written in many
+        blocks, such as by "xz --block-size" or LZMAFile's block_size
+        argument: a single block is decompressed by a single thread. As
+        for read_at(), the file position is not used or changed, and
+        io.UnsupportedOperation is raised unless the file is a seekable
+        .xz file with a usable index.
+        """
+        if threads < 0:
+            raise ValueError("Number of threads must not be negative")
+        index = self._positional_index(offset, size)
+        end = min(offset + size, index.uncompressed_size)
+        out = bytearray(max(end - offset, 0))
+        if not out:
+            return out
+        tasks = queue.Queue()
+        for block in range(index.find_block(offset),
+                           index.find_block(end - 1) + 1):
+            if index.block_uncompressed_sizes[block]:
+                tasks.put(block)
+        if threads == 0:
+            threads = _cpu_count()
+        threads = min(threads, tasks.qsize())
+        errors = []
+        args = (index, tasks, offset, memoryview(out), errors)
+        if threads <= 1:
+            self._read_range_blocks(*args)
+        else:
+            workers = [threading.Thread(target=self._read_range_blocks,
+                                        args=args)
+                       for i in range(threads)]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            for worker in workers:
+                worker.join()
+        del args  # Release the memoryview of out.
+        if errors:
+            raise errors[0]
+        return out
+
+    # Worker for read_range(): decompress the blocks queued in tasks into
+    # out, which holds the data from offset. Stops at the first error, which
+    # is appended to errors.
+    def _read_range_blocks(self, index, tasks, offset, out, errors):
+        end = offset + len(out)
+        while not errors:
+            try:
+                block = tasks.get_nowait()
+            except queue.Empty:
+                return
+            start = int(index.block_uncompressed_offsets[block])
+            stop = start + int(index.block_uncompressed_sizes[block])
+            try:
+                if start < offset or stop > end:
+                    # Only part of the block is wanted.
+                    lo, hi = max(start, offset), min(stop, end)
+                    out[lo - offset:hi - offset] = self._block_part(
+                        index, block, lo - start, hi - start)
+                else:
+                    self._decode_block(index, block,
+                                       out[start - offset:stop - offset])
+            except Exception as e:
+                errors.append(e)
+
+    # Check the arguments of read_at() or read_range(), and return the
+    # index of the file, loading it without changing the file position.
+    def _positional_index(self, offset, size):
+        self._check_can_seek()
+        if offset < 0:
+            raise ValueError("offset must not be negative")
+        if size < 0:
+            raise ValueError("size must not be negative")
+        with self._index_lock:
+            index = self._load_index(_PositionalReader(self._pread,
+                                                       self._raw_size))
+        if index is None:
+            raise io.UnsupportedOperation("Random access requires an .xz "
+                                          "file with a usable index")
+        return index
 
     def seek(self, offset, whence=0):
         """Change the file position.
@@ -353,10 +1081,14 @@ class LZMAFile(io.BufferedIOBase):
 
         Returns the new file position.
 
-        Note that seeking is emulated, sp depending on the parameters,
-        this operation may be extremely slow.
+        Note that seeking is emulated, so depending on the parameters,
+        this operation may be extremely slow. For .xz files, the index
+        at the end of each stream is used to jump straight to the block
+        holding the new position, so only the data from the start of
+        that block needs to be decompressed.
         """
         self._check_can_seek()
+        self._stop_prefetch()
 
         # Recalculate offset as an absolute file position.
         if whence == 0:
@@ -365,7 +1097,8 @@ class LZMAFile(io.BufferedIOBase):
             offset = self._pos + offset
         elif whence == 2:
             # Seeking relative to EOF - we need to know the file's size.
-            if self._size < 0:
+            # If the file has no usable index, we must decompress it all.
+            if self._size < 0 and self._load_index() is None:
                 self._read_all(return_data=False)
             offset = self._size + offset
         else:
@@ -376,14 +1109,15 @@ class LZMAFile(io.BufferedIOBase):
             #This is not needed on Python 3 where the comparison to self._pos
             #will fail with a TypeError.
             raise TypeError("Seek offset should be an integer, not None")
-        if offset < self._pos:
+        index = self._load_index()
+        if index is not None:
+            self._seek_block(index, offset)
+        elif offset < self._pos:
             self._rewind()
-        else:
-            offset -= self._pos
 
         # Read and discard data until we reach the desired position.
         if self._mode != _MODE_READ_EOF:
-            self._read_block(offset, return_data=False)
+            self._read_block(offset - self._pos, return_data=False)
 
         return self._pos
 
@@ -393,9 +1127,65 @@ class LZMAFile(io.BufferedIOBase):
         return self._pos
 
 
+class _PositionalReader(object):
+
+    """Read-only file object over the underlying file of an LZMAFile, for
+    read_index(). pread(offset, size) reads the data, and size() returns
+    the size of the file, without changing the file's own position.
+    """
+
+    def __init__(self, pread, size):
+        self._pread = pread
+        self._size = size
+        self._pos = 0
+
+    def read(self, size):
+        data = self._pread(self._pos, size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size()
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+
+# Return a file descriptor from which os.pread() reads the same data as
+# the file object fp, or None if there is none.
+def _pread_fd(fp):
+    if not hasattr(os, "pread"):
+        return None
+    raw = getattr(fp, "raw", fp)
+    if not isinstance(raw, io.FileIO):
+        return None
+    return raw.fileno()
+
+
+# Return a key identifying the file fp reads from, for BlockCache. Files
+# without a file descriptor get a key of their own. The times are in
+# nanoseconds where available (Python 3.3 and later), so that a rewrite
+# is only missed if it leaves both of them unchanged at that resolution.
+def _file_identity(fp):
+    try:
+        st = os.fstat(fp.fileno())
+    except (AttributeError, OSError, ValueError):
+        return object()
+    return (st.st_dev, st.st_ino, st.st_size,
+            getattr(st, "st_mtime_ns", st.st_mtime),
+            getattr(st, "st_ctime_ns", st.st_ctime))
+
+
 def open(filename, mode="rb",
          format=None, check=-1, preset=None, filters=None,
-         encoding=None, errors=None, newline=None):
+         encoding=None, errors=None, newline=None,
+         threads=1, block_size=0, buffer_size=None, max_buffer_size=None,
+         pipeline=False, prefetch=0, mmap=False, block_cache=None):
     """Open an LZMA-compressed file in binary or text mode.
 
     filename can be either an actual file name (given as a str or bytes object),
@@ -405,8 +1195,13 @@ def open(filename, mode="rb",
     The mode argument can be "r", "rb" (default), "w", "wb", "a", or "ab" for
     binary mode, or "rt", "wt" or "at" for text mode.
 
-    The format, check, preset and filters arguments specify the compression
-    settings, as for LZMACompressor, LZMADecompressor and LZMAFile.
+    The format, check, preset, filters, threads and block_size arguments
+    specify the compression settings, as for LZMACompressor,
+    LZMADecompressor and LZMAFile. The buffer_size and max_buffer_size
+    arguments control reads from the underlying file, and pipeline,
+    prefetch, mmap and block_cache select pipelined writing, read-ahead,
+    memory-mapped reading and caching of decompressed blocks, as for
+    LZMAFile.
 
     For binary mode, this function is equivalent to the LZMAFile constructor:
     LZMAFile(filename, mode, ...). In this case, the encoding, errors and
@@ -430,7 +1225,12 @@ def open(filename, mode="rb",
 
     lz_mode = mode.replace("t", "")
     binary_file = LZMAFile(filename, lz_mode, format=format, check=check,
-                           preset=preset, filters=filters)
+                           preset=preset, filters=filters,
+                           threads=threads, block_size=block_size,
+                           buffer_size=buffer_size,
+                           max_buffer_size=max_buffer_size,
+                           pipeline=pipeline, prefetch=prefetch,
+                           mmap=mmap, block_cache=block_cache)
 
     if "t" in mode:
         return io.TextIOWrapper(binary_file, encoding, errors, newline)
@@ -438,34 +1238,94 @@ def open(filename, mode="rb",
         return binary_file
 
 
-def compress(data, format=FORMAT_XZ, check=-1, preset=None, filters=None):
+def compress(data, format=FORMAT_XZ, check=-1, preset=None, filters=None,
+             threads=1, block_size=0):
     """Compress a block of data.
 
     Refer to LZMACompressor's docstring for a description of the
-    optional arguments *format*, *check*, *preset* and *filters*.
+    optional arguments *format*, *check*, *preset*, *filters*, *threads*
+    and *block_size*.
 
     For incremental compression, use an LZMACompressor object instead.
     """
-    comp = LZMACompressor(format, check, preset, filters)
-    return comp.compress(data) + comp.flush()
-
-
-def decompress(data, format=FORMAT_AUTO, memlimit=None, filters=None):
+    return _compress_buffer(data, format, check, preset, filters, threads,
+                            block_size)
+
+
+# Return the uncompressed size of each stream in data, as recorded in the
+# stream indexes, or an empty list if data is not simply a series of .xz
+# streams. Other buffer types are skipped, as BytesIO would copy them.
+def _stream_sizes(data, format):
+    if (format not in (FORMAT_AUTO, FORMAT_XZ) or
+        not isinstance(data, bytes) or not data.startswith(_XZ_MAGIC)):
+        return []
+    try:
+        index = read_index(io.BytesIO(data))
+    except LZMAError:
+        return []
+    if index.has_padding:
+        return []
+    return [stream.uncompressed_size for stream in index.streams]
+
+
+# Return the expected size of the decompressed .xz streams in data, for
+# sizing the output buffer, or 0 if it is not known. The indexes could be
+# forged, so sizes beyond what data could decompress to, or beyond
+# memlimit, are not believed.
+def _size_hint(data, format, memlimit=None):
+    size = sum(_stream_sizes(data, format))
+    if size > len(data) * _MAX_COMPRESSION_RATIO:
+        return 0
+    if memlimit is not None and size > memlimit:
+        return 0
+    return size
+
+
+def decompress(data, format=FORMAT_AUTO, memlimit=None, filters=None,
+               threads=1):
     """Decompress a block of data.
 
     Refer to LZMADecompressor's docstring for a description of the
-    optional arguments *format*, *check* and *filters*.
+    optional arguments *format*, *memlimit*, *filters* and *threads*.
 
     For incremental decompression, use a LZMADecompressor object instead.
     """
+    if format in (FORMAT_AUTO, FORMAT_XZ) and threads == 1:
+        # Data made up only of .xz streams can be decoded in a single call.
+        try:
+            result = _decompress_buffer(data, memlimit)
+        except LZMAError:
+            result = None  # Let the code below report or skip bad data.
+        if result is not None:
+            return result
+    decomp = LZMADecompressor(format, memlimit, filters, threads,
+                              format != FORMAT_RAW)
+    return _decompress_streams(decomp, data, format, memlimit)
+
+
+# Decompress all the streams in data with decomp, which must have been
+# created with concatenated=True (and the given memlimit) unless format
+# is FORMAT_RAW. Any data following the last valid stream is ignored.
+def _decompress_streams(decomp, data, format, memlimit=None):
+    if format != FORMAT_RAW:
+        # All the streams are decoded in a single pass over data. Knowing
+        # the size of the output up front saves growing the output buffer
+        # repeatedly while decompressing.
+        result = decomp.decompress(data, -1,
+                                   _size_hint(data, format, memlimit))
+        if not decomp.eof:
+            raise LZMAError("Compressed data ended before the "
+                            "end-of-stream marker was reached")
+        return result
+    # Raw streams have no header to tell them apart from trailing data, so
+    # each one is decompressed by resetting decomp and trying again.
     results = []
     while True:
-        decomp = LZMADecompressor(format, memlimit, filters)
         try:
             res = decomp.decompress(data)
         except LZMAError:
             if results:
-                break  # Leftover data is not a valid LZMA/XZ stream; ignore it.
+                break  # Leftover data is not a valid raw stream; ignore it.
             else:
                 raise  # Error on the first iteration; bail out.
         results.append(res)
@@ -475,4 +1335,294 @@ def decompress(data, format=FORMAT_AUTO, memlimit=None, filters=None):
         data = decomp.unused_data
         if not data:
             break
+        decomp.reset()
     return b"".join(results)
+
+
+def decompress_file(filename, format=FORMAT_AUTO, memlimit=None,
+                    filters=None, threads=1):
+    """Decompress the whole of a compressed file.
+
+    filename can be a file name, or a file object with a fileno() method
+    (which is read from its current position). The file is
+    memory-mapped and decompressed as if by decompress(), without first
+    reading it into a bytes object. Refer to LZMADecompressor's
+    docstring for a description of the other arguments.
+    """
+    mapped = _MappedFile(filename)
+    try:
+        return decompress(mapped.data[mapped.tell():], format, memlimit,
+                          filters, threads)
+    finally:
+        mapped.close()
+
+
+def decompress_range(filename, offset, size, threads=0):
+    """Decompress size bytes of an .xz file, starting at offset.
+
+    filename can be a file name, or a seekable file object opened in
+    binary mode. The blocks holding the data are found with the file's
+    index and decompressed in parallel, as by LZMAFile.read_range(),
+    using threads worker threads (0 means one per available CPU core).
+    Returns a bytearray, shorter than size only at the end of the data.
+    """
+    with LZMAFile(filename) as f:
+        return f.read_range(offset, size, threads)
+
+
+def compress_many(buffers, format=FORMAT_XZ, check=-1, preset=None,
+                  filters=None, threads=1):
+    """Compress each of a sequence of buffers.
+
+    Returns a list of bytes objects, the same as calling compress() on
+    each item, but much faster for many small items: the whole batch is
+    compressed without holding the GIL, and the encoder's memory is reused
+    from one item to the next.
+
+    threads is the number of threads compressing items in parallel (0
+    means one per available CPU core). Each item is compressed by a single
+    thread. Refer to LZMACompressor's docstring for a description of the
+    other arguments.
+    """
+    return _compress_many(buffers, format, check, preset, filters, threads)
+
+
+def decompress_many(buffers, format=FORMAT_AUTO, memlimit=None, filters=None,
+                    threads=1):
+    """Decompress each of a sequence of buffers.
+
+    Returns a list of bytes objects, the same as calling decompress() on
+    each item. As for compress_many(), the batch is processed without
+    holding the GIL, reusing the decoder's memory, and threads is the
+    number of threads decompressing items in parallel.
+
+    Refer to LZMADecompressor's docstring for a description of the
+    other arguments.
+    """
+    buffers = list(buffers)
+    results = _decompress_many(buffers, format, memlimit, filters, threads)
+    for i, result in enumerate(results):
+        if result is None:
+            # The item holds more than one stream, has trailing data or
+            # is invalid. Fall back on decompress() to handle it.
+            results[i] = decompress(buffers[i], format, memlimit, filters)
+    return results
+
+
+# Return a hashable equivalent of a filter chain specifier.
+def _filters_key(filters):
+    if filters is None or isinstance(filters, FilterChain):
+        return filters
+    return tuple(tuple(sorted(spec.items())) for spec in filters)
+
+
+class CompressorPool(object):
+
+    """A thread-safe pool of reusable compressor and decompressor objects.
+
+    Creating an LZMACompressor allocates the encoder's dictionary and
+    match finder, which at the higher presets take hundreds of megabytes.
+    A CompressorPool keeps objects that have finished their work, keyed
+    by the settings they were created with, and reset()s them for the
+    next caller asking for the same settings, so that liblzma can reuse
+    their memory. (Reuse still clears the match finder's hash table, so
+    for small inputs at presets 7 to 9 a fresh compressor, whose memory
+    the OS hands out already zeroed, may be just as fast.)
+
+    maxsize is the maximum number of idle objects kept in the pool. When
+    it is exceeded, those with the least recently used settings are
+    discarded first. maxsize=0 disables pooling.
+
+    The hits and misses attributes count the requests that were served
+    from the pool and those that needed a new object, respectively.
+    """
+
+    def __init__(self, maxsize=8):
+        if maxsize < 0:
+            raise ValueError("maxsize must be non-negative")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._idle = OrderedDict()  # Settings -> list of idle objects.
+        self._size = 0
+
+    def __len__(self):
+        """Return the number of idle objects in the pool."""
+        return self._size
+
+    def clear(self):
+        """Discard all the idle objects in the pool."""
+        with self._lock:
+            idle = self._idle
+            self._idle = OrderedDict()
+            self._size = 0
+        del idle  # Free the objects without holding the lock.
+
+    def _acquire(self, key, factory):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.hits += 1
+                self._size -= 1
+                obj = idle.pop()
+                if not idle:
+                    del self._idle[key]
+                return obj
+            self.misses += 1
+        return factory()
+
+    def _release(self, key, obj):
+        try:
+            obj.reset()
+        except LZMAError:
+            return
+        evicted = []
+        with self._lock:
+            # Re-insert the key to mark it as the most recently used.
+            idle = self._idle.pop(key, [])
+            idle.append(obj)
+            self._idle[key] = idle
+            self._size += 1
+            while self._size > self.maxsize:
+                oldest = next(iter(self._idle))
+                idle = self._idle[oldest]
+                evicted.append(idle.pop(0))
+                if not idle:
+                    del self._idle[oldest]
+                self._size -= 1
+        del evicted  # Free the objects without holding the lock.
+
+    @contextlib.contextmanager
+    def _borrow(self, key, factory):
+        obj = self._acquire(key, factory)
+        try:
+            yield obj
+        finally:
+            self._release(key, obj)
+
+    def compressor(self, format=FORMAT_XZ, check=-1, preset=None,
+                   filters=None, threads=1, block_size=0):
+        """Return a context manager lending out an LZMACompressor.
+
+        The compressor is fresh or has been reset, and goes back to the
+        pool when the with block exits, so it must not be used after
+        that. Refer to LZMACompressor's docstring for a description of
+        the arguments.
+        """
+        key = (LZMACompressor, format, check, preset, _filters_key(filters),
+               threads, block_size)
+        return self._borrow(key, lambda: LZMACompressor(
+            format, check, preset, filters, threads, block_size))
+
+    def decompressor(self, format=FORMAT_AUTO, memlimit=None, filters=None,
+                     threads=1, concatenated=False):
+        """Return a context manager lending out an LZMADecompressor.
+
+        As for compressor(), the decompressor goes back to the pool when
+        the with block exits. Refer to LZMADecompressor's docstring for a
+        description of the arguments.
+        """
+        key = (LZMADecompressor, format, memlimit, _filters_key(filters),
+               threads, concatenated)
+        return self._borrow(key, lambda: LZMADecompressor(
+            format, memlimit, filters, threads, concatenated))
+
+    def compress(self, data, format=FORMAT_XZ, check=-1, preset=None,
+                 filters=None, threads=1, block_size=0):
+        """Compress a block of data with a compressor from the pool.
+
+        The result is the same as for the compress() function.
+        """
+        with self.compressor(format, check, preset, filters, threads,
+                             block_size) as comp:
+            return comp.compress(data) + comp.flush()
+
+    def decompress(self, data, format=FORMAT_AUTO, memlimit=None,
+                   filters=None, threads=1):
+        """Decompress a block of data with a decompressor from the pool.
+
+        The result is the same as for the decompress() function.
+        """
+        with self.decompressor(format, memlimit, filters, threads,
+                               format != FORMAT_RAW) as decomp:
+            return _decompress_streams(decomp, data, format, memlimit)
+
+
+class BlockCache(object):
+
+    """A thread-safe LRU cache of decompressed .xz blocks, for LZMAFile.
+
+    Pass a BlockCache as the block_cache argument of LZMAFile or open()
+    to keep the blocks that seek() decompresses in memory, so that later
+    seeks into the same blocks are served without decompressing them
+    again. A cache can be shared by any number of files, and by files in
+    different threads; blocks are keyed by the identity of the file on
+    disk (its device, inode, size, and modification and change times, in
+    nanoseconds where available), so files opened from the same path
+    share their cached blocks. A file rewritten in place within the
+    resolution of the file system's timestamps, and at the same size,
+    cannot be told apart from the original; clear() the cache after such
+    a rewrite. Blocks of file objects without a fileno() are only cached
+    for the LZMAFile using them.
+
+    max_bytes is the maximum total size of the cached blocks. When it is
+    exceeded, the least recently used blocks are discarded first. Blocks
+    larger than max_bytes are not cached; seeking into them decompresses
+    just what is needed, as without a cache.
+
+    The hits and misses attributes count the lookups that found a block
+    in the cache and those that did not, and evictions counts the blocks
+    discarded to make room for others.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        if max_bytes < 0:
+            raise ValueError("max_bytes must be non-negative")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()  # (file, block offset) -> data.
+        self._size = 0
+
+    def __len__(self):
+        """Return the number of blocks in the cache."""
+        return len(self._blocks)
+
+    @property
+    def size(self):
+        """The total size of the blocks in the cache, in bytes."""
+        return self._size
+
+    def clear(self):
+        """Discard all the blocks in the cache."""
+        with self._lock:
+            self._blocks = OrderedDict()
+            self._size = 0
+
+    def _get(self, key):
+        with self._lock:
+            data = self._blocks.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            # Re-insert the block to mark it as the most recently used.
+            self._blocks[key] = data
+            self.hits += 1
+            return data
+
+    def _put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._blocks.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._blocks[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                oldest, evicted = self._blocks.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
@@ -0,0 +1,300 @@
+"""asyncio support for reading and writing compressed streams.
+
+This module uses async/await syntax, so backports.lzma only imports it
+on Python 3.5 and later.
+"""
+
+import asyncio
+import inspect
+import io
+
+from ._lzma import (LZMACompressor, LZMADecompressor, LZMAError,
+                    FORMAT_AUTO, FORMAT_XZ)
+
+
+_MODE_CLOSED   = 0
+_MODE_READ     = 1
+_MODE_READ_EOF = 2
+_MODE_WRITE    = 3
+
+_CHUNK_SIZE = 65536
+
+# Compressing less data than this is quicker than handing it over to the
+# executor, so it is done on the event loop's thread.
+_INLINE_SIZE = 4096
+
+
+class AsyncLZMAFile(object):
+
+    """A file object providing LZMA (de)compression for asyncio code.
+
+    fileobj can be an asyncio StreamReader (for reading) or StreamWriter
+    (for writing), a file object whose read() or write() methods are
+    coroutines, such as those from aiofiles, or a file name. Named files
+    are opened on first use, and their blocking I/O is done in the
+    executor. File objects passed in are not closed by close().
+
+    mode can be "r"/"rb" for reading (default), or "w"/"wb" or "a"/"ab"
+    for writing. The format, check, preset, filters, threads and
+    block_size arguments are as for LZMAFile.
+
+    Compression and decompression are done by an executor (the event
+    loop's default one if executor is None), while liblzma releases the
+    GIL, so a single event loop can serve many compressed streams at
+    once. chunk_size is the amount of compressed data read from fileobj
+    at a time, and the maximum amount of decompressed data produced by
+    each call to the decompressor.
+
+    Iterating over an AsyncLZMAFile with "async for" gives the
+    decompressed data in chunks of at most chunk_size bytes.
+    """
+
+    def __init__(self, fileobj, mode="r",
+                 format=None, check=-1, preset=None, filters=None,
+                 threads=1, block_size=0, chunk_size=_CHUNK_SIZE,
+                 executor=None):
+        self._fp = None
+        self._filename = None
+        self._mode = _MODE_CLOSED
+        self._executor = executor
+        self._pos = 0
+
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive")
+        self._chunk_size = chunk_size
+
+        if mode in ("r", "rb"):
+            if check != -1:
+                raise ValueError("Cannot specify an integrity check "
+                                 "when opening a file for reading")
+            if preset is not None:
+                raise ValueError("Cannot specify a preset compression "
+                                 "level when opening a file for reading")
+            if format is None:
+                format = FORMAT_AUTO
+            mode_code = _MODE_READ
+            self._decompressor = LZMADecompressor(format=format,
+                                                  filters=filters,
+                                                  threads=threads)
+        elif mode in ("w", "wb", "a", "ab"):
+            if format is None:
+                format = FORMAT_XZ
+            mode_code = _MODE_WRITE
+            self._compressor = LZMACompressor(format=format, check=check,
+                                              preset=preset, filters=filters,
+                                              threads=threads,
+                                              block_size=block_size)
+        else:
+            raise ValueError("Invalid mode: {!r}".format(mode))
+
+        if hasattr(fileobj, "read") or hasattr(fileobj, "write"):
+            self._fp = fileobj
+        elif isinstance(fileobj, (str, bytes)):
+            self._filename = fileobj
+            self._file_mode = mode if "b" in mode else mode + "b"
+        else:
+            raise TypeError("fileobj must be a str or bytes object, "
+                            "or a file or stream object")
+        self._mode = mode_code
+
+    def __repr__(self):
+        name = self._filename if self._fp is None else self._fp
+        return "<AsyncLZMAFile {!r}>".format(name)
+
+    async def __aenter__(self):
+        self._check_not_closed()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.read1()
+        if not data:
+            raise StopAsyncIteration
+        return data
+
+    @property
+    def closed(self):
+        """True if this file is closed."""
+        return self._mode == _MODE_CLOSED
+
+    def readable(self):
+        """Return whether the file was opened for reading."""
+        self._check_not_closed()
+        return self._mode in (_MODE_READ, _MODE_READ_EOF)
+
+    def writable(self):
+        """Return whether the file was opened for writing."""
+        self._check_not_closed()
+        return self._mode == _MODE_WRITE
+
+    def tell(self):
+        """Return the current uncompressed file position."""
+        self._check_not_closed()
+        return self._pos
+
+    def _check_not_closed(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+    def _check_can_read(self):
+        if not self.readable():
+            raise io.UnsupportedOperation("File not open for reading")
+
+    def _check_can_write(self):
+        if not self.writable():
+            raise io.UnsupportedOperation("File not open for writing")
+
+    # Run func(*args) in the executor.
+    def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, func, *args)
+
+    # Call a method of the underlying file, awaiting the result if it is
+    # awaitable. Named files are blocking, so their methods are called in
+    # the executor instead.
+    async def _call_fp(self, name, *args):
+        if self._filename is not None:
+            if self._fp is None:
+                self._fp = await self._run(io.open, self._filename,
+                                           self._file_mode)
+            return await self._run(getattr(self._fp, name), *args)
+        result = getattr(self._fp, name)(*args)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def close(self):
+        """Flush and close the file.
+
+        May be called more than once without error. Once the file is
+        closed, any other operation on it will raise a ValueError.
+        """
+        if self._mode == _MODE_CLOSED:
+            return
+        try:
+            if self._mode == _MODE_WRITE:
+                compressed = await self._run(self._compressor.flush)
+                await self._write_raw(compressed)
+                self._compressor = None
+            else:
+                self._decompressor = None
+        finally:
+            try:
+                if self._filename is not None and self._fp is not None:
+                    await self._run(self._fp.close)
+            finally:
+                self._fp = None
+                self._mode = _MODE_CLOSED
+
+    # Decompress more data. Returns b"" on EOF, and otherwise at least
+    # one byte of output. As for LZMAFile, concatenated streams are
+    # decompressed in turn, and trailing data that isn't a valid stream
+    # is ignored.
+    async def _decompress_more(self, size):
+        decompressor = self._decompressor
+        while True:
+            if decompressor.eof:
+                rawblock = (decompressor.unused_data or
+                            await self._call_fp("read", self._chunk_size))
+                if not rawblock:
+                    self._mode = _MODE_READ_EOF
+                    return b""
+                decompressor.reset()
+                try:
+                    result = await self._run(decompressor.decompress,
+                                             rawblock, size)
+                except LZMAError:
+                    self._mode = _MODE_READ_EOF
+                    return b""
+            elif decompressor.needs_input:
+                rawblock = await self._call_fp("read", self._chunk_size)
+                if not rawblock:
+                    raise EOFError("Compressed file ended before the "
+                                   "end-of-stream marker was reached")
+                result = await self._run(decompressor.decompress, rawblock,
+                                         size)
+            else:
+                # Collect output still pending from the previous input.
+                result = await self._run(decompressor.decompress, b"", size)
+            if result:
+                return result
+
+    async def read1(self, size=-1):
+        """Read up to size uncompressed bytes, decompressing at most one
+        chunk of input.
+
+        If size is negative or omitted, up to chunk_size bytes are
+        returned. Returns b"" if the file is at EOF.
+        """
+        self._check_can_read()
+        if size < 0:
+            size = self._chunk_size
+        if self._mode == _MODE_READ_EOF or size == 0:
+            return b""
+        data = await self._decompress_more(size)
+        self._pos += len(data)
+        return data
+
+    async def read(self, size=-1):
+        """Read up to size uncompressed bytes from the file.
+
+        If size is negative or omitted, read until EOF is reached.
+        Returns b"" if the file is already at EOF.
+        """
+        self._check_can_read()
+        blocks = []
+        while size != 0:
+            data = await self.read1(size if size > 0 else self._chunk_size)
+            if not data:
+                break
+            blocks.append(data)
+            if size > 0:
+                size -= len(data)
+        return b"".join(blocks)
+
+    async def _write_raw(self, data):
+        if data:
+            await self._call_fp("write", data)
+        if hasattr(self._fp, "drain"):
+            # Apply the StreamWriter's flow control.
+            await self._fp.drain()
+
+    async def write(self, data):
+        """Write a bytes object to the file.
+
+        Returns the number of uncompressed bytes written, which is
+        always len(data). Compressed data is passed on to the underlying
+        file as soon as the compressor produces it.
+        """
+        self._check_can_write()
+        if len(data) < _INLINE_SIZE:
+            compressed = self._compressor.compress(data)
+        else:
+            compressed = await self._run(self._compressor.compress, data)
+        await self._write_raw(compressed)
+        self._pos += len(data)
+        return len(data)
+
+
+def aopen(fileobj, mode="rb",
+          format=None, check=-1, preset=None, filters=None,
+          threads=1, block_size=0, chunk_size=_CHUNK_SIZE, executor=None):
+    """Open an LZMA-compressed file or stream for use with asyncio.
+
+    This is equivalent to AsyncLZMAFile(fileobj, mode, ...); see its
+    docstring for a description of the arguments. The result can be
+    used as an async context manager:
+
+        async with aopen(reader) as f:
+            async for chunk in f:
+                ...
+    """
+    return AsyncLZMAFile(fileobj, mode, format=format, check=check,
+                         preset=preset, filters=filters, threads=threads,
+                         block_size=block_size, chunk_size=chunk_size,
+                         executor=executor)
@@ -0,0 +1,337 @@
+"""Parsing of .xz stream indexes.
+
+Every .xz stream ends with an index recording the compressed and
+uncompressed size of each of its blocks, followed by a fixed-size
+footer giving the size of the index. Walking these backwards from the
+end of a file tells us where every block starts, both in the file and
+in the uncompressed data, without decompressing anything.
+"""
+
+import binascii
+import io
+import struct
+from array import array
+from bisect import bisect_right
+
+from ._lzma import LZMAError
+
+try:
+    _range = xrange
+except NameError:
+    _range = range
+
+
+# Offsets and sizes are stored in arrays of 64-bit unsigned integers.
+# Python 2 lacks the "Q" typecode, and its "L" is only 32 bits wide on
+# some platforms; doubles still represent every realistic size exactly.
+for _TYPECODE in ("Q", "L", "d"):
+    try:
+        if array(_TYPECODE).itemsize >= 8:
+            break
+    except ValueError:
+        pass
+
+_HEADER_MAGIC = b"\xfd7zXZ\x00"
+_FOOTER_MAGIC = b"YZ"
+_HEADER_SIZE = 12
+_FOOTER_SIZE = 12
+
+# How far to read backwards at a time when skipping stream padding.
+_PADDING_CHUNK_SIZE = 4096
+
+
+def _crc32(data):
+    return binascii.crc32(data) & 0xffffffff
+
+
+def _round_up4(n):
+    return (n + 3) & ~3
+
+
+def _stream_header(check):
+    """Return the 12-byte header of a stream using the given check."""
+    flags = b"\x00" + struct.pack("<B", check)
+    return _HEADER_MAGIC + flags + struct.pack("<I", _crc32(flags))
+
+
+def _stream_footer(check, index_size):
+    """Return the 12-byte footer of a stream with an index of index_size."""
+    rest = struct.pack("<I", index_size // 4 - 1) + b"\x00" + \
+        struct.pack("<B", check)
+    return struct.pack("<I", _crc32(rest)) + rest + _FOOTER_MAGIC
+
+
+def _encode_vli(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _encode_index(records):
+    """Return a stream index for a list of (unpadded size, uncompressed
+    size) pairs, one per block."""
+    parts = [b"\x00", _encode_vli(len(records))]
+    for unpadded_size, uncompressed_size in records:
+        parts.append(_encode_vli(unpadded_size))
+        parts.append(_encode_vli(uncompressed_size))
+    index = b"".join(parts)
+    index += b"\x00" * (_round_up4(len(index)) - len(index))
+    return index + struct.pack("<I", _crc32(index))
+
+
+def _decode_vli(data, pos):
+    # data is a bytearray, so indexing gives ints on Python 2 and 3.
+    result = 0
+    for i in range(9):
+        if pos + i >= len(data):
+            break
+        byte = data[pos + i]
+        result |= (byte & 0x7f) << (7 * i)
+        if not byte & 0x80:
+            if byte == 0 and i > 0:
+                break  # Not the shortest possible encoding.
+            return result, pos + i + 1
+    raise LZMAError("Corrupt input data")
+
+
+def _read_at(fp, offset, size):
+    fp.seek(offset)
+    data = fp.read(size)
+    if len(data) != size:
+        raise LZMAError("Compressed file ended before the "
+                        "end-of-stream marker was reached")
+    return bytes(data)
+
+
+def _skip_padding(fp, pos):
+    # Return the position just after the last non-zero byte before pos.
+    # Padding is rare and short, so start small and read more if needed.
+    n = 4
+    while pos > 0:
+        n = min(pos, n)
+        chunk = _read_at(fp, pos - n, n).rstrip(b"\x00")
+        if chunk:
+            return pos - n + len(chunk)
+        pos -= n
+        n = min(n * 2, _PADDING_CHUNK_SIZE)
+    return 0
+
+
+def _decode_footer(footer):
+    if footer[10:] != _FOOTER_MAGIC:
+        raise LZMAError("Input format not supported by decoder")
+    crc, backward_size = struct.unpack("<II", footer[:8])
+    flags = footer[8:10]
+    if _crc32(footer[4:10]) != crc or flags[0:1] != b"\x00":
+        raise LZMAError("Corrupt input data")
+    return (backward_size + 1) * 4, flags
+
+
+def _decode_index(index):
+    # Return a list of (unpadded size, uncompressed size) pairs.
+    data = bytearray(index)
+    crc = struct.unpack("<I", index[-4:])[0]
+    if data[0] != 0 or _crc32(index[:-4]) != crc:
+        raise LZMAError("Corrupt input data")
+    count, pos = _decode_vli(data, 1)
+    # Each record takes at least two bytes; check the count against the
+    # space left before trusting it as a loop bound.
+    if count > (len(data) - 4 - pos) // 2:
+        raise LZMAError("Corrupt input data")
+    records = []
+    for i in _range(count):
+        unpadded_size, pos = _decode_vli(data, pos)
+        uncompressed_size, pos = _decode_vli(data, pos)
+        records.append((unpadded_size, uncompressed_size))
+    if _round_up4(pos) + 4 != len(data) or any(data[pos:-4]):
+        raise LZMAError("Corrupt input data")
+    return records
+
+
+class XZIndex(object):
+
+    """Block layout of an .xz file, as recorded in its stream indexes.
+
+    XZIndex objects are returned by read_index(). The per-block tables
+    are array.array objects of unsigned 64-bit integers, with one entry
+    per block in file order:
+
+        block_compressed_offsets: offset of each block in the file
+        block_unpadded_sizes: compressed size of each block, excluding
+            the padding that aligns the next block to four bytes
+        block_uncompressed_offsets: offset of each block's data in the
+            decompressed output
+        block_uncompressed_sizes: decompressed size of each block
+        block_streams: number of the stream holding each block
+
+    The streams attribute is a list describing each stream in the file
+    (in order), with attributes offset, size (excluding any padding),
+    padding, check, uncompressed_offset, uncompressed_size, first_block
+    and block_count.
+    """
+
+    def __init__(self):
+        self.streams = []
+        self.compressed_size = 0
+        self.uncompressed_size = 0
+        self.block_compressed_offsets = array(_TYPECODE)
+        self.block_unpadded_sizes = array(_TYPECODE)
+        self.block_uncompressed_offsets = array(_TYPECODE)
+        self.block_uncompressed_sizes = array(_TYPECODE)
+        self.block_streams = array(_TYPECODE)
+
+    def __repr__(self):
+        return ("<XZIndex: %d stream(s), %d block(s), %d bytes compressed, "
+                "%d bytes uncompressed>" % (self.stream_count,
+                                            self.block_count,
+                                            self.compressed_size,
+                                            self.uncompressed_size))
+
+    @property
+    def block_count(self):
+        """Number of blocks in all the streams."""
+        return len(self.block_compressed_offsets)
+
+    @property
+    def stream_count(self):
+        """Number of streams in the file."""
+        return len(self.streams)
+
+    @property
+    def has_padding(self):
+        """True if there is stream padding after any of the streams."""
+        return any(s.padding for s in self.streams)
+
+    def find_block(self, offset):
+        """Return the number of the block holding an uncompressed offset.
+
+        Empty blocks are skipped. Returns None if offset is beyond the
+        end of the uncompressed data.
+        """
+        if not 0 <= offset < self.uncompressed_size:
+            return None
+        return bisect_right(self.block_uncompressed_offsets, offset) - 1
+
+    def block_stream(self, block):
+        """Return the description of the stream holding a block."""
+        return self.streams[int(self.block_streams[block])]
+
+
+class _Stream(object):
+
+    """Location and settings of one stream in an .xz file."""
+
+    def __init__(self, offset, size, padding, check, index_offset):
+        self.offset = offset
+        self.size = size
+        self.padding = padding
+        self.check = check
+        self.index_offset = index_offset
+        self.uncompressed_offset = 0
+        self.uncompressed_size = 0
+        self.first_block = 0
+        self.block_count = 0
+
+    def __repr__(self):
+        return ("<stream at offset %d: %d block(s), %d bytes, check %d>"
+                % (self.offset, self.block_count, self.size, self.check))
+
+    @property
+    def header(self):
+        return _stream_header(self.check)
+
+    @property
+    def end(self):
+        """Offset just past this stream and any padding following it."""
+        return self.offset + self.size + self.padding
+
+
+def read_index(fileobj):
+    """Read the block layout of an .xz file without decompressing it.
+
+    fileobj can be either a file name (given as a str or bytes object),
+    or a seekable file object opened in binary mode. Only the footer
+    and index of each stream (plus its header) are read, working back
+    from the end of the file, so this is fast even for huge files. The
+    position of a file object is left unchanged.
+
+    The file must consist only of .xz streams (optionally separated by
+    stream padding); LZMAError is raised otherwise.
+
+    Returns an XZIndex object.
+    """
+    if not (hasattr(fileobj, "read") or hasattr(fileobj, "seek")):
+        with io.open(fileobj, "rb") as fp:
+            return _read_index(fp)
+    pos = fileobj.tell()
+    try:
+        return _read_index(fileobj)
+    finally:
+        fileobj.seek(pos)
+
+
+def _read_index(fp):
+    """Read the indexes of all the streams in the seekable file fp.
+
+    The file position of fp is left unspecified. Raises LZMAError if
+    fp does not consist solely of .xz streams and stream padding.
+    """
+    fp.seek(0, 2)
+    pos = fp.tell()
+    file_size = pos
+    found = []
+    while pos > 0:
+        end = _skip_padding(fp, pos)
+        padding = pos - end
+        if padding % 4:
+            raise LZMAError("Corrupt input data")
+        if end < _HEADER_SIZE + _FOOTER_SIZE:
+            raise LZMAError("Input format not supported by decoder")
+        index_size, flags = _decode_footer(
+            _read_at(fp, end - _FOOTER_SIZE, _FOOTER_SIZE))
+        index_offset = end - _FOOTER_SIZE - index_size
+        if index_offset < _HEADER_SIZE:
+            raise LZMAError("Corrupt input data")
+        records = _decode_index(_read_at(fp, index_offset, index_size))
+        blocks_size = sum(_round_up4(r[0]) for r in records)
+        start = index_offset - blocks_size - _HEADER_SIZE
+        if start < 0:
+            raise LZMAError("Corrupt input data")
+        header = _read_at(fp, start, _HEADER_SIZE)
+        if header[:6] != _HEADER_MAGIC:
+            raise LZMAError("Input format not supported by decoder")
+        if header[6:8] != flags or _crc32(flags) != struct.unpack(
+                "<I", header[8:])[0]:
+            raise LZMAError("Corrupt input data")
+        check = struct.unpack("<B", flags[1:])[0]
+        found.append((_Stream(start, end - start, padding, check,
+                              index_offset), records))
+        pos = start
+    if not found:
+        raise LZMAError("Compressed file ended before the "
+                        "end-of-stream marker was reached")
+
+    index = XZIndex()
+    index.compressed_size = file_size
+    uncompressed_offset = 0
+    for number, (stream, records) in enumerate(reversed(found)):
+        stream.uncompressed_offset = uncompressed_offset
+        stream.first_block = index.block_count
+        stream.block_count = len(records)
+        offset = stream.offset + _HEADER_SIZE
+        for unpadded_size, uncompressed_size in records:
+            index.block_compressed_offsets.append(offset)
+            index.block_unpadded_sizes.append(unpadded_size)
+            index.block_uncompressed_offsets.append(uncompressed_offset)
+            index.block_uncompressed_sizes.append(uncompressed_size)
+            index.block_streams.append(number)
+            offset += _round_up4(unpadded_size)
+            uncompressed_offset += uncompressed_size
+        stream.uncompressed_size = (uncompressed_offset -
+                                    stream.uncompressed_offset)
+        index.streams.append(stream)
+    index.uncompressed_size = uncompressed_offset
+    return index
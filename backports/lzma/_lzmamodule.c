@@ -144,11 +144,41 @@ enum {
 
 #define LZMA_CHECK_UNKNOWN (LZMA_CHECK_ID_MAX + 1)
 
+/* The multithreaded encoder became part of the stable API in liblzma 5.2.0. */
+#if LZMA_VERSION >= 50020002
+#define HAVE_MT_ENCODER
+#endif
+
+/* Flush modes for LZMACompressor.flush(), the same as the corresponding
+   lzma_action values. */
+enum {
+    FLUSH_SYNC = LZMA_SYNC_FLUSH,
+    FLUSH_FULL = LZMA_FULL_FLUSH,
+    FLUSH_FINISH = LZMA_FINISH,
+    FLUSH_BLOCK = 4,    /* LZMA_FULL_BARRIER, added in liblzma 5.2.0 */
+};
+
+/* The multithreaded decoder was added in liblzma 5.4.0. */
+#if LZMA_VERSION >= 50040002
+#define HAVE_MT_DECODER
+#endif
+
 
 typedef struct {
     PyObject_HEAD
     lzma_stream lzs;
     int flushed;
+    /* The settings passed to the constructor, kept for reset(). */
+    int format;
+    int check;
+    PyObject *preset_obj;
+    PyObject *filterspecs;
+    int threads;
+    uint64_t block_size;
+    /* Whether the multithreaded .xz encoder is in use. */
+    char multithreaded;
+    /* Whether every filter in the chain supports LZMA_SYNC_FLUSH. */
+    char sync_flushable;
 #ifdef WITH_THREAD
     PyThread_type_lock lock;
 #endif
@@ -160,11 +190,44 @@ typedef struct {
     int check;
     char eof;
     PyObject *unused_data;
+    /* For FORMAT_AUTO with multiple threads, choosing between the .xz and
+       .lzma decoders is deferred until the first byte of input arrives. */
+    char deferred_init;
+    int format;
+    PyObject *filterspecs;
+    int threads;
+    uint64_t memlimit;
+    char needs_input;
+    uint8_t *input_buffer;
+    size_t input_buffer_size;
+    /* In concatenated mode, a stream following another one is only known
+       to be valid once it produces output. Until then, in_new_stream is
+       set, and the input it has consumed so far is kept in stream_head, so
+       that it can be returned in unused_data if it turns out not to be. */
+    char concatenated;
+    char in_new_stream;
+    uint8_t *stream_head;
+    size_t stream_head_size;
 #ifdef WITH_THREAD
     PyThread_type_lock lock;
 #endif
 } Decompressor;
 
+typedef struct {
+    PyObject_HEAD
+    lzma_filter filters[LZMA_FILTERS_MAX + 1];
+    /* Copies of the filter specifiers the chain was created from. */
+    PyObject *specs;
+    /* The filter IDs and raw options, used for hashing and comparison. */
+    PyObject *key;
+} FilterChain;
+
+#if PY_MAJOR_VERSION < 3
+typedef long Py_hash_t;
+#endif
+
+static PyTypeObject FilterChain_type;
+
 /* LZMAError class object. */
 static PyObject *Error;
 
@@ -219,11 +282,34 @@ catch_lzma_error(lzma_ret lzret)
 #define INITIAL_BUFFER_SIZE BUFSIZ
 #endif
 
+/* Upper bound on the compression ratio believed when sizing an output
+   buffer from the sizes recorded in .xz indexes, which have not been
+   checked against the data yet. LZMA2 does not compress much beyond
+   7000:1. */
+#define MAX_COMPRESSION_RATIO 8192
+
+/* The output buffer doubles in size each time it fills up, so producing n
+   bytes of output takes O(log n) reallocations. Beyond this size, it grows
+   by this much at a time instead, bounding the memory wasted at the end. */
+#define MAX_BUFFER_INCREMENT ((Py_ssize_t)256 << 20)
+
 static int
-grow_buffer(PyObject **buf)
+grow_buffer(PyObject **buf, Py_ssize_t max_length)
 {
-    size_t size = PyBytes_GET_SIZE(*buf);
-    return _PyBytes_Resize(buf, size + (size >> 3) + 6);
+    Py_ssize_t size = PyBytes_GET_SIZE(*buf);
+    Py_ssize_t increment, newsize;
+
+    increment = size < MAX_BUFFER_INCREMENT ? size : MAX_BUFFER_INCREMENT;
+    if (size > PY_SSIZE_T_MAX - increment) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    newsize = size + increment;
+
+    if (max_length > 0 && newsize > max_length)
+        newsize = max_length;
+
+    return _PyBytes_Resize(buf, newsize);
 }
 
 
@@ -464,11 +550,55 @@ free_filter_chain(lzma_filter filters[])
         PyMem_Free(filters[i].options);
 }
 
+/* Return the size of the options struct used by a filter. */
+static size_t
+filter_options_size(lzma_vli id)
+{
+    switch (id) {
+        case LZMA_FILTER_LZMA1:
+        case LZMA_FILTER_LZMA2:
+            return sizeof(lzma_options_lzma);
+        case LZMA_FILTER_DELTA:
+            return sizeof(lzma_options_delta);
+        default:
+            return sizeof(lzma_options_bcj);
+    }
+}
+
+/* Copy an already-parsed filter chain, so that the copy can be released
+   with free_filter_chain(). */
+static int
+copy_filter_chain(lzma_filter filters[], const lzma_filter src[])
+{
+    int i;
+
+    for (i = 0; src[i].id != LZMA_VLI_UNKNOWN; i++) {
+        size_t size = filter_options_size(src[i].id);
+
+        filters[i].id = src[i].id;
+        filters[i].options = PyMem_Malloc(size);
+        if (filters[i].options == NULL) {
+            filters[i].id = LZMA_VLI_UNKNOWN;
+            free_filter_chain(filters);
+            PyErr_NoMemory();
+            return -1;
+        }
+        memcpy(filters[i].options, src[i].options, size);
+    }
+    filters[i].id = LZMA_VLI_UNKNOWN;
+    return 0;
+}
+
 static int
 parse_filter_chain_spec(lzma_filter filters[], PyObject *filterspecs)
 {
     Py_ssize_t i, num_filters;
 
+    /* A FilterChain has been parsed and validated already. */
+    if (Py_TYPE(filterspecs) == &FilterChain_type)
+        return copy_filter_chain(filters,
+                                 ((FilterChain *)filterspecs)->filters);
+
     /* PySequence_Length() is not guaranteed to return error
        for non-sequence types, and it does not in PyPy.
        https://bugs.python.org/issue32500
@@ -597,41 +727,273 @@ error:
 }
 
 
+/* FilterChain class. */
+
+static PyObject *
+FilterChain_new(PyTypeObject *type, PyObject *args, PyObject *kwargs)
+{
+    static char *arg_names[] = {"filters", NULL};
+    PyObject *filterspecs;
+    FilterChain *self;
+    Py_ssize_t i, num_filters, key_size = 0;
+    char *key;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O:FilterChain", arg_names,
+                                     &filterspecs))
+        return NULL;
+
+    if (Py_TYPE(filterspecs) == &FilterChain_type) {
+        Py_INCREF(filterspecs);
+        return filterspecs;
+    }
+
+    self = (FilterChain *)type->tp_alloc(type, 0);
+    if (self == NULL)
+        return NULL;
+    self->filters[0].id = LZMA_VLI_UNKNOWN;
+
+    if (parse_filter_chain_spec(self->filters, filterspecs) == -1)
+        goto error;
+
+    for (num_filters = 0; self->filters[num_filters].id != LZMA_VLI_UNKNOWN;
+         num_filters++)
+        key_size += sizeof(lzma_vli) +
+                    filter_options_size(self->filters[num_filters].id);
+
+    self->specs = PyTuple_New(num_filters);
+    if (self->specs == NULL)
+        goto error;
+    for (i = 0; i < num_filters; i++) {
+        PyObject *spec, *copy;
+
+        spec = PySequence_GetItem(filterspecs, i);
+        if (spec == NULL)
+            goto error;
+        copy = PyDict_New();
+        if (copy == NULL || PyDict_Merge(copy, spec, 1) == -1) {
+            Py_DECREF(spec);
+            Py_XDECREF(copy);
+            goto error;
+        }
+        Py_DECREF(spec);
+        PyTuple_SET_ITEM(self->specs, i, copy);
+    }
+
+    /* The options structs were zeroed before being filled in, so equal
+       chains have identical bytes, padding included. */
+#if PY_MAJOR_VERSION >= 3
+    self->key = PyBytes_FromStringAndSize(NULL, key_size);
+#else
+    self->key = PyString_FromStringAndSize(NULL, key_size);
+#endif
+    if (self->key == NULL)
+        goto error;
+#if PY_MAJOR_VERSION >= 3
+    key = PyBytes_AS_STRING(self->key);
+#else
+    key = PyString_AS_STRING(self->key);
+#endif
+    for (i = 0; i < num_filters; i++) {
+        size_t size = filter_options_size(self->filters[i].id);
+
+        memcpy(key, &self->filters[i].id, sizeof(lzma_vli));
+        key += sizeof(lzma_vli);
+        memcpy(key, self->filters[i].options, size);
+        key += size;
+    }
+    return (PyObject *)self;
+
+error:
+    Py_DECREF(self);
+    return NULL;
+}
+
+static void
+FilterChain_dealloc(FilterChain *self)
+{
+    free_filter_chain(self->filters);
+    Py_XDECREF(self->specs);
+    Py_XDECREF(self->key);
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyObject *
+FilterChain_repr(FilterChain *self)
+{
+    PyObject *list, *list_repr, *result;
+
+    list = PySequence_List(self->specs);
+    if (list == NULL)
+        return NULL;
+    list_repr = PyObject_Repr(list);
+    Py_DECREF(list);
+    if (list_repr == NULL)
+        return NULL;
+#if PY_MAJOR_VERSION >= 3
+    result = PyUnicode_FromFormat("FilterChain(%U)", list_repr);
+#else
+    result = PyString_FromFormat("FilterChain(%s)",
+                                 PyString_AS_STRING(list_repr));
+#endif
+    Py_DECREF(list_repr);
+    return result;
+}
+
+static Py_hash_t
+FilterChain_hash(FilterChain *self)
+{
+    return PyObject_Hash(self->key);
+}
+
+static PyObject *
+FilterChain_richcompare(PyObject *self, PyObject *other, int op)
+{
+    if (Py_TYPE(other) != &FilterChain_type || (op != Py_EQ && op != Py_NE)) {
+        Py_INCREF(Py_NotImplemented);
+        return Py_NotImplemented;
+    }
+    return PyObject_RichCompare(((FilterChain *)self)->key,
+                                ((FilterChain *)other)->key, op);
+}
+
+static Py_ssize_t
+FilterChain_length(FilterChain *self)
+{
+    return PyTuple_GET_SIZE(self->specs);
+}
+
+/* Return a copy of a filter specifier, so that the chain stays immutable. */
+static PyObject *
+FilterChain_item(FilterChain *self, Py_ssize_t i)
+{
+    if (i < 0 || i >= PyTuple_GET_SIZE(self->specs)) {
+        PyErr_SetString(PyExc_IndexError, "FilterChain index out of range");
+        return NULL;
+    }
+    return PyDict_Copy(PyTuple_GET_ITEM(self->specs, i));
+}
+
+static PyObject *
+FilterChain_reduce(FilterChain *self, PyObject *noargs)
+{
+    PyObject *list, *result;
+
+    list = PySequence_List(self->specs);
+    if (list == NULL)
+        return NULL;
+    result = Py_BuildValue("(O(O))", Py_TYPE(self), list);
+    Py_DECREF(list);
+    return result;
+}
+
+static PyMethodDef FilterChain_methods[] = {
+    {"__reduce__", (PyCFunction)FilterChain_reduce, METH_NOARGS, NULL},
+    {NULL}
+};
+
+static PySequenceMethods FilterChain_as_sequence = {
+    (lenfunc)FilterChain_length,        /* sq_length */
+    0,                                  /* sq_concat */
+    0,                                  /* sq_repeat */
+    (ssizeargfunc)FilterChain_item,     /* sq_item */
+};
+
+PyDoc_STRVAR(FilterChain_doc,
+"FilterChain(filters)\n"
+"\n"
+"Create an immutable, pre-parsed filter chain.\n"
+"\n"
+"filters should be a sequence of dicts, in the same form as the filters\n"
+"argument of LZMACompressor. It is validated and converted to liblzma's\n"
+"native representation once, and the resulting FilterChain can then be\n"
+"passed as the filters argument of LZMACompressor, LZMADecompressor,\n"
+"LZMAFile and the module-level functions, saving the cost of parsing\n"
+"the dicts again each time.\n"
+"\n"
+"FilterChain objects are hashable, and compare equal if their filters\n"
+"have the same options. Indexing or iterating over a FilterChain gives\n"
+"copies of the dicts it was created from.\n");
+
+static PyTypeObject FilterChain_type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "backports.lzma.FilterChain",       /* tp_name */
+    sizeof(FilterChain),                /* tp_basicsize */
+    0,                                  /* tp_itemsize */
+    (destructor)FilterChain_dealloc,    /* tp_dealloc */
+    0,                                  /* tp_print */
+    0,                                  /* tp_getattr */
+    0,                                  /* tp_setattr */
+    0,                                  /* tp_reserved */
+    (reprfunc)FilterChain_repr,         /* tp_repr */
+    0,                                  /* tp_as_number */
+    &FilterChain_as_sequence,           /* tp_as_sequence */
+    0,                                  /* tp_as_mapping */
+    (hashfunc)FilterChain_hash,         /* tp_hash */
+    0,                                  /* tp_call */
+    0,                                  /* tp_str */
+    0,                                  /* tp_getattro */
+    0,                                  /* tp_setattro */
+    0,                                  /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                 /* tp_flags */
+    FilterChain_doc,                    /* tp_doc */
+    0,                                  /* tp_traverse */
+    0,                                  /* tp_clear */
+    FilterChain_richcompare,            /* tp_richcompare */
+    0,                                  /* tp_weaklistoffset */
+    0,                                  /* tp_iter */
+    0,                                  /* tp_iternext */
+    FilterChain_methods,                /* tp_methods */
+    0,                                  /* tp_members */
+    0,                                  /* tp_getset */
+    0,                                  /* tp_base */
+    0,                                  /* tp_dict */
+    0,                                  /* tp_descr_get */
+    0,                                  /* tp_descr_set */
+    0,                                  /* tp_dictoffset */
+    0,                                  /* tp_init */
+    0,                                  /* tp_alloc */
+    FilterChain_new,                    /* tp_new */
+};
+
+
 /* LZMACompressor class. */
 
+/* Feed data to the encoder lzs, returning the output produced. bufsize is
+   the initial size of the output buffer. */
 static PyObject *
-compress(Compressor *c, uint8_t *data, size_t len, lzma_action action)
+encode(lzma_stream *lzs, uint8_t *data, size_t len, lzma_action action,
+       Py_ssize_t bufsize)
 {
     size_t data_size = 0;
     PyObject *result;
 
-    result = PyBytes_FromStringAndSize(NULL, INITIAL_BUFFER_SIZE);
+    result = PyBytes_FromStringAndSize(NULL, bufsize);
     if (result == NULL)
         return NULL;
-    c->lzs.next_in = data;
-    c->lzs.avail_in = len;
-    c->lzs.next_out = (uint8_t *)PyBytes_AS_STRING(result);
-    c->lzs.avail_out = PyBytes_GET_SIZE(result);
+    lzs->next_in = data;
+    lzs->avail_in = len;
+    lzs->next_out = (uint8_t *)PyBytes_AS_STRING(result);
+    lzs->avail_out = PyBytes_GET_SIZE(result);
     for (;;) {
         lzma_ret lzret;
 
         Py_BEGIN_ALLOW_THREADS
-        lzret = lzma_code(&c->lzs, action);
-        data_size = (char *)c->lzs.next_out - PyBytes_AS_STRING(result);
+        lzret = lzma_code(lzs, action);
+        data_size = (char *)lzs->next_out - PyBytes_AS_STRING(result);
         Py_END_ALLOW_THREADS
         if (catch_lzma_error(lzret))
             goto error;
-        if ((action == LZMA_RUN && c->lzs.avail_in == 0) ||
-            (action == LZMA_FINISH && lzret == LZMA_STREAM_END)) {
+        if ((action == LZMA_RUN && lzs->avail_in == 0) ||
+            (action != LZMA_RUN && lzret == LZMA_STREAM_END)) {
             break;
-        } else if (c->lzs.avail_out == 0) {
-            if (grow_buffer(&result) == -1)
+        } else if (lzs->avail_out == 0) {
+            if (grow_buffer(&result, -1) == -1)
                 goto error;
-            c->lzs.next_out = (uint8_t *)PyBytes_AS_STRING(result) + data_size;
-            c->lzs.avail_out = PyBytes_GET_SIZE(result) - data_size;
+            lzs->next_out = (uint8_t *)PyBytes_AS_STRING(result) + data_size;
+            lzs->avail_out = PyBytes_GET_SIZE(result) - data_size;
         }
     }
-    if (data_size != PyBytes_GET_SIZE(result))
+    if ((Py_ssize_t)data_size != PyBytes_GET_SIZE(result))
         if (_PyBytes_Resize(&result, data_size) == -1)
             goto error;
     return result;
@@ -641,6 +1003,12 @@ error:
     return NULL;
 }
 
+static PyObject *
+compress(Compressor *c, uint8_t *data, size_t len, lzma_action action)
+{
+    return encode(&c->lzs, data, len, action, INITIAL_BUFFER_SIZE);
+}
+
 PyDoc_STRVAR(Compressor_compress_doc,
 "compress(data) -> bytes\n"
 "\n"
@@ -676,24 +1044,84 @@ Compressor_compress(Compressor *self, PyObject *args)
 }
 
 PyDoc_STRVAR(Compressor_flush_doc,
-"flush() -> bytes\n"
+"flush(mode=FLUSH_FINISH) -> bytes\n"
+"\n"
+"Flush the compressor. Returns the compressed data left in internal\n"
+"buffers.\n"
+"\n"
+"With the default mode of FLUSH_FINISH, this finishes the compression\n"
+"process, and the compressor object cannot be used afterwards, unless\n"
+"it is reset(). With the other modes, the compressor carries on with\n"
+"the same stream:\n"
 "\n"
-"Finish the compression process. Returns the compressed data left\n"
-"in internal buffers.\n"
+"    FLUSH_SYNC:  make all the data passed to compress() so far\n"
+"                 decodable from the output, keeping the dictionary, so\n"
+"                 later data compresses almost as well as without the\n"
+"                 flush. Supported by FORMAT_XZ (except with the\n"
+"                 multithreaded encoder) and FORMAT_RAW.\n"
+"    FLUSH_FULL:  as FLUSH_SYNC, but also end the current .xz block and\n"
+"                 reset the encoder, so that later data can be decoded\n"
+"                 independently.\n"
+"    FLUSH_BLOCK: end the current .xz block like FLUSH_FULL, but the\n"
+"                 multithreaded encoder may hold back its output until\n"
+"                 later, instead of waiting for it.\n"
 "\n"
-"The compressor object cannot be used after this method is called.\n");
+"FLUSH_SYNC also needs a filter chain made only of FILTER_LZMA2 and\n"
+"FILTER_DELTA; the BCJ filters and FILTER_LZMA1 cannot be flushed this\n"
+"way. FLUSH_FULL and FLUSH_BLOCK are only supported by FORMAT_XZ. Each\n"
+"flush adds a few bytes of overhead to the output. An unsupported mode\n"
+"raises ValueError, and leaves the compressor usable.\n");
+
+/* Return whether the encoder set up for self supports action. */
+static int
+flush_supported(Compressor *self, lzma_action action)
+{
+    if (action == LZMA_FINISH)
+        return 1;
+    if (action == LZMA_SYNC_FLUSH && !self->sync_flushable)
+        return 0;
+#ifndef HAVE_MT_ENCODER
+    if (action == FLUSH_BLOCK)
+        return 0;
+#endif
+    switch (self->format) {
+        case FORMAT_XZ:
+            /* The multithreaded encoder can only flush at the end of a
+               block. */
+            return action != LZMA_SYNC_FLUSH || !self->multithreaded;
+        case FORMAT_RAW:
+            return action == LZMA_SYNC_FLUSH;
+        default:
+            return 0;
+    }
+}
 
 static PyObject *
-Compressor_flush(Compressor *self, PyObject *noargs)
+Compressor_flush(Compressor *self, PyObject *args, PyObject *kwargs)
 {
+    static char *arg_names[] = {"mode", NULL};
+    int mode = FLUSH_FINISH;
     PyObject *result = NULL;
 
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|i:flush", arg_names,
+                                     &mode))
+        return NULL;
+    if (mode != FLUSH_SYNC && mode != FLUSH_FULL && mode != FLUSH_BLOCK &&
+        mode != FLUSH_FINISH) {
+        PyErr_Format(PyExc_ValueError, "Invalid flush mode: %d", mode);
+        return NULL;
+    }
+
     ACQUIRE_LOCK(self);
     if (self->flushed) {
         PyErr_SetString(PyExc_ValueError, "Repeated call to flush()");
+    } else if (!flush_supported(self, (lzma_action)mode)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Flush mode not supported by this compressor");
     } else {
-        self->flushed = 1;
-        result = compress(self, NULL, 0, LZMA_FINISH);
+        if (mode == FLUSH_FINISH)
+            self->flushed = 1;
+        result = compress(self, NULL, 0, (lzma_action)mode);
     }
     RELEASE_LOCK(self);
     return result;
@@ -701,11 +1129,35 @@ Compressor_flush(Compressor *self, PyObject *noargs)
 
 static int
 Compressor_init_xz(lzma_stream *lzs, int check, uint32_t preset,
-                   PyObject *filterspecs)
+                   PyObject *filterspecs, int threads, uint64_t block_size)
 {
     lzma_ret lzret;
 
-    if (filterspecs == Py_None) {
+    if (threads != 1 || block_size != 0) {
+#ifdef HAVE_MT_ENCODER
+        lzma_mt mt;
+        lzma_filter filters[LZMA_FILTERS_MAX + 1];
+
+        memset(&mt, 0, sizeof mt);
+        mt.threads = threads;
+        mt.block_size = block_size;
+        mt.check = check;
+        if (filterspecs == Py_None) {
+            mt.preset = preset;
+        } else {
+            if (parse_filter_chain_spec(filters, filterspecs) == -1)
+                return -1;
+            mt.filters = filters;
+        }
+        lzret = lzma_stream_encoder_mt(lzs, &mt);
+        if (filterspecs != Py_None)
+            free_filter_chain(filters);
+#else
+        PyErr_SetString(Error, "Multithreaded compression and block_size "
+                               "require liblzma 5.2.0 or later");
+        return -1;
+#endif
+    } else if (filterspecs == Py_None) {
         lzret = lzma_easy_encoder(lzs, preset, check);
     } else {
         lzma_filter filters[LZMA_FILTERS_MAX + 1];
@@ -777,21 +1229,12 @@ Compressor_init_raw(lzma_stream *lzs, PyObject *filterspecs)
         return 0;
 }
 
+/* Validate the compressor settings and initialize the encoder lzs. */
 static int
-Compressor_init(Compressor *self, PyObject *args, PyObject *kwargs)
+init_encoder(lzma_stream *lzs, int format, int check, PyObject *preset_obj,
+             PyObject *filterspecs, int threads, uint64_t block_size)
 {
-    static char *arg_names[] = {"format", "check", "preset", "filters", NULL};
-    int format = FORMAT_XZ;
-    int check = -1;
     uint32_t preset = LZMA_PRESET_DEFAULT;
-    PyObject *preset_obj = Py_None;
-    PyObject *filterspecs = Py_None;
-
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
-                                     "|iiOO:LZMACompressor", arg_names,
-                                     &format, &check, &preset_obj,
-                                     &filterspecs))
-        return -1;
 
     if (format != FORMAT_XZ && check != -1 && check != LZMA_CHECK_NONE) {
         PyErr_SetString(PyExc_ValueError,
@@ -809,68 +1252,200 @@ Compressor_init(Compressor *self, PyObject *args, PyObject *kwargs)
         if (!uint32_converter(preset_obj, &preset))
             return -1;
 
-#ifdef WITH_THREAD
-    self->lock = PyThread_allocate_lock();
-    if (self->lock == NULL) {
-        PyErr_SetString(PyExc_MemoryError, "Unable to allocate lock");
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Number of threads must not be negative");
+        return -1;
+    }
+    if (format != FORMAT_XZ && threads != 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Multithreaded compression is only supported "
+                        "by FORMAT_XZ");
         return -1;
     }
+    if (format != FORMAT_XZ && block_size != 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "block_size is only supported by FORMAT_XZ");
+        return -1;
+    }
+#ifdef HAVE_MT_ENCODER
+    /* threads=0 means one thread per available CPU core. lzma_cputhreads()
+       returns 0 if the number of cores cannot be determined. */
+    if (threads == 0) {
+        threads = (int)lzma_cputhreads();
+        if (threads == 0)
+            threads = 1;
+    }
 #endif
 
-    self->flushed = 0;
     switch (format) {
         case FORMAT_XZ:
             if (check == -1)
                 check = LZMA_CHECK_CRC64;
-            if (Compressor_init_xz(&self->lzs, check, preset, filterspecs) != 0)
-                break;
-            return 0;
+            return Compressor_init_xz(lzs, check, preset, filterspecs,
+                                      threads, block_size);
 
         case FORMAT_ALONE:
-            if (Compressor_init_alone(&self->lzs, preset, filterspecs) != 0)
-                break;
-            return 0;
+            return Compressor_init_alone(lzs, preset, filterspecs);
 
         case FORMAT_RAW:
-            if (Compressor_init_raw(&self->lzs, filterspecs) != 0)
-                break;
-            return 0;
+            return Compressor_init_raw(lzs, filterspecs);
 
         default:
             PyErr_Format(PyExc_ValueError,
                          "Invalid container format: %d", format);
-            break;
+            return -1;
     }
-
-#ifdef WITH_THREAD
-    PyThread_free_lock(self->lock);
-    self->lock = NULL;
-#endif
-    return -1;
 }
 
-static void
-Compressor_dealloc(Compressor *self)
+/* Return whether init_encoder() sets up the multithreaded .xz encoder for
+   these settings. */
+static int
+uses_mt_encoder(int format, int threads, uint64_t block_size)
 {
-    lzma_end(&self->lzs);
-#ifdef WITH_THREAD
-    if (self->lock != NULL)
-        PyThread_free_lock(self->lock);
+#ifdef HAVE_MT_ENCODER
+    if (threads == 0)
+        threads = (int)lzma_cputhreads();
+    return format == FORMAT_XZ &&
+           (threads > 1 || block_size != 0);
+#else
+    return 0;
 #endif
-    Py_TYPE(self)->tp_free((PyObject *)self);
 }
 
-static PyMethodDef Compressor_methods[] = {
-    {"compress", (PyCFunction)Compressor_compress, METH_VARARGS,
-     Compressor_compress_doc},
-    {"flush", (PyCFunction)Compressor_flush, METH_NOARGS,
-     Compressor_flush_doc},
-    {NULL}
-};
+/* Return whether every filter in filterspecs (None meaning the default
+   LZMA2 chain) supports LZMA_SYNC_FLUSH, or -1 on error. The BCJ filters
+   and LZMA1 do not: liblzma fails the flush, leaving the encoder unusable. */
+static int
+supports_sync_flush(PyObject *filterspecs)
+{
+    lzma_filter filters[LZMA_FILTERS_MAX + 1];
+    int i, result = 1;
 
-PyDoc_STRVAR(Compressor_doc,
-"LZMACompressor(format=FORMAT_XZ, check=-1, preset=None, filters=None)\n"
-"\n"
+    if (filterspecs == Py_None)
+        return 1;
+    if (parse_filter_chain_spec(filters, filterspecs) == -1)
+        return -1;
+    for (i = 0; filters[i].id != LZMA_VLI_UNKNOWN; i++) {
+        if (filters[i].id != LZMA_FILTER_LZMA2 &&
+            filters[i].id != LZMA_FILTER_DELTA)
+            result = 0;
+    }
+    free_filter_chain(filters);
+    return result;
+}
+
+static int
+Compressor_init(Compressor *self, PyObject *args, PyObject *kwargs)
+{
+    static char *arg_names[] = {"format", "check", "preset", "filters",
+                                "threads", "block_size", NULL};
+    int format = FORMAT_XZ;
+    int check = -1;
+    PyObject *preset_obj = Py_None;
+    PyObject *filterspecs = Py_None;
+    int threads = 1;
+    uint64_t block_size = 0;
+    int sync_flushable;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "|iiOOiO&:LZMACompressor", arg_names,
+                                     &format, &check, &preset_obj,
+                                     &filterspecs, &threads,
+                                     lzma_vli_converter, &block_size))
+        return -1;
+
+#ifdef WITH_THREAD
+    self->lock = PyThread_allocate_lock();
+    if (self->lock == NULL) {
+        PyErr_SetString(PyExc_MemoryError, "Unable to allocate lock");
+        return -1;
+    }
+#endif
+
+    self->flushed = 0;
+    if (init_encoder(&self->lzs, format, check, preset_obj, filterspecs,
+                     threads, block_size) == 0) {
+        /* The filter chain has been validated by init_encoder(). */
+        sync_flushable = supports_sync_flush(filterspecs);
+        if (sync_flushable == -1) {
+            lzma_end(&self->lzs);
+            goto error;
+        }
+        self->format = format;
+        self->check = check;
+        Py_INCREF(preset_obj);
+        self->preset_obj = preset_obj;
+        Py_INCREF(filterspecs);
+        self->filterspecs = filterspecs;
+        self->threads = threads;
+        self->block_size = block_size;
+        self->multithreaded = uses_mt_encoder(format, threads, block_size);
+        self->sync_flushable = (char)sync_flushable;
+        return 0;
+    }
+
+error:
+#ifdef WITH_THREAD
+    PyThread_free_lock(self->lock);
+    self->lock = NULL;
+#endif
+    return -1;
+}
+
+PyDoc_STRVAR(Compressor_reset_doc,
+"reset()\n"
+"\n"
+"Reset the compressor object, so that it can be used to compress a new\n"
+"stream with the same settings. Any data not yet flushed is discarded.\n"
+"\n"
+"This is faster than creating a new compressor, as the memory allocated\n"
+"by liblzma for the previous stream is reused where possible.\n");
+
+static PyObject *
+Compressor_reset(Compressor *self, PyObject *noargs)
+{
+    int ret;
+
+    ACQUIRE_LOCK(self);
+    ret = init_encoder(&self->lzs, self->format, self->check,
+                       self->preset_obj, self->filterspecs,
+                       self->threads, self->block_size);
+    /* liblzma frees the stream if reinitializing it fails. */
+    self->flushed = (ret == -1);
+    RELEASE_LOCK(self);
+    if (ret == -1)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static void
+Compressor_dealloc(Compressor *self)
+{
+    lzma_end(&self->lzs);
+    Py_XDECREF(self->preset_obj);
+    Py_XDECREF(self->filterspecs);
+#ifdef WITH_THREAD
+    if (self->lock != NULL)
+        PyThread_free_lock(self->lock);
+#endif
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyMethodDef Compressor_methods[] = {
+    {"compress", (PyCFunction)Compressor_compress, METH_VARARGS,
+     Compressor_compress_doc},
+    {"flush", (PyCFunction)Compressor_flush, METH_VARARGS | METH_KEYWORDS,
+     Compressor_flush_doc},
+    {"reset", (PyCFunction)Compressor_reset, METH_NOARGS,
+     Compressor_reset_doc},
+    {NULL}
+};
+
+PyDoc_STRVAR(Compressor_doc,
+"LZMACompressor(format=FORMAT_XZ, check=-1, preset=None, filters=None,\n"
+"               threads=1, block_size=0)\n"
+"\n"
 "Create a compressor object for compressing data incrementally.\n"
 "\n"
 "format specifies the container format to use for the output. This can\n"
@@ -892,7 +1467,23 @@ PyDoc_STRVAR(Compressor_doc,
 "\n"
 "filters (if provided) should be a sequence of dicts. Each dict should\n"
 "have an entry for \"id\" indicating the ID of the filter, plus\n"
-"additional entries for options to the filter.\n"
+"additional entries for options to the filter. A FilterChain object\n"
+"can be given instead, to avoid parsing the dicts every time.\n"
+"\n"
+"threads specifies the number of worker threads to use. This is only\n"
+"supported by FORMAT_XZ. The default of 1 uses the single-threaded\n"
+"encoder, and 0 means one thread per available CPU core. The\n"
+"multithreaded encoder splits its input into independent blocks of\n"
+"block_size uncompressed bytes each, which are compressed in parallel.\n"
+"If block_size is 0 (the default), liblzma picks a size based on the\n"
+"compression settings.\n"
+"\n"
+"Giving a block_size with threads=1 also splits the output into blocks,\n"
+"compressed one at a time by a single worker thread. As with more\n"
+"threads, each block header records the block's sizes, so the result\n"
+"can be decompressed in parallel, and LZMAFile can seek in it by reading\n"
+"only the blocks it needs. A threads value other than 1 and a non-zero\n"
+"block_size both require liblzma 5.2.0 or later.\n"
 "\n"
 "For one-shot compression, use the compress() function instead.\n");
 
@@ -940,49 +1531,231 @@ static PyTypeObject Compressor_type = {
 
 /* LZMADecompressor class. */
 
+static const uint32_t decoder_flags =
+        LZMA_TELL_ANY_CHECK | LZMA_TELL_NO_CHECK;
+
+static lzma_ret
+init_xz_decoder(lzma_stream *lzs, uint64_t memlimit, int threads)
+{
+#ifdef HAVE_MT_DECODER
+    if (threads != 1) {
+        lzma_mt mt;
+
+        memset(&mt, 0, sizeof mt);
+        mt.flags = decoder_flags;
+        mt.threads = threads;
+        mt.memlimit_stop = memlimit;
+        /* If decoding in parallel would need more memory than this, liblzma
+           falls back to single-threaded decoding instead of failing. */
+        if (memlimit == UINT64_MAX && lzma_physmem() != 0)
+            mt.memlimit_threading = lzma_physmem() / 4;
+        else
+            mt.memlimit_threading = memlimit;
+        return lzma_stream_decoder_mt(lzs, &mt);
+    }
+#endif
+    return lzma_stream_decoder(lzs, memlimit, decoder_flags);
+}
+
+/* Finish initializing a FORMAT_AUTO decompressor once the first byte of
+   input is known, mirroring the detection done by lzma_auto_decoder(). */
+static int
+deferred_init(Decompressor *d, uint8_t first_byte)
+{
+    lzma_ret lzret;
+
+    if (first_byte == 0xFD) {
+        lzret = init_xz_decoder(&d->lzs, d->memlimit, d->threads);
+    } else {
+        d->check = LZMA_CHECK_NONE;
+        lzret = lzma_alone_decoder(&d->lzs, d->memlimit);
+    }
+    if (catch_lzma_error(lzret))
+        return -1;
+    d->deferred_init = 0;
+    return 0;
+}
+
+static int Decompressor_init_coder(Decompressor *self);
+
+/* Give up on returning a stream's input in unused_data once this much of
+   it has been consumed without producing any output. */
+#define MAX_STREAM_HEAD ((size_t)1 << 16)
+
+static void
+forget_stream_head(Decompressor *d)
+{
+    d->in_new_stream = 0;
+    if (d->stream_head != NULL) {
+        PyMem_Free(d->stream_head);
+        d->stream_head = NULL;
+    }
+    d->stream_head_size = 0;
+}
+
+/* Called when the end of a stream is reached. In concatenated mode, if
+   there is more input, the decoder is set up for the next stream in place,
+   without copying the input. Returns 1 if decoding should carry on with
+   the next stream, 0 if the end of the data was reached, or -1 on error. */
+static int
+end_of_stream(Decompressor *d)
+{
+    lzma_stream *lzs = &d->lzs;
+
+    forget_stream_head(d);
+    if (!d->concatenated || lzs->avail_in == 0) {
+        d->eof = 1;
+        return 0;
+    }
+    if (Decompressor_init_coder(d) == -1)
+        return -1;
+    if (d->deferred_init && deferred_init(d, lzs->next_in[0]) == -1)
+        return -1;
+    d->in_new_stream = 1;
+    return 1;
+}
+
+/* Check the result of decoding (part of) a stream following another one,
+   given where its input and output were before the call to lzma_code(). If
+   lzret is an error, the data is taken not to be a valid stream: any output
+   the call produced is dropped (by moving next_out back to out_before), all
+   the input from its start is saved in unused_data, and 1 is returned.
+   Returns 0 to carry on decoding, or -1 on error. */
+static int
+check_new_stream(Decompressor *d, lzma_ret lzret, const uint8_t *in_before,
+                 const uint8_t *out_before)
+{
+    lzma_stream *lzs = &d->lzs;
+
+    if (lzret == LZMA_OK || lzret == LZMA_GET_CHECK ||
+        lzret == LZMA_NO_CHECK) {
+        size_t consumed = lzs->next_in - in_before;
+        size_t new_size = d->stream_head_size + consumed;
+        uint8_t *tmp;
+
+        if (lzs->next_out != out_before || new_size > MAX_STREAM_HEAD) {
+            forget_stream_head(d);
+            return 0;
+        }
+        if (consumed == 0)
+            return 0;
+        tmp = (uint8_t *)PyMem_Realloc(d->stream_head, new_size);
+        if (tmp == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        memcpy(tmp + d->stream_head_size, in_before, consumed);
+        d->stream_head = tmp;
+        d->stream_head_size = new_size;
+        return 0;
+    } else if (lzret == LZMA_STREAM_END || lzret == LZMA_MEM_ERROR ||
+               lzret == LZMA_BUF_ERROR || lzret == LZMA_PROG_ERROR) {
+        /* Not a problem with the input data itself. */
+        return 0;
+    } else {
+        /* Input from in_before on is still available, whatever liblzma
+           consumed before failing. */
+        size_t rest = lzs->next_in + lzs->avail_in - in_before;
+        PyObject *unused;
+
+        unused = PyBytes_FromStringAndSize(NULL, d->stream_head_size + rest);
+        if (unused == NULL)
+            return -1;
+        if (d->stream_head_size > 0)
+            memcpy(PyBytes_AS_STRING(unused), d->stream_head,
+                   d->stream_head_size);
+        memcpy(PyBytes_AS_STRING(unused) + d->stream_head_size, in_before,
+               rest);
+        Py_CLEAR(d->unused_data);
+        d->unused_data = unused;
+        forget_stream_head(d);
+        lzs->next_in += lzs->avail_in;
+        lzs->avail_in = 0;
+        lzs->avail_out += lzs->next_out - out_before;
+        lzs->next_out = (uint8_t *)out_before;
+        d->eof = 1;
+        return 1;
+    }
+}
+
 static PyObject *
-decompress(Decompressor *d, uint8_t *data, size_t len)
+decompress_buf(Decompressor *d, Py_ssize_t max_length, Py_ssize_t bufsize)
 {
-    size_t data_size = 0;
+    Py_ssize_t data_size = 0;
     PyObject *result;
+    lzma_stream *lzs = &d->lzs;
 
-    result = PyBytes_FromStringAndSize(NULL, INITIAL_BUFFER_SIZE);
+    if (d->deferred_init && lzs->avail_in > 0)
+        if (deferred_init(d, lzs->next_in[0]) == -1)
+            return NULL;
+    if (d->deferred_init)
+        return PyBytes_FromStringAndSize(NULL, 0);
+
+    /* If the caller knows how much output to expect, allocate one byte
+       more than that. The spare byte stops the output buffer from filling
+       up, so that liblzma carries on to the end of the stream without us
+       having to grow the buffer first. */
+    if (bufsize <= 0 || bufsize >= PY_SSIZE_T_MAX)
+        bufsize = INITIAL_BUFFER_SIZE;
+    else
+        bufsize++;
+    if (max_length >= 0 && max_length < bufsize)
+        bufsize = max_length;
+    result = PyBytes_FromStringAndSize(NULL, bufsize);
+    if (result == NULL && bufsize > INITIAL_BUFFER_SIZE &&
+        PyErr_ExceptionMatches(PyExc_MemoryError)) {
+        /* bufsize is only a hint; start small and grow the buffer. */
+        PyErr_Clear();
+        result = PyBytes_FromStringAndSize(NULL, INITIAL_BUFFER_SIZE);
+    }
     if (result == NULL)
         return NULL;
-    d->lzs.next_in = data;
-    d->lzs.avail_in = len;
-    d->lzs.next_out = (uint8_t *)PyBytes_AS_STRING(result);
-    d->lzs.avail_out = PyBytes_GET_SIZE(result);
+
+    lzs->next_out = (uint8_t *)PyBytes_AS_STRING(result);
+    lzs->avail_out = PyBytes_GET_SIZE(result);
+
     for (;;) {
         lzma_ret lzret;
+        const uint8_t *in_before = lzs->next_in;
+        const uint8_t *out_before = lzs->next_out;
+        int ret;
 
         Py_BEGIN_ALLOW_THREADS
-        lzret = lzma_code(&d->lzs, LZMA_RUN);
-        data_size = (char *)d->lzs.next_out - PyBytes_AS_STRING(result);
+        lzret = lzma_code(lzs, LZMA_RUN);
+        data_size = (char *)lzs->next_out - PyBytes_AS_STRING(result);
         Py_END_ALLOW_THREADS
+        if (d->in_new_stream) {
+            ret = check_new_stream(d, lzret, in_before, out_before);
+            if (ret == -1)
+                goto error;
+            if (ret == 1) {
+                data_size = (char *)lzs->next_out - PyBytes_AS_STRING(result);
+                break;
+            }
+        }
         if (catch_lzma_error(lzret))
             goto error;
         if (lzret == LZMA_GET_CHECK || lzret == LZMA_NO_CHECK)
-            d->check = lzma_get_check(&d->lzs);
+            d->check = lzma_get_check(lzs);
         if (lzret == LZMA_STREAM_END) {
-            d->eof = 1;
-            if (d->lzs.avail_in > 0) {
-                Py_CLEAR(d->unused_data);
-                d->unused_data = PyBytes_FromStringAndSize(
-                        (char *)d->lzs.next_in, d->lzs.avail_in);
-                if (d->unused_data == NULL)
-                    goto error;
-            }
-            break;
-        } else if (d->lzs.avail_out == 0) {
-            /* Need to check d->lzs.avail_out before d->lzs.avail_in.
-               Maybe d->lzs's internal state still have a few bytes
-               can be output, grow the output buffer and continue. */
-            if (grow_buffer(&result) == -1)
+            ret = end_of_stream(d);
+            if (ret == -1)
+                goto error;
+            if (ret == 0)
+                break;
+        }
+        if (lzs->avail_out == 0) {
+            /* Need to check lzs->avail_out before lzs->avail_in.
+               Maybe lzs's internal state still have a few bytes
+               can be output, grow the output buffer and continue
+               if max_length < 0. */
+            if (data_size == max_length)
+                break;
+            if (grow_buffer(&result, max_length) == -1)
                 goto error;
-            d->lzs.next_out = (uint8_t *)PyBytes_AS_STRING(result) + data_size;
-            d->lzs.avail_out = PyBytes_GET_SIZE(result) - data_size;
-        } else if (d->lzs.avail_in == 0) {
+            lzs->next_out = (uint8_t *)PyBytes_AS_STRING(result) + data_size;
+            lzs->avail_out = PyBytes_GET_SIZE(result) - data_size;
+        } else if (lzs->avail_in == 0) {
             break;
         }
     }
@@ -996,41 +1769,361 @@ error:
     return NULL;
 }
 
+/* Decompress into the caller's buffer out, writing at most out_len bytes.
+   Returns the number of bytes written, or -1 on error. */
+static Py_ssize_t
+decompress_into_buf(Decompressor *d, uint8_t *out, size_t out_len)
+{
+    Py_ssize_t data_size = 0;
+    lzma_stream *lzs = &d->lzs;
+
+    if (d->deferred_init && lzs->avail_in > 0)
+        if (deferred_init(d, lzs->next_in[0]) == -1)
+            return -1;
+    if (d->deferred_init)
+        return 0;
+
+    lzs->next_out = out;
+    lzs->avail_out = out_len;
+
+    for (;;) {
+        lzma_ret lzret;
+        const uint8_t *in_before = lzs->next_in;
+        const uint8_t *out_before = lzs->next_out;
+        int ret;
+
+        Py_BEGIN_ALLOW_THREADS
+        lzret = lzma_code(lzs, LZMA_RUN);
+        data_size = lzs->next_out - out;
+        Py_END_ALLOW_THREADS
+        if (d->in_new_stream) {
+            ret = check_new_stream(d, lzret, in_before, out_before);
+            if (ret == -1)
+                return -1;
+            if (ret == 1) {
+                data_size = lzs->next_out - out;
+                break;
+            }
+        }
+        if (catch_lzma_error(lzret))
+            return -1;
+        if (lzret == LZMA_GET_CHECK || lzret == LZMA_NO_CHECK)
+            d->check = lzma_get_check(lzs);
+        if (lzret == LZMA_STREAM_END) {
+            ret = end_of_stream(d);
+            if (ret == -1)
+                return -1;
+            if (ret == 0)
+                break;
+        }
+        if (lzs->avail_out == 0 || lzs->avail_in == 0) {
+            break;
+        }
+    }
+    return data_size;
+}
+
+/* In concatenated mode, eof is also set at the end of a stream that used
+   up all the input so far, as more data might start another stream. */
+static int
+at_stream_boundary(Decompressor *d)
+{
+    return d->concatenated && d->eof &&
+           PyBytes_GET_SIZE(d->unused_data) == 0;
+}
+
+/* Append new input to any unconsumed input left over from the previous
+   call, and point the lzma_stream at it. Returns 1 if the input buffer is
+   in use, 0 if the stream reads directly from data, or -1 on error. */
+static int
+prepare_input(Decompressor *d, uint8_t *data, size_t len)
+{
+    lzma_stream *lzs = &d->lzs;
+
+    /* Prepend unconsumed input if necessary. */
+    if (lzs->next_in != NULL) {
+        size_t avail_now, avail_total;
+
+        /* Number of bytes we can append to input buffer. */
+        avail_now = (d->input_buffer + d->input_buffer_size)
+            - (lzs->next_in + lzs->avail_in);
+
+        /* Number of bytes we can append if we move existing
+           contents to beginning of buffer (overwriting
+           consumed input). */
+        avail_total = d->input_buffer_size - lzs->avail_in;
+
+        if (avail_total < len) {
+            size_t offset = lzs->next_in - d->input_buffer;
+            uint8_t *tmp;
+            size_t new_size = d->input_buffer_size + len - avail_now;
+
+            /* Assign to temporary variable first, so we don't
+               lose address of allocated buffer if realloc fails. */
+            tmp = (uint8_t *)PyMem_Realloc(d->input_buffer, new_size);
+            if (tmp == NULL) {
+                PyErr_NoMemory();
+                return -1;
+            }
+            d->input_buffer = tmp;
+            d->input_buffer_size = new_size;
+
+            lzs->next_in = d->input_buffer + offset;
+        } else if (avail_now < len) {
+            memmove(d->input_buffer, lzs->next_in, lzs->avail_in);
+            lzs->next_in = d->input_buffer;
+        }
+        memcpy((void *)(lzs->next_in + lzs->avail_in), data, len);
+        lzs->avail_in += len;
+        return 1;
+    } else {
+        lzs->next_in = data;
+        lzs->avail_in = len;
+        return 0;
+    }
+}
+
+/* Update needs_input and unused_data after decompressing, and keep a copy
+   of any input that the decompressor did not consume. */
+static int
+save_input(Decompressor *d, int input_buffer_in_use)
+{
+    lzma_stream *lzs = &d->lzs;
+
+    if (d->eof) {
+        d->needs_input = 0;
+        if (lzs->avail_in > 0) {
+            Py_CLEAR(d->unused_data);
+            d->unused_data = PyBytes_FromStringAndSize(
+                    (char *)lzs->next_in, lzs->avail_in);
+            if (d->unused_data == NULL)
+                return -1;
+        } else if (at_stream_boundary(d)) {
+            /* Another stream may follow. */
+            lzs->next_in = NULL;
+            d->needs_input = 1;
+        }
+    } else if (lzs->avail_in == 0) {
+        /* There is no unconsumed input data. */
+        lzs->next_in = NULL;
+        /* If the output buffer filled up, liblzma may still hold some
+           output, so the caller must call again before giving more input
+           (bpo-21872). */
+        d->needs_input = lzs->avail_out > 0 || d->deferred_init;
+    } else {
+        /* The decompressor did not consume all input data. */
+        d->needs_input = 0;
+
+        /* If we were using the input buffer, we are done. Otherwise, copy
+           unconsumed input data to the input buffer. */
+        if (!input_buffer_in_use) {
+
+            /* Discard buffer if it's too small
+               (resizing it may needlessly copy the current contents). */
+            if (d->input_buffer != NULL &&
+                d->input_buffer_size < lzs->avail_in) {
+                PyMem_Free(d->input_buffer);
+                d->input_buffer = NULL;
+            }
+
+            /* Allocate if necessary. */
+            if (d->input_buffer == NULL) {
+                d->input_buffer = (uint8_t *)PyMem_Malloc(lzs->avail_in);
+                if (d->input_buffer == NULL) {
+                    PyErr_NoMemory();
+                    return -1;
+                }
+                d->input_buffer_size = lzs->avail_in;
+            }
+
+            /* Copy unconsumed data. */
+            memcpy(d->input_buffer, lzs->next_in, lzs->avail_in);
+            lzs->next_in = d->input_buffer;
+        }
+    }
+    return 0;
+}
+
+static PyObject *
+decompress(Decompressor *d, uint8_t *data, size_t len, Py_ssize_t max_length,
+           Py_ssize_t bufsize)
+{
+    int input_buffer_in_use;
+    PyObject *result;
+
+    input_buffer_in_use = prepare_input(d, data, len);
+    if (input_buffer_in_use == -1)
+        return NULL;
+    if (d->eof) {
+        /* At a stream boundary; any new input starts the next stream. */
+        if (len == 0) {
+            d->lzs.next_in = NULL;
+            return PyBytes_FromStringAndSize(NULL, 0);
+        }
+        d->eof = 0;
+        if (end_of_stream(d) == -1) {
+            d->lzs.next_in = NULL;
+            return NULL;
+        }
+    }
+
+    result = decompress_buf(d, max_length, bufsize);
+    if (result == NULL) {
+        d->lzs.next_in = NULL;
+        return NULL;
+    }
+
+    if (save_input(d, input_buffer_in_use) == -1) {
+        Py_DECREF(result);
+        return NULL;
+    }
+    return result;
+}
+
+static Py_ssize_t
+decompress_into(Decompressor *d, uint8_t *data, size_t len,
+                uint8_t *out, size_t out_len)
+{
+    int input_buffer_in_use;
+    Py_ssize_t result;
+
+    input_buffer_in_use = prepare_input(d, data, len);
+    if (input_buffer_in_use == -1)
+        return -1;
+    if (d->eof) {
+        /* At a stream boundary; any new input starts the next stream. */
+        if (len == 0) {
+            d->lzs.next_in = NULL;
+            return 0;
+        }
+        d->eof = 0;
+        if (end_of_stream(d) == -1) {
+            d->lzs.next_in = NULL;
+            return -1;
+        }
+    }
+
+    result = decompress_into_buf(d, out, out_len);
+    if (result == -1) {
+        d->lzs.next_in = NULL;
+        return -1;
+    }
+
+    if (save_input(d, input_buffer_in_use) == -1)
+        return -1;
+    return result;
+}
+
 PyDoc_STRVAR(Decompressor_decompress_doc,
-"decompress(data) -> bytes\n"
+"decompress(data, max_length=-1, bufsize=0) -> bytes\n"
 "\n"
 "Provide data to the decompressor object. Returns a chunk of\n"
 "decompressed data if possible, or b\"\" otherwise.\n"
 "\n"
+"If max_length is nonnegative, returns at most max_length bytes of\n"
+"decompressed data. If this limit is reached and further output can be\n"
+"produced, the needs_input attribute will be set to False. In this case,\n"
+"the next call to decompress() may provide data as b\"\" to obtain more\n"
+"of the output.\n"
+"\n"
+"If all of the input data was decompressed and returned (either because\n"
+"this was less than max_length bytes, or because max_length was\n"
+"negative), the needs_input attribute will be set to True.\n"
+"\n"
+"bufsize, if given, is the expected size of the output. It is used as\n"
+"the initial size of the output buffer, avoiding the need to grow it\n"
+"when the size of the decompressed data is known in advance. It is only\n"
+"a hint: if a buffer that large cannot be allocated, a small one is\n"
+"grown as usual.\n"
+"\n"
 "Attempting to decompress data after the end of the stream is\n"
 "reached raises an EOFError. Any data found after the end of the\n"
-"stream is ignored, and saved in the unused_data attribute.\n");
+"stream is ignored, and saved in the unused_data attribute. In\n"
+"concatenated mode, data following the end of a stream starts a new one\n"
+"instead.\n");
 
 static PyObject *
-Decompressor_decompress(Decompressor *self, PyObject *args)
+Decompressor_decompress(Decompressor *self, PyObject *args, PyObject *kwargs)
 {
+    static char *arg_names[] = {"data", "max_length", "bufsize", NULL};
     Py_buffer buffer;
+    Py_ssize_t max_length = -1;
+    Py_ssize_t bufsize = 0;
     PyObject *result = NULL;
 
-#if PY_MAJOR_VERSION >= 3  
+#if PY_MAJOR_VERSION >= 3
     /* Type code 'y' for bytes on Python 3 */
-    if (!PyArg_ParseTuple(args, "y*:decompress", &buffer))
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*|nn:decompress",
+                                     arg_names, &buffer, &max_length,
+                                     &bufsize))
 #else
     /* Type code 's' for string on Python 2 */
-    if (!PyArg_ParseTuple(args, "s*:decompress", &buffer))
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s*|nn:decompress",
+                                     arg_names, &buffer, &max_length,
+                                     &bufsize))
 #endif
         return NULL;
 
+    if (bufsize < 0) {
+        PyErr_SetString(PyExc_ValueError, "bufsize must be non-negative");
+        PyBuffer_Release(&buffer);
+        return NULL;
+    }
+
     ACQUIRE_LOCK(self);
-    if (self->eof)
+    if (self->eof && !at_stream_boundary(self))
         PyErr_SetString(PyExc_EOFError, "Already at end of stream");
     else
-        result = decompress(self, buffer.buf, buffer.len);
+        result = decompress(self, buffer.buf, buffer.len, max_length,
+                            bufsize);
     RELEASE_LOCK(self);
     PyBuffer_Release(&buffer);
     return result;
 }
 
+PyDoc_STRVAR(Decompressor_decompress_into_doc,
+"decompress_into(data, out_buffer) -> int\n"
+"\n"
+"Provide data to the decompressor object, writing decompressed data\n"
+"directly into out_buffer, which may be any writable object supporting\n"
+"the buffer protocol (such as a bytearray, memoryview or mmap). Returns\n"
+"the number of bytes written, which may be 0.\n"
+"\n"
+"At most len(out_buffer) bytes are written. The needs_input, eof and\n"
+"unused_data attributes are updated as for decompress() with a\n"
+"max_length of len(out_buffer).\n");
+
+static PyObject *
+Decompressor_decompress_into(Decompressor *self, PyObject *args,
+                             PyObject *kwargs)
+{
+    static char *arg_names[] = {"data", "out_buffer", NULL};
+    Py_buffer buffer, out;
+    Py_ssize_t result = -1;
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*w*:decompress_into",
+                                     arg_names, &buffer, &out))
+#else
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s*w*:decompress_into",
+                                     arg_names, &buffer, &out))
+#endif
+        return NULL;
+
+    ACQUIRE_LOCK(self);
+    if (self->eof && !at_stream_boundary(self))
+        PyErr_SetString(PyExc_EOFError, "Already at end of stream");
+    else
+        result = decompress_into(self, buffer.buf, buffer.len,
+                                 out.buf, out.len);
+    RELEASE_LOCK(self);
+    PyBuffer_Release(&buffer);
+    PyBuffer_Release(&out);
+    if (result == -1)
+        return NULL;
+    return Py_BuildValue("n", result);
+}
+
 static int
 Decompressor_init_raw(lzma_stream *lzs, PyObject *filterspecs)
 {
@@ -1047,226 +2140,988 @@ Decompressor_init_raw(lzma_stream *lzs, PyObject *filterspecs)
         return 0;
 }
 
+/* Set up the decoder for the settings stored in self. */
+static int
+Decompressor_init_coder(Decompressor *self)
+{
+    lzma_ret lzret;
+
+    self->check = LZMA_CHECK_UNKNOWN;
+    self->deferred_init = 0;
+    switch (self->format) {
+        case FORMAT_AUTO:
+            if (self->threads != 1) {
+                self->deferred_init = 1;
+                return 0;
+            }
+            lzret = lzma_auto_decoder(&self->lzs, self->memlimit,
+                                      decoder_flags);
+            return catch_lzma_error(lzret) ? -1 : 0;
+
+        case FORMAT_XZ:
+            lzret = init_xz_decoder(&self->lzs, self->memlimit,
+                                    self->threads);
+            return catch_lzma_error(lzret) ? -1 : 0;
+
+        case FORMAT_ALONE:
+            self->check = LZMA_CHECK_NONE;
+            lzret = lzma_alone_decoder(&self->lzs, self->memlimit);
+            return catch_lzma_error(lzret) ? -1 : 0;
+
+        case FORMAT_RAW:
+            self->check = LZMA_CHECK_NONE;
+            return Decompressor_init_raw(&self->lzs, self->filterspecs);
+
+        default:
+            PyErr_Format(PyExc_ValueError,
+                         "Invalid container format: %d", self->format);
+            return -1;
+    }
+}
+
+static int
+Decompressor_init(Decompressor *self, PyObject *args, PyObject *kwargs)
+{
+    static char *arg_names[] = {"format", "memlimit", "filters", "threads",
+                                "concatenated", NULL};
+    int format = FORMAT_AUTO;
+    uint64_t memlimit = UINT64_MAX;
+    PyObject *memlimit_obj = Py_None;
+    PyObject *filterspecs = Py_None;
+    int threads = 1;
+    int concatenated = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "|iOOii:LZMADecompressor", arg_names,
+                                     &format, &memlimit_obj, &filterspecs,
+                                     &threads, &concatenated))
+        return -1;
+
+    if (memlimit_obj != Py_None) {
+        if (format == FORMAT_RAW) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Cannot specify memory limit with FORMAT_RAW");
+            return -1;
+        }
+#if PY_MAJOR_VERSION >= 3
+        memlimit = PyLong_AsUnsignedLongLong(memlimit_obj);
+#else
+        if (PyInt_Check(memlimit_obj))
+            memlimit = (unsigned PY_LONG_LONG)PyInt_AsLong(memlimit_obj);
+        else if (PyLong_Check(memlimit_obj))
+            memlimit = PyLong_AsUnsignedLongLong(memlimit_obj);
+        else
+            return -1;
+#endif
+        if (PyErr_Occurred())
+            return -1;
+    }
+
+    if (format == FORMAT_RAW && filterspecs == Py_None) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Must specify filters for FORMAT_RAW");
+        return -1;
+    } else if (format != FORMAT_RAW && filterspecs != Py_None) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Cannot specify filters except with FORMAT_RAW");
+        return -1;
+    }
+
+    if (concatenated && format == FORMAT_RAW) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Cannot decode concatenated streams with FORMAT_RAW");
+        return -1;
+    }
+
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Number of threads must not be negative");
+        return -1;
+    }
+    if (threads != 1) {
+        if (format != FORMAT_AUTO && format != FORMAT_XZ) {
+            PyErr_SetString(PyExc_ValueError,
+                            "Multithreaded decompression is only supported "
+                            "by FORMAT_AUTO and FORMAT_XZ");
+            return -1;
+        }
+#ifdef HAVE_MT_DECODER
+        if (threads == 0) {
+            threads = (int)lzma_cputhreads();
+            if (threads == 0)
+                threads = 1;
+        }
+#else
+        PyErr_SetString(Error, "Multithreaded decompression requires "
+                               "liblzma 5.4.0 or later");
+        return -1;
+#endif
+    }
+
+#ifdef WITH_THREAD
+    self->lock = PyThread_allocate_lock();
+    if (self->lock == NULL) {
+        PyErr_SetString(PyExc_MemoryError, "Unable to allocate lock");
+        return -1;
+    }
+#endif
+
+    self->check = LZMA_CHECK_UNKNOWN;
+    self->needs_input = 1;
+    self->input_buffer = NULL;
+    self->input_buffer_size = 0;
+    self->deferred_init = 0;
+    self->concatenated = concatenated != 0;
+    self->in_new_stream = 0;
+    self->stream_head = NULL;
+    self->stream_head_size = 0;
+    self->threads = threads;
+    self->memlimit = memlimit;
+    self->unused_data = PyBytes_FromStringAndSize(NULL, 0);
+    if (self->unused_data == NULL)
+        goto error;
+
+    self->format = format;
+    Py_INCREF(filterspecs);
+    self->filterspecs = filterspecs;
+    if (Decompressor_init_coder(self) == 0)
+        return 0;
+
+error:
+    Py_CLEAR(self->unused_data);
+    Py_CLEAR(self->filterspecs);
+#ifdef WITH_THREAD
+    PyThread_free_lock(self->lock);
+    self->lock = NULL;
+#endif
+    return -1;
+}
+
+PyDoc_STRVAR(Decompressor_reset_doc,
+"reset()\n"
+"\n"
+"Reset the decompressor object, so that it can be used to decompress a\n"
+"new stream with the same settings. Any input not yet decompressed is\n"
+"discarded, and the eof, needs_input, check and unused_data attributes\n"
+"are reset to their initial values.\n"
+"\n"
+"This is faster than creating a new decompressor, as the memory\n"
+"allocated by liblzma for the previous stream is reused where possible.\n");
+
+static PyObject *
+Decompressor_reset(Decompressor *self, PyObject *noargs)
+{
+    PyObject *empty;
+    int ret;
+
+    empty = PyBytes_FromStringAndSize(NULL, 0);
+    if (empty == NULL)
+        return NULL;
+
+    ACQUIRE_LOCK(self);
+    Py_CLEAR(self->unused_data);
+    self->unused_data = empty;
+    self->eof = 0;
+    self->needs_input = 1;
+    self->lzs.next_in = NULL;
+    self->lzs.avail_in = 0;
+    forget_stream_head(self);
+    ret = Decompressor_init_coder(self);
+    RELEASE_LOCK(self);
+    if (ret == -1)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+static void
+Decompressor_dealloc(Decompressor *self)
+{
+    if (self->input_buffer != NULL)
+        PyMem_Free(self->input_buffer);
+    if (self->stream_head != NULL)
+        PyMem_Free(self->stream_head);
+    lzma_end(&self->lzs);
+    Py_CLEAR(self->unused_data);
+    Py_CLEAR(self->filterspecs);
+#ifdef WITH_THREAD
+    if (self->lock != NULL)
+        PyThread_free_lock(self->lock);
+#endif
+    Py_TYPE(self)->tp_free((PyObject *)self);
+}
+
+static PyMethodDef Decompressor_methods[] = {
+    {"decompress", (PyCFunction)Decompressor_decompress,
+     METH_VARARGS | METH_KEYWORDS, Decompressor_decompress_doc},
+    {"decompress_into", (PyCFunction)Decompressor_decompress_into,
+     METH_VARARGS | METH_KEYWORDS, Decompressor_decompress_into_doc},
+    {"reset", (PyCFunction)Decompressor_reset, METH_NOARGS,
+     Decompressor_reset_doc},
+    {NULL}
+};
+
+PyDoc_STRVAR(Decompressor_check_doc,
+"ID of the integrity check used by the input stream.");
+
+PyDoc_STRVAR(Decompressor_eof_doc,
+"True if the end-of-stream marker has been reached.");
+
+PyDoc_STRVAR(Decompressor_unused_data_doc,
+"Data found after the end of the compressed stream.");
+
+PyDoc_STRVAR(Decompressor_needs_input_doc,
+"True if more input is needed before more decompressed data can be produced.");
+
+static PyMemberDef Decompressor_members[] = {
+    {"check", T_INT, offsetof(Decompressor, check), READONLY,
+     Decompressor_check_doc},
+    {"eof", T_BOOL, offsetof(Decompressor, eof), READONLY,
+     Decompressor_eof_doc},
+    {"unused_data", T_OBJECT_EX, offsetof(Decompressor, unused_data), READONLY,
+     Decompressor_unused_data_doc},
+    {"needs_input", T_BOOL, offsetof(Decompressor, needs_input), READONLY,
+     Decompressor_needs_input_doc},
+    {NULL}
+};
+
+PyDoc_STRVAR(Decompressor_doc,
+"LZMADecompressor(format=FORMAT_AUTO, memlimit=None, filters=None,\n"
+"                 threads=1, concatenated=False)\n"
+"\n"
+"Create a decompressor object for decompressing data incrementally.\n"
+"\n"
+"format specifies the container format of the input stream. If this is\n"
+"FORMAT_AUTO (the default), the decompressor will automatically detect\n"
+"whether the input is FORMAT_XZ or FORMAT_ALONE. Streams created with\n"
+"FORMAT_RAW cannot be autodetected.\n"
+"\n"
+"memlimit can be specified to limit the amount of memory used by the\n"
+"decompressor. This will cause decompression to fail if the input\n"
+"cannot be decompressed within the given limit.\n"
+"\n"
+"filters specifies a custom filter chain. This argument is required for\n"
+"FORMAT_RAW, and not accepted with any other format. When provided,\n"
+"this should be a sequence of dicts, each indicating the ID and options\n"
+"for a single filter, or a FilterChain object.\n"
+"\n"
+"threads specifies the number of worker threads to use for .xz input;\n"
+"0 means one thread per available CPU core. Only blocks whose headers\n"
+"record their sizes (as written by the multithreaded encoder) can be\n"
+"decoded in parallel. This argument is supported by FORMAT_AUTO and\n"
+"FORMAT_XZ, and requires liblzma 5.4.0 or later.\n"
+"\n"
+"If concatenated is true, the input may consist of several streams one\n"
+"after the other, which are decoded in a single pass. eof is set at the\n"
+"end of each stream that uses up all the input given so far, and any\n"
+"further input starts a new stream. Data after the last stream that is\n"
+"not a valid stream ends decompression, and is saved in unused_data\n"
+"instead of raising an error, as long as no output has been produced\n"
+"from it. This argument is not supported by FORMAT_RAW.\n"
+"\n"
+"For one-shot decompression, use the decompress() function instead.\n");
+
+static PyTypeObject Decompressor_type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_lzma.LZMADecompressor",           /* tp_name */
+    sizeof(Decompressor),               /* tp_basicsize */
+    0,                                  /* tp_itemsize */
+    (destructor)Decompressor_dealloc,   /* tp_dealloc */
+    0,                                  /* tp_print */
+    0,                                  /* tp_getattr */
+    0,                                  /* tp_setattr */
+    0,                                  /* tp_reserved */
+    0,                                  /* tp_repr */
+    0,                                  /* tp_as_number */
+    0,                                  /* tp_as_sequence */
+    0,                                  /* tp_as_mapping */
+    0,                                  /* tp_hash */
+    0,                                  /* tp_call */
+    0,                                  /* tp_str */
+    0,                                  /* tp_getattro */
+    0,                                  /* tp_setattro */
+    0,                                  /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT,                 /* tp_flags */
+    Decompressor_doc,                   /* tp_doc */
+    0,                                  /* tp_traverse */
+    0,                                  /* tp_clear */
+    0,                                  /* tp_richcompare */
+    0,                                  /* tp_weaklistoffset */
+    0,                                  /* tp_iter */
+    0,                                  /* tp_iternext */
+    Decompressor_methods,               /* tp_methods */
+    Decompressor_members,               /* tp_members */
+    0,                                  /* tp_getset */
+    0,                                  /* tp_base */
+    0,                                  /* tp_dict */
+    0,                                  /* tp_descr_get */
+    0,                                  /* tp_descr_set */
+    0,                                  /* tp_dictoffset */
+    (initproc)Decompressor_init,        /* tp_init */
+    0,                                  /* tp_alloc */
+    PyType_GenericNew,                  /* tp_new */
+};
+
+
+/* Module-level functions. */
+
+PyDoc_STRVAR(is_check_supported_doc,
+"is_check_supported(check_id) -> bool\n"
+"\n"
+"Test whether the given integrity check is supported.\n"
+"\n"
+"Always returns True for CHECK_NONE and CHECK_CRC32.\n");
+
+static PyObject *
+is_check_supported(PyObject *self, PyObject *args)
+{
+    int check_id;
+
+    if (!PyArg_ParseTuple(args, "i:is_check_supported", &check_id))
+        return NULL;
+
+    return PyBool_FromLong(lzma_check_is_supported(check_id));
+}
+
+
+PyDoc_STRVAR(_compress_buffer_doc,
+"_compress_buffer(data, format=FORMAT_XZ, check=-1, preset=None,\n"
+"                 filters=None, threads=1, block_size=0) -> bytes\n"
+"\n"
+"Compress data in a single call, as for LZMACompressor.compress()\n"
+"followed by flush(), but without creating a compressor object.\n");
+
+static PyObject *
+_compress_buffer(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *arg_names[] = {"data", "format", "check", "preset",
+                                "filters", "threads", "block_size", NULL};
+    Py_buffer buffer;
+    int format = FORMAT_XZ;
+    int check = -1;
+    PyObject *preset_obj = Py_None;
+    PyObject *filterspecs = Py_None;
+    int threads = 1;
+    uint64_t block_size = 0;
+    lzma_stream lzs = LZMA_STREAM_INIT;
+    Py_ssize_t bufsize;
+    PyObject *result = NULL;
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "y*|iiOOiO&:_compress_buffer", arg_names,
+#else
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "s*|iiOOiO&:_compress_buffer", arg_names,
+#endif
+                                     &buffer, &format, &check, &preset_obj,
+                                     &filterspecs, &threads,
+                                     lzma_vli_converter, &block_size))
+        return NULL;
+
+    if (init_encoder(&lzs, format, check, preset_obj, filterspecs,
+                     threads, block_size) == 0) {
+        /* Start with room for the worst case of the single-call .xz
+           encoder; output of this size or less then needs no copying. */
+        bufsize = (Py_ssize_t)lzma_stream_buffer_bound(buffer.len);
+        if (bufsize <= 0)
+            bufsize = INITIAL_BUFFER_SIZE;
+        result = encode(&lzs, buffer.buf, buffer.len, LZMA_FINISH, bufsize);
+    }
+    lzma_end(&lzs);
+    PyBuffer_Release(&buffer);
+    return result;
+}
+
+/* Find the total decompressed size of data made up solely of .xz streams
+   (with no stream padding), by walking back through their footers and
+   indexes. Returns -1 if the data is not of this form. */
+static Py_ssize_t
+xz_buffer_size(const uint8_t *data, size_t len)
+{
+    uint64_t size = 0;
+    size_t pos = len;
+
+    if (len == 0)
+        return -1;
+    while (pos > 0) {
+        lzma_stream_flags footer;
+        lzma_index *index = NULL;
+        uint64_t memlimit = UINT64_MAX;
+        size_t index_start, index_pos = 0;
+        lzma_vli stream_size;
+
+        if (pos < 2 * LZMA_STREAM_HEADER_SIZE)
+            return -1;
+        if (lzma_stream_footer_decode(
+                &footer, data + pos - LZMA_STREAM_HEADER_SIZE) != LZMA_OK)
+            return -1;
+        if (pos - 2 * LZMA_STREAM_HEADER_SIZE < footer.backward_size)
+            return -1;
+        index_start = pos - LZMA_STREAM_HEADER_SIZE - footer.backward_size;
+        if (lzma_index_buffer_decode(&index, &memlimit, NULL,
+                                     data + index_start, &index_pos,
+                                     footer.backward_size) != LZMA_OK)
+            return -1;
+        stream_size = lzma_index_stream_size(index);
+        size += lzma_index_uncompressed_size(index);
+        lzma_index_end(index, NULL);
+        if (stream_size > pos || size >= PY_SSIZE_T_MAX)
+            return -1;
+        pos -= stream_size;
+    }
+    return (Py_ssize_t)size;
+}
+
+PyDoc_STRVAR(_decompress_buffer_doc,
+"_decompress_buffer(data, memlimit=None) -> bytes or None\n"
+"\n"
+"Decompress data consisting solely of .xz streams in a single call. The\n"
+"output buffer is sized using the stream indexes. Returns None if data\n"
+"is not of this form, or has stream padding, or if the size given by the\n"
+"indexes is implausible, exceeds memlimit or cannot be allocated.\n");
+
+static PyObject *
+_decompress_buffer(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *arg_names[] = {"data", "memlimit", NULL};
+    Py_buffer buffer;
+    Py_ssize_t size;
+    PyObject *memlimit_obj = Py_None;
+    uint64_t memlimit = UINT64_MAX;
+    size_t in_pos = 0, out_pos = 0;
+    lzma_ret lzret;
+    PyObject *result;
+
+#if PY_MAJOR_VERSION >= 3
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "y*|O:_decompress_buffer", arg_names,
+#else
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "s*|O:_decompress_buffer", arg_names,
+#endif
+                                     &buffer, &memlimit_obj))
+        return NULL;
+
+    if (memlimit_obj != Py_None &&
+        !lzma_vli_converter(memlimit_obj, &memlimit)) {
+        PyBuffer_Release(&buffer);
+        return NULL;
+    }
+
+    /* Nothing has checked the indexes yet, so the size they give is only
+       believed if the data could decompress to that much, and it is not
+       over memlimit. Otherwise the caller decompresses the data with a
+       growing buffer, and the decoder reports any mismatch. */
+    size = xz_buffer_size(buffer.buf, buffer.len);
+    if (size == -1 ||
+        (size_t)size / MAX_COMPRESSION_RATIO > (size_t)buffer.len ||
+        (uint64_t)size > memlimit) {
+        PyBuffer_Release(&buffer);
+        Py_RETURN_NONE;
+    }
+
+    /* As in decompress_buf(), a spare byte at the end lets liblzma decode
+       the index and footer of the last stream with output space left. */
+    result = PyBytes_FromStringAndSize(NULL, size + 1);
+    if (result == NULL) {
+        PyBuffer_Release(&buffer);
+        if (!PyErr_ExceptionMatches(PyExc_MemoryError))
+            return NULL;
+        PyErr_Clear();
+        Py_RETURN_NONE;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    lzret = lzma_stream_buffer_decode(&memlimit, LZMA_CONCATENATED, NULL,
+                                      buffer.buf, &in_pos, buffer.len,
+                                      (uint8_t *)PyBytes_AS_STRING(result),
+                                      &out_pos, size + 1);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&buffer);
+
+    if (catch_lzma_error(lzret)) {
+        Py_DECREF(result);
+        return NULL;
+    }
+    /* The indexes were checked against the blocks while decoding. */
+    if (_PyBytes_Resize(&result, out_pos) == -1)
+        return NULL;
+    return result;
+}
+
+/* Batch (de)compression.
+
+   _compress_many() and _decompress_many() process a list of buffers with
+   the GIL released throughout. Each thread reuses one lzma_stream for all
+   of its items, so liblzma can reuse the memory it allocated for the
+   previous item instead of setting up the coder from scratch. */
+
+typedef struct {
+    /* Settings, read-only while the batch runs. */
+    int decompress;
+    int format;
+    lzma_check check;
+    uint32_t preset;
+    lzma_options_lzma alone_options;
+    lzma_filter filters[LZMA_FILTERS_MAX + 1];
+    int have_filters;
+    uint64_t memlimit;
+    Py_buffer *inputs;
+    Py_ssize_t count;
+    /* Results for each item. The outputs are allocated with malloc(). */
+    uint8_t **outputs;
+    size_t *output_sizes;
+    lzma_ret *errors;
+    /* Index of the next item to process. */
+    Py_ssize_t next;
+#ifdef WITH_THREAD
+    PyThread_type_lock lock;
+    PyThread_type_lock done;
+    int running;
+#endif
+} Batch;
+
+/* (Re)initialize lzs for the next item. Does not need the GIL. */
+static lzma_ret
+batch_init_coder(Batch *b, lzma_stream *lzs)
+{
+    if (b->decompress) {
+        switch (b->format) {
+            case FORMAT_AUTO:
+                return lzma_auto_decoder(lzs, b->memlimit, 0);
+            case FORMAT_XZ:
+                return lzma_stream_decoder(lzs, b->memlimit, 0);
+            case FORMAT_ALONE:
+                return lzma_alone_decoder(lzs, b->memlimit);
+            default:
+                return lzma_raw_decoder(lzs, b->filters);
+        }
+    }
+    switch (b->format) {
+        case FORMAT_XZ:
+            if (b->have_filters)
+                return lzma_stream_encoder(lzs, b->filters, b->check);
+            return lzma_easy_encoder(lzs, b->preset, b->check);
+        case FORMAT_ALONE:
+            if (b->have_filters)
+                return lzma_alone_encoder(lzs, b->filters[0].options);
+            return lzma_alone_encoder(lzs, &b->alone_options);
+        default:
+            return lzma_raw_encoder(lzs, b->filters);
+    }
+}
+
+/* Process item i using lzs. Does not need the GIL. */
+static void
+batch_process(Batch *b, lzma_stream *lzs, Py_ssize_t i)
+{
+    uint8_t *out, *tmp;
+    size_t size, used = 0;
+    lzma_ret lzret;
+
+    lzret = batch_init_coder(b, lzs);
+    if (lzret != LZMA_OK) {
+        b->errors[i] = lzret;
+        return;
+    }
+
+    if (b->decompress)
+        size = (size_t)b->inputs[i].len * 4;
+    else
+        size = lzma_stream_buffer_bound(b->inputs[i].len);
+    if (size < INITIAL_BUFFER_SIZE)
+        size = INITIAL_BUFFER_SIZE;
+    out = (uint8_t *)malloc(size);
+    if (out == NULL) {
+        b->errors[i] = LZMA_MEM_ERROR;
+        return;
+    }
+
+    lzs->next_in = b->inputs[i].buf;
+    lzs->avail_in = b->inputs[i].len;
+    lzs->next_out = out;
+    lzs->avail_out = size;
+    for (;;) {
+        lzret = lzma_code(lzs, b->decompress ? LZMA_RUN : LZMA_FINISH);
+        used = lzs->next_out - out;
+        if (lzret == LZMA_STREAM_END) {
+            /* Anything after the first stream is left to the caller. */
+            lzret = lzs->avail_in == 0 ? LZMA_OK : LZMA_BUF_ERROR;
+            break;
+        } else if (lzret != LZMA_OK) {
+            break;
+        } else if (lzs->avail_out == 0) {
+            size = size < MAX_BUFFER_INCREMENT ?
+                   size * 2 : size + MAX_BUFFER_INCREMENT;
+            tmp = (uint8_t *)realloc(out, size);
+            if (tmp == NULL) {
+                lzret = LZMA_MEM_ERROR;
+                break;
+            }
+            out = tmp;
+            lzs->next_out = out + used;
+            lzs->avail_out = size - used;
+        } else if (b->decompress && lzs->avail_in == 0) {
+            /* Truncated input. */
+            lzret = LZMA_BUF_ERROR;
+            break;
+        }
+    }
+    if (lzret != LZMA_OK) {
+        free(out);
+        b->errors[i] = lzret;
+        return;
+    }
+    b->outputs[i] = out;
+    b->output_sizes[i] = used;
+}
+
+/* Process items until there are none left. Does not need the GIL. */
+static void
+batch_run(Batch *b, lzma_stream *lzs)
+{
+    for (;;) {
+        Py_ssize_t i;
+
+#ifdef WITH_THREAD
+        PyThread_acquire_lock(b->lock, WAIT_LOCK);
+#endif
+        i = b->next++;
+#ifdef WITH_THREAD
+        PyThread_release_lock(b->lock);
+#endif
+        if (i >= b->count)
+            break;
+        batch_process(b, lzs, i);
+    }
+}
+
+#ifdef WITH_THREAD
+#ifdef PYTHREAD_INVALID_THREAD_ID
+#define THREAD_START_FAILED PYTHREAD_INVALID_THREAD_ID
+#else
+#define THREAD_START_FAILED -1
+#endif
+
+/* Note that a thread has finished. The last one to finish wakes up the
+   thread running batch_execute(), which may then free b->lock and
+   b->done immediately; so neither may be used after releasing done. */
+static void
+batch_thread_done(Batch *b)
+{
+    int last;
+
+    PyThread_acquire_lock(b->lock, WAIT_LOCK);
+    last = --b->running == 0;
+    PyThread_release_lock(b->lock);
+    if (last)
+        PyThread_release_lock(b->done);
+}
+
+static void
+batch_worker(void *arg)
+{
+    Batch *b = (Batch *)arg;
+    lzma_stream lzs = LZMA_STREAM_INIT;
+
+    batch_run(b, &lzs);
+    lzma_end(&lzs);
+    batch_thread_done(b);
+}
+#endif
+
+/* Acquire the input buffers and allocate the result arrays. */
 static int
-Decompressor_init(Decompressor *self, PyObject *args, PyObject *kwargs)
+batch_setup(Batch *b, PyObject *seq)
 {
-    static char *arg_names[] = {"format", "memlimit", "filters", NULL};
-    const uint32_t decoder_flags = LZMA_TELL_ANY_CHECK | LZMA_TELL_NO_CHECK;
-    int format = FORMAT_AUTO;
-    uint64_t memlimit = UINT64_MAX;
-    PyObject *memlimit_obj = Py_None;
-    PyObject *filterspecs = Py_None;
-    lzma_ret lzret;
-
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
-                                     "|iOO:LZMADecompressor", arg_names,
-                                     &format, &memlimit_obj, &filterspecs))
+    Py_ssize_t i;
+
+    b->count = PySequence_Fast_GET_SIZE(seq);
+    b->inputs = PyMem_New(Py_buffer, b->count);
+    b->outputs = PyMem_New(uint8_t *, b->count);
+    b->output_sizes = PyMem_New(size_t, b->count);
+    b->errors = PyMem_New(lzma_ret, b->count);
+    if (b->inputs == NULL || b->outputs == NULL ||
+        b->output_sizes == NULL || b->errors == NULL) {
+        b->count = 0;
+        PyErr_NoMemory();
         return -1;
-
-    if (memlimit_obj != Py_None) {
-        if (format == FORMAT_RAW) {
-            PyErr_SetString(PyExc_ValueError,
-                            "Cannot specify memory limit with FORMAT_RAW");
+    }
+    for (i = 0; i < b->count; i++) {
+        b->outputs[i] = NULL;
+        b->errors[i] = LZMA_OK;
+    }
+    for (i = 0; i < b->count; i++) {
+        if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(seq, i),
+                               &b->inputs[i], PyBUF_SIMPLE) == -1) {
+            b->count = i;
             return -1;
         }
-#if PY_MAJOR_VERSION >= 3
-        memlimit = PyLong_AsUnsignedLongLong(memlimit_obj);
-#else
-        if (PyInt_Check(memlimit_obj))
-            memlimit = (unsigned PY_LONG_LONG)PyInt_AsLong(memlimit_obj);
-        else if (PyLong_Check(memlimit_obj))
-            memlimit = PyLong_AsUnsignedLongLong(memlimit_obj);
-        else
-            return -1;
-#endif
-        if (PyErr_Occurred())
-            return -1;
     }
+    return 0;
+}
 
-    if (format == FORMAT_RAW && filterspecs == Py_None) {
-        PyErr_SetString(PyExc_ValueError,
-                        "Must specify filters for FORMAT_RAW");
-        return -1;
-    } else if (format != FORMAT_RAW && filterspecs != Py_None) {
-        PyErr_SetString(PyExc_ValueError,
-                        "Cannot specify filters except with FORMAT_RAW");
-        return -1;
+static void
+batch_free(Batch *b)
+{
+    Py_ssize_t i;
+
+    if (b->inputs != NULL)
+        for (i = 0; i < b->count; i++)
+            PyBuffer_Release(&b->inputs[i]);
+    if (b->outputs != NULL)
+        for (i = 0; i < b->count; i++)
+            free(b->outputs[i]);
+    PyMem_Free(b->inputs);
+    PyMem_Free(b->outputs);
+    PyMem_Free(b->output_sizes);
+    PyMem_Free(b->errors);
+    if (b->have_filters)
+        free_filter_chain(b->filters);
+}
+
+/* Run the batch on up to threads threads, using lzs on this one, and
+   collect the results into a list. Failed items are left as None when
+   decompressing; when compressing, they raise an exception. */
+static PyObject *
+batch_execute(Batch *b, lzma_stream *lzs, int threads)
+{
+    PyObject *result;
+    Py_ssize_t i;
+
+    if (threads == 0) {
+#ifdef HAVE_MT_ENCODER
+        threads = (int)lzma_cputhreads();
+#endif
+        if (threads == 0)
+            threads = 1;
     }
+    if (threads > b->count)
+        threads = (int)b->count;
+    b->next = 0;
 
 #ifdef WITH_THREAD
-    self->lock = PyThread_allocate_lock();
-    if (self->lock == NULL) {
+    b->lock = PyThread_allocate_lock();
+    b->done = PyThread_allocate_lock();
+    if (b->lock == NULL || b->done == NULL) {
+        if (b->lock != NULL)
+            PyThread_free_lock(b->lock);
+        if (b->done != NULL)
+            PyThread_free_lock(b->done);
         PyErr_SetString(PyExc_MemoryError, "Unable to allocate lock");
-        return -1;
+        return NULL;
     }
+    PyThread_acquire_lock(b->done, WAIT_LOCK);
+    b->running = 1;
 #endif
 
-    self->check = LZMA_CHECK_UNKNOWN;
-    self->unused_data = PyBytes_FromStringAndSize(NULL, 0);
-    if (self->unused_data == NULL)
-        goto error;
-
-    switch (format) {
-        case FORMAT_AUTO:
-            lzret = lzma_auto_decoder(&self->lzs, memlimit, decoder_flags);
-            if (catch_lzma_error(lzret))
-                break;
-            return 0;
-
-        case FORMAT_XZ:
-            lzret = lzma_stream_decoder(&self->lzs, memlimit, decoder_flags);
-            if (catch_lzma_error(lzret))
-                break;
-            return 0;
-
-        case FORMAT_ALONE:
-            self->check = LZMA_CHECK_NONE;
-            lzret = lzma_alone_decoder(&self->lzs, memlimit);
-            if (catch_lzma_error(lzret))
-                break;
-            return 0;
-
-        case FORMAT_RAW:
-            self->check = LZMA_CHECK_NONE;
-            if (Decompressor_init_raw(&self->lzs, filterspecs) == -1)
-                break;
-            return 0;
-
-        default:
-            PyErr_Format(PyExc_ValueError,
-                         "Invalid container format: %d", format);
+    Py_BEGIN_ALLOW_THREADS
+#ifdef WITH_THREAD
+    for (i = 1; i < threads; i++) {
+        PyThread_acquire_lock(b->lock, WAIT_LOCK);
+        b->running++;
+        PyThread_release_lock(b->lock);
+        if (PyThread_start_new_thread(batch_worker, b) ==
+                THREAD_START_FAILED) {
+            /* Carry on with the threads we have. */
+            PyThread_acquire_lock(b->lock, WAIT_LOCK);
+            b->running--;
+            PyThread_release_lock(b->lock);
             break;
+        }
     }
-
-error:
-    Py_CLEAR(self->unused_data);
+#endif
+    batch_run(b, lzs);
 #ifdef WITH_THREAD
-    PyThread_free_lock(self->lock);
-    self->lock = NULL;
+    batch_thread_done(b);
+    /* Wait for the other threads to finish. */
+    PyThread_acquire_lock(b->done, WAIT_LOCK);
+    PyThread_release_lock(b->done);
 #endif
-    return -1;
-}
+    Py_END_ALLOW_THREADS
 
-static void
-Decompressor_dealloc(Decompressor *self)
-{
-    lzma_end(&self->lzs);
-    Py_CLEAR(self->unused_data);
 #ifdef WITH_THREAD
-    if (self->lock != NULL)
-        PyThread_free_lock(self->lock);
+    PyThread_free_lock(b->lock);
+    PyThread_free_lock(b->done);
 #endif
-    Py_TYPE(self)->tp_free((PyObject *)self);
-}
 
-static PyMethodDef Decompressor_methods[] = {
-    {"decompress", (PyCFunction)Decompressor_decompress, METH_VARARGS,
-     Decompressor_decompress_doc},
-    {NULL}
-};
+    result = PyList_New(b->count);
+    if (result == NULL)
+        return NULL;
+    for (i = 0; i < b->count; i++) {
+        PyObject *item;
 
-PyDoc_STRVAR(Decompressor_check_doc,
-"ID of the integrity check used by the input stream.");
+        if (b->errors[i] != LZMA_OK) {
+            if (!b->decompress) {
+                catch_lzma_error(b->errors[i]);
+                goto error;
+            }
+            Py_INCREF(Py_None);
+            item = Py_None;
+        } else {
+            item = PyBytes_FromStringAndSize((char *)b->outputs[i],
+                                             b->output_sizes[i]);
+            if (item == NULL)
+                goto error;
+        }
+        PyList_SET_ITEM(result, i, item);
+    }
+    return result;
 
-PyDoc_STRVAR(Decompressor_eof_doc,
-"True if the end-of-stream marker has been reached.");
+error:
+    Py_DECREF(result);
+    return NULL;
+}
 
-PyDoc_STRVAR(Decompressor_unused_data_doc,
-"Data found after the end of the compressed stream.");
+PyDoc_STRVAR(_compress_many_doc,
+"_compress_many(buffers, format=FORMAT_XZ, check=-1, preset=None,\n"
+"               filters=None, threads=1) -> list\n"
+"\n"
+"Compress each of a sequence of buffers, as for compress(), returning a\n"
+"list of bytes objects. Up to threads threads are used.\n");
 
-static PyMemberDef Decompressor_members[] = {
-    {"check", T_INT, offsetof(Decompressor, check), READONLY,
-     Decompressor_check_doc},
-    {"eof", T_BOOL, offsetof(Decompressor, eof), READONLY,
-     Decompressor_eof_doc},
-    {"unused_data", T_OBJECT_EX, offsetof(Decompressor, unused_data), READONLY,
-     Decompressor_unused_data_doc},
-    {NULL}
-};
+static PyObject *
+_compress_many(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+    static char *arg_names[] = {"buffers", "format", "check", "preset",
+                                "filters", "threads", NULL};
+    PyObject *buffers, *seq;
+    PyObject *preset_obj = Py_None;
+    PyObject *filterspecs = Py_None;
+    int format = FORMAT_XZ;
+    int check = -1;
+    int threads = 1;
+    lzma_stream lzs = LZMA_STREAM_INIT;
+    Batch b;
+    PyObject *result = NULL;
 
-PyDoc_STRVAR(Decompressor_doc,
-"LZMADecompressor(format=FORMAT_AUTO, memlimit=None, filters=None)\n"
-"\n"
-"Create a decompressor object for decompressing data incrementally.\n"
-"\n"
-"format specifies the container format of the input stream. If this is\n"
-"FORMAT_AUTO (the default), the decompressor will automatically detect\n"
-"whether the input is FORMAT_XZ or FORMAT_ALONE. Streams created with\n"
-"FORMAT_RAW cannot be autodetected.\n"
-"\n"
-"memlimit can be specified to limit the amount of memory used by the\n"
-"decompressor. This will cause decompression to fail if the input\n"
-"cannot be decompressed within the given limit.\n"
-"\n"
-"filters specifies a custom filter chain. This argument is required for\n"
-"FORMAT_RAW, and not accepted with any other format. When provided,\n"
-"this should be a sequence of dicts, each indicating the ID and options\n"
-"for a single filter.\n"
-"\n"
-"For one-shot decompression, use the decompress() function instead.\n");
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "O|iiOOi:_compress_many", arg_names,
+                                     &buffers, &format, &check, &preset_obj,
+                                     &filterspecs, &threads))
+        return NULL;
 
-static PyTypeObject Decompressor_type = {
-    PyVarObject_HEAD_INIT(NULL, 0)
-    "_lzma.LZMADecompressor",           /* tp_name */
-    sizeof(Decompressor),               /* tp_basicsize */
-    0,                                  /* tp_itemsize */
-    (destructor)Decompressor_dealloc,   /* tp_dealloc */
-    0,                                  /* tp_print */
-    0,                                  /* tp_getattr */
-    0,                                  /* tp_setattr */
-    0,                                  /* tp_reserved */
-    0,                                  /* tp_repr */
-    0,                                  /* tp_as_number */
-    0,                                  /* tp_as_sequence */
-    0,                                  /* tp_as_mapping */
-    0,                                  /* tp_hash */
-    0,                                  /* tp_call */
-    0,                                  /* tp_str */
-    0,                                  /* tp_getattro */
-    0,                                  /* tp_setattro */
-    0,                                  /* tp_as_buffer */
-    Py_TPFLAGS_DEFAULT,                 /* tp_flags */
-    Decompressor_doc,                   /* tp_doc */
-    0,                                  /* tp_traverse */
-    0,                                  /* tp_clear */
-    0,                                  /* tp_richcompare */
-    0,                                  /* tp_weaklistoffset */
-    0,                                  /* tp_iter */
-    0,                                  /* tp_iternext */
-    Decompressor_methods,               /* tp_methods */
-    Decompressor_members,               /* tp_members */
-    0,                                  /* tp_getset */
-    0,                                  /* tp_base */
-    0,                                  /* tp_dict */
-    0,                                  /* tp_descr_get */
-    0,                                  /* tp_descr_set */
-    0,                                  /* tp_dictoffset */
-    (initproc)Decompressor_init,        /* tp_init */
-    0,                                  /* tp_alloc */
-    PyType_GenericNew,                  /* tp_new */
-};
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Number of threads must not be negative");
+        return NULL;
+    }
 
+    seq = PySequence_Fast(buffers, "buffers must be a sequence");
+    if (seq == NULL)
+        return NULL;
+    memset(&b, 0, sizeof b);
+
+    /* Setting up an encoder here validates the arguments, and leaves it
+       ready for reuse by this thread. */
+    if (init_encoder(&lzs, format, check, preset_obj, filterspecs,
+                     1, 0) == -1)
+        goto done;
+    b.format = format;
+    b.check = (check == -1) ? LZMA_CHECK_CRC64 : check;
+    b.preset = LZMA_PRESET_DEFAULT;
+    if (preset_obj != Py_None && !uint32_converter(preset_obj, &b.preset))
+        goto done;
+    if (format == FORMAT_ALONE && filterspecs == Py_None &&
+        lzma_lzma_preset(&b.alone_options, b.preset)) {
+        PyErr_Format(Error, "Invalid compression preset: %d", b.preset);
+        goto done;
+    }
+    if (filterspecs != Py_None) {
+        if (parse_filter_chain_spec(b.filters, filterspecs) == -1)
+            goto done;
+        b.have_filters = 1;
+    }
 
-/* Module-level functions. */
+    if (batch_setup(&b, seq) == 0)
+        result = batch_execute(&b, &lzs, threads);
 
-PyDoc_STRVAR(is_check_supported_doc,
-"is_check_supported(check_id) -> bool\n"
-"\n"
-"Test whether the given integrity check is supported.\n"
+done:
+    batch_free(&b);
+    lzma_end(&lzs);
+    Py_DECREF(seq);
+    return result;
+}
+
+PyDoc_STRVAR(_decompress_many_doc,
+"_decompress_many(buffers, format=FORMAT_AUTO, memlimit=None,\n"
+"                 filters=None, threads=1) -> list\n"
 "\n"
-"Always returns True for CHECK_NONE and CHECK_CRC32.\n");
+"Decompress each of a sequence of buffers holding a single compressed\n"
+"stream, returning a list of bytes objects. Up to threads threads are\n"
+"used. Items that cannot be decompressed, or that have data after the\n"
+"first stream, are returned as None.\n");
 
 static PyObject *
-is_check_supported(PyObject *self, PyObject *args)
+_decompress_many(PyObject *self, PyObject *args, PyObject *kwargs)
 {
-    int check_id;
+    static char *arg_names[] = {"buffers", "format", "memlimit", "filters",
+                                "threads", NULL};
+    PyObject *buffers, *seq;
+    PyObject *memlimit_obj = Py_None;
+    PyObject *filterspecs = Py_None;
+    int format = FORMAT_AUTO;
+    int threads = 1;
+    lzma_stream lzs = LZMA_STREAM_INIT;
+    Batch b;
+    PyObject *result = NULL;
 
-    if (!PyArg_ParseTuple(args, "i:is_check_supported", &check_id))
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs,
+                                     "O|iOOi:_decompress_many", arg_names,
+                                     &buffers, &format, &memlimit_obj,
+                                     &filterspecs, &threads))
         return NULL;
 
-    return PyBool_FromLong(lzma_check_is_supported(check_id));
-}
+    if (format < FORMAT_AUTO || format > FORMAT_RAW) {
+        PyErr_Format(PyExc_ValueError,
+                     "Invalid container format: %d", format);
+        return NULL;
+    }
+    if (memlimit_obj != Py_None && format == FORMAT_RAW) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Cannot specify memory limit with FORMAT_RAW");
+        return NULL;
+    }
+    if (format == FORMAT_RAW && filterspecs == Py_None) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Must specify filters for FORMAT_RAW");
+        return NULL;
+    } else if (format != FORMAT_RAW && filterspecs != Py_None) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Cannot specify filters except with FORMAT_RAW");
+        return NULL;
+    }
+    if (threads < 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Number of threads must not be negative");
+        return NULL;
+    }
+
+    seq = PySequence_Fast(buffers, "buffers must be a sequence");
+    if (seq == NULL)
+        return NULL;
+    memset(&b, 0, sizeof b);
+    b.decompress = 1;
+    b.format = format;
+    b.memlimit = UINT64_MAX;
+    if (memlimit_obj != Py_None &&
+        !lzma_vli_converter(memlimit_obj, &b.memlimit))
+        goto done;
+    if (filterspecs != Py_None) {
+        if (parse_filter_chain_spec(b.filters, filterspecs) == -1)
+            goto done;
+        b.have_filters = 1;
+    }
+
+    if (batch_setup(&b, seq) == 0)
+        result = batch_execute(&b, &lzs, threads);
 
+done:
+    batch_free(&b);
+    lzma_end(&lzs);
+    Py_DECREF(seq);
+    return result;
+}
 
 PyDoc_STRVAR(_encode_filter_properties_doc,
 "_encode_filter_properties(filter) -> bytes\n"
@@ -1359,6 +3214,14 @@ _decode_filter_properties(PyObject *self, PyObject *args)
 static PyMethodDef module_methods[] = {
     {"is_check_supported", (PyCFunction)is_check_supported,
      METH_VARARGS, is_check_supported_doc},
+    {"_compress_buffer", (PyCFunction)_compress_buffer,
+     METH_VARARGS | METH_KEYWORDS, _compress_buffer_doc},
+    {"_decompress_buffer", (PyCFunction)_decompress_buffer,
+     METH_VARARGS | METH_KEYWORDS, _decompress_buffer_doc},
+    {"_compress_many", (PyCFunction)_compress_many,
+     METH_VARARGS | METH_KEYWORDS, _compress_many_doc},
+    {"_decompress_many", (PyCFunction)_decompress_many,
+     METH_VARARGS | METH_KEYWORDS, _decompress_many_doc},
     {"_encode_filter_properties", (PyCFunction)_encode_filter_properties,
      METH_VARARGS, _encode_filter_properties_doc},
     {"_decode_filter_properties", (PyCFunction)_decode_filter_properties,
@@ -1436,6 +3299,10 @@ init_lzma(void)
         PyModule_AddIntMacro(m, FORMAT_XZ) == -1 ||
         PyModule_AddIntMacro(m, FORMAT_ALONE) == -1 ||
         PyModule_AddIntMacro(m, FORMAT_RAW) == -1 ||
+        PyModule_AddIntMacro(m, FLUSH_SYNC) == -1 ||
+        PyModule_AddIntMacro(m, FLUSH_FULL) == -1 ||
+        PyModule_AddIntMacro(m, FLUSH_BLOCK) == -1 ||
+        PyModule_AddIntMacro(m, FLUSH_FINISH) == -1 ||
         ADD_INT_PREFIX_MACRO(m, CHECK_NONE) == -1 ||
         ADD_INT_PREFIX_MACRO(m, CHECK_CRC32) == -1 ||
         ADD_INT_PREFIX_MACRO(m, CHECK_CRC64) == -1 ||
@@ -1499,6 +3366,22 @@ init_lzma(void)
         return;
 #endif
 
+    if (PyType_Ready(&FilterChain_type) == -1)
+#if PY_MAJOR_VERSION >= 3
+        return NULL;
+#else
+        return;
+#endif
+
+    Py_INCREF(&FilterChain_type);
+    if (PyModule_AddObject(m, "FilterChain",
+                           (PyObject *)&FilterChain_type) == -1)
+#if PY_MAJOR_VERSION >= 3
+        return NULL;
+#else
+        return;
+#endif
+
     if (PyType_Ready(&Decompressor_type) == -1)
 #if PY_MAJOR_VERSION >= 3
         return NULL;
@@ -0,0 +1,95 @@
+"""Memory-mapped input for LZMAFile and decompress_file().
+
+A _MappedFile maps a whole file into memory and provides the read-only
+file methods LZMAFile uses. read() returns memoryview slices of the
+mapping, so compressed data goes from the page cache to liblzma without
+a read() system call or a bytes object per chunk.
+"""
+
+import io
+import mmap
+import os
+
+
+class _MappedFile(object):
+
+    """Read-only, seekable file object over a memory-mapped file.
+
+    fileobj can be a file name, or a file object with a fileno() method,
+    in which case reading starts at its current position. A file opened
+    by name is closed by close(); a file object passed in is not.
+    """
+
+    def __init__(self, fileobj):
+        self._mmap = None
+        self._data = b""
+        if hasattr(fileobj, "fileno"):
+            self._fp = fileobj
+            self._closefp = False
+            self._pos = fileobj.tell()
+        else:
+            self._fp = io.open(fileobj, "rb")
+            self._closefp = True
+            self._pos = 0
+        try:
+            fd = self._fp.fileno()
+            # Empty files cannot be mapped.
+            if os.fstat(fd).st_size:
+                self._mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                try:
+                    self._data = memoryview(self._mmap)
+                except TypeError:
+                    # Python 2's mmap only supports slicing, which copies.
+                    self._data = self._mmap
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def data(self):
+        """The contents of the file, as a buffer."""
+        return self._data
+
+    def read(self, size=-1):
+        start = self._pos
+        if size is None or size < 0:
+            self._pos = len(self._data)
+        else:
+            self._pos = min(start + size, len(self._data))
+        return self._data[start:self._pos]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._data)
+        if offset < 0:
+            raise ValueError("negative seek position %d" % (offset,))
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self._fp.fileno()
+
+    def close(self):
+        self._data = b""
+        try:
+            if self._mmap is not None:
+                try:
+                    self._mmap.close()
+                except BufferError:
+                    pass  # A slice is still in use; leave it to the GC.
+                self._mmap = None
+        finally:
+            if self._closefp:
+                self._fp.close()
+                self._closefp = False
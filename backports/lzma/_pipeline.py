@@ -0,0 +1,186 @@
+"""Pipelined .xz compression for LZMAFile.
+
+Data written to the file is cut into blocks, which a pool of worker
+threads compress independently while the caller carries on. A writer
+thread then stitches the blocks together, in order, into a single .xz
+stream: the stream header, each block, and finally an index and footer
+built from the sizes of the blocks.
+
+Each worker compresses a block as a complete one-block stream with an
+ordinary LZMACompressor, and the block is cut out of it using the
+stream's index. All the blocks share the stream's integrity check type,
+so they can be reassembled into one stream unchanged.
+"""
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from ._lzma import LZMACompressor, FORMAT_XZ, CHECK_CRC64
+from ._index import (_FOOTER_SIZE, _HEADER_SIZE, _decode_footer,
+                     _decode_index, _encode_index, _stream_footer,
+                     _stream_header)
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+class _Block(object):
+
+    """A block of data on its way through the pipeline."""
+
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.done = threading.Event()
+        self.compressed = None
+        self.unpadded_size = None
+        self.error = None
+
+
+class _PipelinedWriter(object):
+
+    """Compress data written to it into a single .xz stream written to fp,
+    using a pool of worker threads and a writer thread.
+
+    compressor is an LZMACompressor created with the given check, preset
+    and filters, which the first worker uses; the others create their own.
+    At most queue_size blocks are in flight at a time; write() blocks when
+    the pipeline is full. Errors raised by the workers or when writing to
+    fp are re-raised by the next call to write() or close().
+    """
+
+    def __init__(self, fp, compressor, check=-1, preset=None, filters=None,
+                 workers=0, block_size=1 << 22, queue_size=None):
+        if check == -1:
+            check = CHECK_CRC64
+        if workers == 0:
+            workers = _cpu_count()
+        if queue_size is None:
+            queue_size = 2 * workers
+        self._fp = fp
+        self._check = check
+        self._block_size = block_size
+        self._pending = []
+        self._pending_size = 0
+        self._error = None
+        self._settings = (check, preset, filters)
+
+        # Blocks are queued for the workers, and in the same order for the
+        # writer. Only the writer's queue is bounded, as every block passes
+        # through both.
+        self._work_queue = queue.Queue()
+        self._write_queue = queue.Queue(queue_size)
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._compress_blocks,
+                                      args=(compressor,))
+            compressor = None
+            self._start(thread)
+        self._writer = threading.Thread(target=self._write_blocks)
+        self._start(self._writer)
+
+    def _start(self, thread):
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _compress_blocks(self, compressor):
+        while True:
+            block = self._work_queue.get()
+            if block is None:
+                return
+            try:
+                if compressor is None:
+                    compressor = LZMACompressor(FORMAT_XZ, *self._settings)
+                else:
+                    compressor.reset()
+                stream = compressor.compress(block.data) + compressor.flush()
+                index_size = _decode_footer(stream[-_FOOTER_SIZE:])[0]
+                index_offset = len(stream) - _FOOTER_SIZE - index_size
+                [(block.unpadded_size, uncompressed_size)] = _decode_index(
+                    stream[index_offset:-_FOOTER_SIZE])
+                block.compressed = stream[_HEADER_SIZE:index_offset]
+            except Exception as e:
+                block.error = e
+            block.data = None
+            block.done.set()
+
+    def _write_blocks(self):
+        records = []
+        try:
+            self._fp.write(_stream_header(self._check))
+        except Exception as e:
+            self._error = e
+        while True:
+            block = self._write_queue.get()
+            if block is None:
+                break
+            block.done.wait()
+            if self._error is not None:
+                continue  # Keep draining the queue so write() cannot stall.
+            try:
+                if block.error is not None:
+                    raise block.error
+                self._fp.write(block.compressed)
+                records.append((block.unpadded_size, block.size))
+            except Exception as e:
+                self._error = e
+        if self._error is None:
+            try:
+                index = _encode_index(records)
+                self._fp.write(index +
+                               _stream_footer(self._check, len(index)))
+            except Exception as e:
+                self._error = e
+
+    # Once an error has occurred, the output is incomplete, so every later
+    # call fails too.
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _submit(self, data):
+        block = _Block(data)
+        self._write_queue.put(block)
+        self._work_queue.put(block)
+
+    def write(self, data):
+        """Queue data for compression."""
+        self._check_error()
+        if not isinstance(data, bytes):
+            data = memoryview(data).tobytes()
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self._block_size:
+            data = b"".join(self._pending)
+            end = len(data) - len(data) % self._block_size
+            for i in range(0, end, self._block_size):
+                self._submit(data[i:i + self._block_size])
+            self._pending = [data[end:]]
+            self._pending_size = len(data) - end
+
+    def close(self):
+        """Compress any remaining data, and finish the stream.
+
+        Waits for all the threads to exit.
+        """
+        if self._pending_size:
+            self._submit(b"".join(self._pending))
+        self._pending = []
+        self._pending_size = 0
+        self._write_queue.put(None)
+        for thread in self._threads:
+            if thread is not self._writer:
+                self._work_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._check_error()
@@ -0,0 +1,71 @@
+"""Read-ahead for LZMAFile.
+
+A _Prefetcher calls a function producing decompressed chunks in a
+background thread, keeping up to a fixed number of them queued for the
+reader. Reading the underlying file and decompressing (both of which
+release the GIL) then overlap with whatever the reader does with the
+data.
+"""
+
+import threading
+from collections import deque
+
+
+class _Prefetcher(object):
+
+    """Call produce() repeatedly in a background thread, queueing up to
+    depth of its results.
+
+    produce() returns a chunk of data, or None at the end of the data. The
+    thread exits after the end of the data, or after produce() raises an
+    exception, which get() re-raises.
+    """
+
+    def __init__(self, produce, depth):
+        self._produce = produce
+        self._depth = depth
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                item = (self._produce(), None)
+            except Exception as e:
+                item = (None, e)
+            with self._cond:
+                while len(self._items) >= self._depth and not self._stopping:
+                    self._cond.wait()
+                self._items.append(item)
+                self._cond.notify_all()
+                if item[0] is None or self._stopping:
+                    return
+
+    def get(self):
+        """Return the next (chunk, exception) pair, waiting if needed.
+
+        chunk is None at the end of the data or if an exception occurred.
+        """
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            item = self._items.popleft()
+            self._cond.notify_all()
+        return item
+
+    def stop(self):
+        """Stop the thread, and return a list of the items it queued.
+
+        Waits for any call to produce() in progress to finish.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        items = list(self._items)
+        self._items.clear()
+        return items
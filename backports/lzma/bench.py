@@ -0,0 +1,431 @@
+"""Benchmarks for backports.lzma.
+
+Run with "python -m backports.lzma.bench"; see --help for the options.
+The suite times one-shot compress() and decompress(), incremental
+LZMACompressor and LZMADecompressor calls, and LZMAFile reads, seeks and
+writes, over synthetic data of different entropy. The data is generated
+from fixed seeds, so runs on the same machine are comparable.
+
+Each benchmark reports the best time of several runs, as megabytes of
+uncompressed data per second, and per-call latency percentiles where it
+makes a series of calls. Memory use is reported as the peak resident set
+size during the timed runs (Linux only; elsewhere this is the peak for
+the whole process so far), and from an extra run under tracemalloc, as
+the peak size of Python heap allocations and the number of memory blocks
+still allocated afterwards. liblzma's own allocations only show up in
+the resident set size.
+
+With --json, the results are also written out as JSON, and --compare
+prints the change in throughput against such a file from an earlier run.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import io
+import json
+import platform
+import random
+import re
+import sys
+import time
+import timeit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from . import (LZMACompressor, LZMADecompressor, LZMAFile, compress,
+               decompress, __version__)
+
+
+_timer = timeit.default_timer
+
+CORPORA = ("text", "mixed", "random")
+
+
+def _make_text(size):
+    # Compressible, line-oriented input, like a log file.
+    lines = []
+    n = 0
+    i = 0
+    while n < size:
+        line = "%08d the quick brown fox jumps over the lazy dog %d\n" % (
+            i, i * 7919 % 1000003)
+        lines.append(line)
+        n += len(line)
+        i += 1
+    return "".join(lines)[:size].encode("ascii")
+
+
+def _make_random(size, seed=0):
+    # Incompressible input, generated reproducibly.
+    blocks = []
+    for i in range((size + 31) // 32):
+        blocks.append(hashlib.sha256(("%d:%d" % (seed, i)).encode("ascii"))
+                      .digest())
+    return b"".join(blocks)[:size]
+
+
+def make_corpus(kind, size):
+    """Return size bytes of test data of the given kind.
+
+    kind is "text" (highly compressible), "random" (incompressible), or
+    "mixed" (alternating 1 KiB runs of each).
+    """
+    if kind == "text":
+        return _make_text(size)
+    elif kind == "random":
+        return _make_random(size)
+    elif kind == "mixed":
+        text = _make_text(size)
+        noise = _make_random(size)
+        return b"".join(text[i:i + 1024] if i % 2048 == 0 else
+                        noise[i:i + 1024]
+                        for i in range(0, size, 1024))
+    raise ValueError("Unknown corpus: %r" % (kind,))
+
+
+def _percentiles(samples):
+    # Nearest-rank percentiles of a list of durations, in microseconds.
+    samples = sorted(samples)
+    result = {}
+    for p in (50, 90, 99):
+        rank = max(int(len(samples) * p / 100.0 + 0.5), 1)
+        result["p%d" % p] = samples[rank - 1] * 1e6
+    result["max"] = samples[-1] * 1e6
+    return result
+
+
+# Return the peak resident set size in KiB, and reset it if possible, so
+# that the next call reports the peak since this one.
+def _peak_rss():
+    peak = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    peak = int(line.split()[1])
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError, ValueError):
+        pass
+    if peak is None and resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak //= 1024  # Reported in bytes rather than KiB.
+    return peak
+
+
+def _allocations(run):
+    # Run run() under tracemalloc, returning the peak size of the traced
+    # memory and the number of blocks left allocated.
+    if tracemalloc is None:
+        return {}
+    tracemalloc.start()
+    try:
+        before = len(tracemalloc.take_snapshot().traces)
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        after = len(tracemalloc.take_snapshot().traces)
+    finally:
+        tracemalloc.stop()
+    return {"alloc_peak": peak, "alloc_blocks": after - before}
+
+
+def measure(name, params, run, nbytes, repeat=3, memory=True):
+    """Time run() and return a result dict for the benchmark.
+
+    run() may return a list of per-call durations, which are summarized as
+    latency percentiles. nbytes is the amount of uncompressed data each run
+    processes. If memory is true, run() is called once more under
+    tracemalloc to measure its allocations.
+    """
+    _peak_rss()
+    times = []
+    latencies = []
+    for i in range(repeat):
+        start = _timer()
+        calls = run()
+        times.append(_timer() - start)
+        if isinstance(calls, list):
+            latencies.extend(calls)
+    result = {
+        "id": "%s[%s]" % (name, ",".join("%s=%s" % item
+                                          for item in sorted(params.items()))),
+        "name": name,
+        "params": params,
+        "bytes": nbytes,
+        "seconds": min(times),
+        "mb_per_s": nbytes / min(times) / 1e6,
+        "peak_rss_kib": _peak_rss(),
+    }
+    if latencies:
+        result["latency_us"] = _percentiles(latencies)
+        result["calls"] = len(latencies) // repeat
+    if memory:
+        result.update(_allocations(run))
+    return result
+
+
+def _timed_calls(func, args):
+    # Call func with each item of args, returning the duration of each call.
+    durations = []
+    for arg in args:
+        start = _timer()
+        func(arg)
+        durations.append(_timer() - start)
+    return durations
+
+
+def _chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def bench_compress(data, params, presets, **kwargs):
+    """Benchmark compress() and decompress() at each preset."""
+    results = []
+    for preset in presets:
+        p = dict(params, preset=preset)
+        compressed = compress(data, preset=preset)
+        results.append(measure("compress", p,
+                               lambda: compress(data, preset=preset),
+                               len(data), **kwargs))
+        results.append(measure("decompress", p,
+                               lambda: decompress(compressed),
+                               len(data), **kwargs))
+    return results
+
+
+def bench_incremental(data, params, chunk_sizes, preset, **kwargs):
+    """Benchmark feeding LZMACompressor and LZMADecompressor chunk_size
+    bytes of input at a time."""
+    results = []
+    compressed = compress(data, preset=preset)
+    for size in chunk_sizes:
+        p = dict(params, chunk_size=size, preset=preset)
+        chunks = _chunks(data, size)
+        cchunks = _chunks(compressed, size)
+
+        def run_compressor():
+            comp = LZMACompressor(preset=preset)
+            durations = _timed_calls(comp.compress, chunks)
+            comp.flush()
+            return durations
+
+        def run_decompressor():
+            return _timed_calls(LZMADecompressor().decompress, cchunks)
+
+        results.append(measure("LZMACompressor", p, run_compressor,
+                               len(data), **kwargs))
+        results.append(measure("LZMADecompressor", p, run_decompressor,
+                               len(data), **kwargs))
+    return results
+
+
+def bench_file(data, params, read_sizes, chunk_sizes, preset, seeks=200,
+               **kwargs):
+    """Benchmark LZMAFile reads of each size in read_sizes, line iteration,
+    random seeks, and writes of each size in chunk_sizes."""
+    results = []
+    compressed = compress(data, preset=preset)
+
+    for size in read_sizes:
+        def run_read():
+            with LZMAFile(io.BytesIO(compressed)) as f:
+                durations = []
+                while True:
+                    start = _timer()
+                    chunk = f.read(size)
+                    durations.append(_timer() - start)
+                    if not chunk:
+                        return durations
+        results.append(measure("LZMAFile.read", dict(params, size=size),
+                               run_read, len(data), **kwargs))
+
+    def run_readline():
+        with io.TextIOWrapper(LZMAFile(io.BytesIO(compressed)),
+                              encoding="latin-1") as f:
+            for line in f:
+                pass
+    results.append(measure("LZMAFile.readline", dict(params), run_readline,
+                           len(data), **kwargs))
+
+    # Seeking uses the .xz index to jump to the block holding the target,
+    # so the data is compressed in blocks of 64 KiB.
+    blocked = LZMACompressor(preset=preset, threads=0, block_size=1 << 16)
+    blocked = blocked.compress(data) + blocked.flush()
+    rng = random.Random(0)
+    offsets = [rng.randrange(len(data)) for i in range(seeks)]
+
+    def run_seek():
+        with LZMAFile(io.BytesIO(blocked)) as f:
+            def seek_and_read(offset):
+                f.seek(offset)
+                f.read(4096)
+            return _timed_calls(seek_and_read, offsets)
+    results.append(measure("LZMAFile.seek", dict(params, block_size=1 << 16),
+                           run_seek, seeks * 4096, **kwargs))
+
+    for size in chunk_sizes:
+        chunks = _chunks(data, size)
+
+        def run_write():
+            with LZMAFile(io.BytesIO(), "w", preset=preset) as f:
+                return _timed_calls(f.write, chunks)
+        results.append(measure("LZMAFile.write",
+                               dict(params, chunk_size=size, preset=preset),
+                               run_write, len(data), **kwargs))
+    return results
+
+
+def run_suite(size=4 << 20, corpora=CORPORA, presets=(0, 6),
+              chunk_sizes=(1024, 65536), read_sizes=(1, 256, 65536),
+              repeat=3, memory=True, only=None, verbose=False):
+    """Run the benchmark suite, returning a list of result dicts.
+
+    Each dict has the benchmark's "id", "name" and "params", and the
+    measurements described in the module docstring. only is a regular
+    expression; if given, only benchmarks whose id it matches are kept.
+    """
+    results = []
+    kwargs = {"repeat": repeat, "memory": memory}
+    for kind in corpora:
+        data = make_corpus(kind, size)
+        params = {"corpus": kind}
+        found = bench_compress(data, params, presets, **kwargs)
+        found += bench_incremental(data, params, chunk_sizes, presets[-1],
+                                   **kwargs)
+        found += bench_file(data, params, read_sizes, chunk_sizes,
+                            presets[0], **kwargs)
+        for result in found:
+            if only is None or re.search(only, result["id"]):
+                results.append(result)
+                if verbose:
+                    print(format_result(result))
+    return results
+
+
+def format_result(result):
+    """Return a one-line summary of a result dict."""
+    line = "%-58s %9.2f MB/s" % (result["id"], result["mb_per_s"])
+    if "latency_us" in result:
+        line += "  p50 %8.1f us  p99 %8.1f us" % (
+            result["latency_us"]["p50"], result["latency_us"]["p99"])
+    if result.get("peak_rss_kib") is not None:
+        line += "  rss %7d KiB" % result["peak_rss_kib"]
+    if "alloc_peak" in result:
+        line += "  heap %7d KiB" % (result["alloc_peak"] // 1024)
+    return line
+
+
+def _environment():
+    return {
+        "backports.lzma": __version__,
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def compare(results, baseline):
+    """Return lines comparing the throughput in results with that of the
+    results in baseline (as loaded from the JSON output)."""
+    old = dict((r["id"], r) for r in baseline["results"])
+    lines = []
+    for result in results:
+        if result["id"] in old:
+            ratio = result["mb_per_s"] / old[result["id"]]["mb_per_s"]
+            lines.append("%-58s %+7.1f%%" % (result["id"],
+                                             (ratio - 1) * 100))
+    return lines
+
+
+def _int_list(text):
+    return tuple(int(item) for item in text.split(","))
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python -m backports.lzma.bench",
+        description="Benchmark compression and decompression with "
+                    "backports.lzma.")
+    parser.add_argument("--size", type=int, default=4 << 20,
+                        help="uncompressed size of the test data in bytes "
+                             "(default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of runs per benchmark; the best is "
+                             "reported (default: %(default)s)")
+    parser.add_argument("--corpus", default=",".join(CORPORA),
+                        help="comma-separated kinds of test data, from "
+                             "%(default)s")
+    parser.add_argument("--presets", type=_int_list, default=(0, 6),
+                        help="comma-separated compression presets; the "
+                             "incremental benchmarks use the last one, and "
+                             "LZMAFile the first (default: 0,6)")
+    parser.add_argument("--chunk-sizes", type=_int_list,
+                        default=(1024, 65536),
+                        help="comma-separated sizes of the chunks fed to "
+                             "the compressor objects and LZMAFile.write() "
+                             "(default: 1024,65536)")
+    parser.add_argument("--read-sizes", type=_int_list,
+                        default=(1, 256, 65536),
+                        help="comma-separated sizes for LZMAFile.read() "
+                             "(default: 1,256,65536)")
+    parser.add_argument("--only", metavar="REGEX",
+                        help="only run benchmarks whose id matches REGEX, "
+                             "e.g. 'decompress.*corpus=text'")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the extra run under tracemalloc")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write the results to FILE as JSON ('-' for "
+                             "standard output)")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare throughput against the JSON results "
+                             "in FILE")
+    args = parser.parse_args(argv)
+
+    corpora = tuple(args.corpus.split(","))
+    for kind in corpora:
+        if kind not in CORPORA:
+            parser.error("unknown corpus: %r" % (kind,))
+    verbose = args.json != "-"
+    if verbose:
+        print("%d bytes of data per corpus, best of %d runs" % (
+            args.size, args.repeat))
+    results = run_suite(args.size, corpora, args.presets, args.chunk_sizes,
+                        args.read_sizes, args.repeat, args.memory, args.only,
+                        verbose)
+
+    if args.json:
+        output = {"environment": _environment(),
+                  "settings": {"size": args.size, "repeat": args.repeat},
+                  "results": results}
+        if args.json == "-":
+            json.dump(output, sys.stdout, indent=1, sort_keys=True)
+            print()
+        else:
+            with open(args.json, "w") as f:
+                json.dump(output, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        out = sys.stdout if verbose else sys.stderr
+        print("Change in throughput against %s:" % (args.compare,), file=out)
+        for line in compare(results, baseline):
+            print(line, file=out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
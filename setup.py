@@ -9,9 +9,11 @@ import sys, os
 
 try:
     from setuptools.command.build_ext import build_ext
+    from setuptools.command.build_py import build_py
     from setuptools import setup, Extension
 except ImportError:
     from distutils.command.build_ext import build_ext
+    from distutils.command.build_py import build_py
     from distutils.core import setup
     from distutils.extension import Extension
 
@@ -59,6 +61,18 @@ class build_ext_subclass(build_ext):
         build_ext.build_extensions(self)
 
 
+class build_py_subclass(build_py):
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 5):
+            # The asyncio support uses async/await syntax, which older
+            # Pythons cannot even byte-compile; backports.lzma only imports
+            # it on Python 3.5 and later.
+            modules = [m for m in modules
+                       if m[:2] != ("backports.lzma", "_async")]
+        return modules
+
+
 packages = ["backports", "backports.lzma"]
 prefix = sys.prefix
 home = os.path.expanduser("~")
@@ -120,5 +134,6 @@ setup(
     ext_modules = extens,
     cmdclass = {
         'build_ext': build_ext_subclass,
+        'build_py': build_py_subclass,
     },
 )
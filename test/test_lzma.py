@@ -1,7 +1,9 @@
 from io import BytesIO, UnsupportedOperation
 import os
 import sys
+import pickle
 import random
+import struct
 import unittest
 
 try:
@@ -36,6 +38,39 @@ from backports import lzma
 from backports.lzma import LZMACompressor, LZMADecompressor, LZMAError, LZMAFile
 
 
+def _have_mt_encoder():
+    # Multithreaded compression needs liblzma 5.2.0 or later.
+    try:
+        LZMACompressor(threads=2)
+    except LZMAError:
+        return False
+    return True
+
+requires_mt_encoder = unittest.skipUnless(_have_mt_encoder(),
+                                          "requires multithreaded encoder")
+
+def _have_mt_decoder():
+    # Multithreaded decompression needs liblzma 5.4.0 or later.
+    try:
+        LZMADecompressor(threads=2)
+    except LZMAError:
+        return False
+    return True
+
+requires_mt_decoder = unittest.skipUnless(_have_mt_decoder(),
+                                          "requires multithreaded decoder")
+
+def _forge_xz_size(size):
+    # Return COMPRESSED_XZ with its index claiming that its block
+    # decompresses to size bytes.
+    from backports.lzma import _index
+    index = lzma.read_index(BytesIO(COMPRESSED_XZ))
+    stream = index.streams[0]
+    records = _index._encode_index([(index.block_unpadded_sizes[0], size)])
+    return (COMPRESSED_XZ[:stream.index_offset] + records +
+            _index._stream_footer(stream.check, len(records)))
+
+
 class CompressorDecompressorTestCase(unittest.TestCase):
 
     # Test error cases.
@@ -94,6 +129,64 @@ class CompressorDecompressorTestCase(unittest.TestCase):
         self.assertRaises(ValueError, LZMACompressor,
                           filters=[{"id": lzma.FILTER_X86, "foo": 0}])
 
+    def test_filter_chain(self):
+        chain = lzma.FilterChain(FILTERS_RAW_4)
+        self.assertEqual(len(chain), 3)
+        self.assertEqual(list(chain), FILTERS_RAW_4)
+        self.assertIs(lzma.FilterChain(chain), chain)
+        # Items are copies, so the chain cannot be modified.
+        chain[0]["dist"] = 1
+        self.assertEqual(chain[0], FILTERS_RAW_4[0])
+        self.assertRaises(IndexError, chain.__getitem__, 3)
+        self.assertEqual(eval(repr(chain), vars(lzma)), chain)
+        self.assertEqual(pickle.loads(pickle.dumps(chain)), chain)
+
+        # Chains with the same options are equal, however they are given.
+        same = lzma.FilterChain([
+            {"dist": 4, "id": lzma.FILTER_DELTA},
+            {"id": lzma.FILTER_X86, "start_offset": 0x40},
+            {"id": lzma.FILTER_LZMA2, "preset": 4, "lc": 2, "lp": 0}])
+        self.assertEqual(same, chain)
+        self.assertEqual(hash(same), hash(chain))
+        self.assertEqual(lzma.FilterChain([{"id": lzma.FILTER_LZMA2}]),
+                         lzma.FilterChain([{"id": lzma.FILTER_LZMA2,
+                                            "preset": 6}]))
+        self.assertNotEqual(lzma.FilterChain(FILTERS_RAW_1), chain)
+        self.assertNotEqual(chain, FILTERS_RAW_4)
+        self.assertEqual(len(set([chain, same,
+                                  lzma.FilterChain(FILTERS_RAW_1)])), 2)
+
+        self.assertRaises(TypeError, lzma.FilterChain, [b"wobsite"])
+        self.assertRaises(ValueError, lzma.FilterChain, [{"id": 98765}])
+        self.assertRaises(ValueError, lzma.FilterChain,
+                          [{"id": lzma.FILTER_LZMA2, "foo": 0}])
+        self.assertRaises(ValueError, lzma.FilterChain,
+                          [{"id": lzma.FILTER_LZMA2}] * 5)
+
+    def test_roundtrip_filter_chain(self):
+        for filters, cdata in ((FILTERS_RAW_1, COMPRESSED_RAW_1),
+                               (FILTERS_RAW_2, COMPRESSED_RAW_2),
+                               (FILTERS_RAW_3, COMPRESSED_RAW_3),
+                               (FILTERS_RAW_4, COMPRESSED_RAW_4)):
+            chain = lzma.FilterChain(filters)
+            lzc = LZMACompressor(lzma.FORMAT_RAW, filters=chain)
+            self.assertEqual(lzc.compress(INPUT) + lzc.flush(), cdata)
+            lzd = LZMADecompressor(lzma.FORMAT_RAW, filters=chain)
+            self._test_decompressor(lzd, cdata, lzma.CHECK_NONE)
+            lzd.reset()
+            self._test_decompressor(lzd, cdata, lzma.CHECK_NONE)
+
+        chain = lzma.FilterChain(FILTERS_RAW_4)
+        cdata = lzma.compress(INPUT, filters=chain)
+        self.assertEqual(cdata, lzma.compress(INPUT, filters=FILTERS_RAW_4))
+        self.assertEqual(lzma.decompress(cdata), INPUT)
+        self.assertEqual(lzma.compress_many([INPUT], lzma.FORMAT_RAW,
+                                            filters=chain),
+                         [lzma.compress(INPUT, lzma.FORMAT_RAW,
+                                        filters=FILTERS_RAW_4)])
+        self.assertRaises(ValueError, LZMACompressor, lzma.FORMAT_ALONE,
+                          filters=chain)
+
     def test_decompressor_after_eof(self):
         lzd = LZMADecompressor()
         lzd.decompress(COMPRESSED_XZ)
@@ -162,6 +255,166 @@ class CompressorDecompressorTestCase(unittest.TestCase):
         self.assertTrue(lzd.eof)
         self.assertEqual(lzd.unused_data, b"")
 
+    def test_decompressor_chunks_maxsize(self):
+        lzd = LZMADecompressor()
+        max_length = 100
+        out = []
+
+        # Feed first half the input
+        len_ = len(COMPRESSED_XZ) // 2
+        out.append(lzd.decompress(COMPRESSED_XZ[:len_],
+                                  max_length=max_length))
+        self.assertFalse(lzd.needs_input)
+        self.assertEqual(len(out[-1]), max_length)
+
+        # Retrieve more data without providing more input
+        out.append(lzd.decompress(b"", max_length=max_length))
+        self.assertFalse(lzd.needs_input)
+        self.assertEqual(len(out[-1]), max_length)
+
+        # Retrieve more data while providing more input
+        out.append(lzd.decompress(COMPRESSED_XZ[len_:],
+                                  max_length=max_length))
+        self.assertLessEqual(len(out[-1]), max_length)
+
+        # Retrieve remaining uncompressed data
+        while not lzd.eof:
+            out.append(lzd.decompress(b"", max_length=max_length))
+            self.assertLessEqual(len(out[-1]), max_length)
+
+        out = b"".join(out)
+        self.assertEqual(out, INPUT)
+        self.assertEqual(lzd.check, lzma.CHECK_CRC64)
+        self.assertEqual(lzd.unused_data, b"")
+
+    def test_decompressor_inputbuf_1(self):
+        # Test reusing input buffer after moving existing
+        # contents to beginning
+        lzd = LZMADecompressor()
+        out = []
+
+        # Create input buffer and fill it
+        self.assertEqual(lzd.decompress(COMPRESSED_XZ[:100],
+                                        max_length=0), b"")
+
+        # Retrieve some results, freeing capacity at beginning
+        # of input buffer
+        out.append(lzd.decompress(b"", 2))
+
+        # Add more data that fits into input buffer after
+        # moving existing data to beginning
+        out.append(lzd.decompress(COMPRESSED_XZ[100:105], 15))
+
+        # Decompress rest of data
+        out.append(lzd.decompress(COMPRESSED_XZ[105:]))
+        self.assertEqual(b"".join(out), INPUT)
+
+    def test_decompressor_inputbuf_2(self):
+        # Test reusing input buffer by appending data at the
+        # end right away
+        lzd = LZMADecompressor()
+        out = []
+
+        # Create input buffer and empty it
+        self.assertEqual(lzd.decompress(COMPRESSED_XZ[:200],
+                                        max_length=0), b"")
+        out.append(lzd.decompress(b""))
+
+        # Fill buffer with new data
+        out.append(lzd.decompress(COMPRESSED_XZ[200:280], 2))
+
+        # Append some more data, not enough to require resize
+        out.append(lzd.decompress(COMPRESSED_XZ[280:300], 2))
+
+        # Decompress rest of data
+        out.append(lzd.decompress(COMPRESSED_XZ[300:]))
+        self.assertEqual(b"".join(out), INPUT)
+
+    def test_decompressor_inputbuf_3(self):
+        # Test reusing input buffer after extending it
+        lzd = LZMADecompressor()
+        out = []
+
+        # Create almost full input buffer
+        out.append(lzd.decompress(COMPRESSED_XZ[:200], 5))
+
+        # Add even more data to it, requiring resize
+        out.append(lzd.decompress(COMPRESSED_XZ[200:300], 5))
+
+        # Decompress rest of data
+        out.append(lzd.decompress(COMPRESSED_XZ[300:]))
+        self.assertEqual(b"".join(out), INPUT)
+
+    def test_decompressor_unused_data_maxsize(self):
+        lzd = LZMADecompressor()
+        extra = b"fooblibar"
+        out = []
+        data = COMPRESSED_XZ + extra
+        while not lzd.eof:
+            out.append(lzd.decompress(data, max_length=64))
+            data = b""
+        self.assertEqual(b"".join(out), INPUT)
+        self.assertEqual(lzd.unused_data, extra)
+        self.assertFalse(lzd.needs_input)
+
+    def test_decompressor_bufsize(self):
+        for bufsize in (1, 100, len(INPUT), len(INPUT) + 1, 1 << 20):
+            lzd = LZMADecompressor()
+            self.assertEqual(lzd.decompress(COMPRESSED_XZ, bufsize=bufsize),
+                             INPUT)
+            self.assertTrue(lzd.eof)
+        lzd = LZMADecompressor()
+        out = lzd.decompress(COMPRESSED_XZ, 100, len(INPUT))
+        self.assertEqual(out, INPUT[:100])
+        self.assertFalse(lzd.needs_input)
+        self.assertRaises(ValueError, lzd.decompress, b"", bufsize=-1)
+        # bufsize is only a hint, so a huge one does not fail.
+        lzd = LZMADecompressor()
+        self.assertEqual(lzd.decompress(COMPRESSED_XZ, bufsize=1 << 55),
+                         INPUT)
+
+    def test_decompressor_decompress_into(self):
+        lzd = LZMADecompressor()
+        buf = bytearray(100)
+        out = []
+        data = COMPRESSED_XZ
+        while not lzd.eof:
+            n = lzd.decompress_into(data, buf)
+            self.assertTrue(0 <= n <= len(buf))
+            out.append(bytes(buf[:n]))
+            data = b""
+        self.assertEqual(b"".join(out), INPUT)
+        self.assertEqual(lzd.check, lzma.CHECK_CRC64)
+        self.assertRaises(EOFError, lzd.decompress_into, b"", buf)
+
+    def test_decompressor_decompress_into_memoryview(self):
+        lzd = LZMADecompressor()
+        buf = bytearray(len(INPUT) + 10)
+        n = lzd.decompress_into(COMPRESSED_XZ + b"extra",
+                                memoryview(buf)[5:])
+        self.assertEqual(n, len(INPUT))
+        self.assertEqual(bytes(buf[5:5 + n]), INPUT)
+        self.assertEqual(bytes(buf[:5]), b"\0" * 5)
+        self.assertTrue(lzd.eof)
+        self.assertEqual(lzd.unused_data, b"extra")
+
+    def test_decompressor_decompress_into_mixed(self):
+        # decompress() and decompress_into() share the same input buffer.
+        lzd = LZMADecompressor()
+        buf = bytearray(50)
+        n = lzd.decompress_into(COMPRESSED_XZ[:200], buf)
+        self.assertFalse(lzd.needs_input)
+        out = [bytes(buf[:n]), lzd.decompress(COMPRESSED_XZ[200:])]
+        self.assertEqual(b"".join(out), INPUT)
+
+    def test_decompressor_decompress_into_bad_args(self):
+        lzd = LZMADecompressor()
+        self.assertRaises(TypeError, lzd.decompress_into, COMPRESSED_XZ)
+        self.assertRaises(TypeError, lzd.decompress_into, COMPRESSED_XZ,
+                          b"read-only")
+        self.assertRaises(LZMAError, lzd.decompress_into, COMPRESSED_RAW_1,
+                          bytearray(10))
+
     def test_decompressor_unused_data(self):
         lzd = LZMADecompressor()
         extra = b"fooblibar"
@@ -211,6 +464,90 @@ class CompressorDecompressorTestCase(unittest.TestCase):
         lzd = LZMADecompressor()
         self._test_decompressor(lzd, cdata, lzma.CHECK_CRC64)
 
+    @requires_mt_encoder
+    def test_roundtrip_xz_threads(self):
+        lzc = LZMACompressor(threads=2, block_size=1024)
+        cdata = lzc.compress(INPUT) + lzc.flush()
+        lzd = LZMADecompressor()
+        self._test_decompressor(lzd, cdata, lzma.CHECK_CRC64)
+
+        lzc = LZMACompressor(threads=0)
+        cdata = []
+        for i in range(0, len(INPUT), 10):
+            cdata.append(lzc.compress(INPUT[i:i+10]))
+        cdata.append(lzc.flush())
+        lzd = LZMADecompressor()
+        self._test_decompressor(lzd, b"".join(cdata), lzma.CHECK_CRC64)
+
+    @requires_mt_encoder
+    def test_roundtrip_xz_threads_filters(self):
+        lzc = LZMACompressor(threads=2, block_size=512, check=lzma.CHECK_NONE,
+                             filters=FILTERS_RAW_4)
+        cdata = lzc.compress(INPUT) + lzc.flush()
+        lzd = LZMADecompressor()
+        self._test_decompressor(lzd, cdata, lzma.CHECK_NONE)
+
+    @requires_mt_decoder
+    def test_decompressor_threads(self):
+        lzd = LZMADecompressor(threads=2)
+        self._test_decompressor(lzd, COMPRESSED_XZ, lzma.CHECK_CRC64)
+
+        lzd = LZMADecompressor(lzma.FORMAT_XZ, threads=0)
+        self._test_decompressor(lzd, COMPRESSED_XZ, lzma.CHECK_CRC64)
+
+        # FORMAT_AUTO still detects .lzma input when threads are requested.
+        lzd = LZMADecompressor(threads=2)
+        self._test_decompressor(lzd, COMPRESSED_ALONE, lzma.CHECK_NONE)
+
+        lzd = LZMADecompressor(threads=2)
+        self.assertEqual(lzd.decompress(b""), b"")
+        self._test_decompressor(lzd, COMPRESSED_XZ + b"extra",
+                                lzma.CHECK_CRC64, unused_data=b"extra")
+
+    @requires_mt_encoder
+    @requires_mt_decoder
+    def test_roundtrip_xz_threads_multiblock(self):
+        lzc = LZMACompressor(threads=2, block_size=256)
+        cdata = lzc.compress(INPUT) + lzc.flush()
+        lzd = LZMADecompressor(threads=4)
+        out = []
+        for i in range(0, len(cdata), 10):
+            out.append(lzd.decompress(cdata[i:i+10]))
+        self.assertEqual(b"".join(out), INPUT)
+        self.assertTrue(lzd.eof)
+
+    @requires_mt_encoder
+    def test_compressor_block_size(self):
+        # A block_size without threads still splits the output into
+        # blocks, with their sizes recorded in the block headers.
+        lzc = LZMACompressor(block_size=1000)
+        cdata = lzc.compress(INPUT) + lzc.flush()
+        self.assertEqual(lzma.decompress(cdata), INPUT)
+        index = lzma.read_index(BytesIO(cdata))
+        self.assertEqual(index.block_count, -(-len(INPUT) // 1000))
+        self.assertEqual(set(index.block_uncompressed_sizes[:-1]),
+                         set([1000]))
+        self.assertEqual(lzma.compress(INPUT, block_size=1000), cdata)
+        self.assertRaises(ValueError, lzc.flush, lzma.FLUSH_SYNC)
+
+    def test_bad_threads_args(self):
+        self.assertRaises(TypeError, LZMACompressor, threads="4")
+        self.assertRaises(ValueError, LZMACompressor, threads=-1)
+        self.assertRaises(ValueError, LZMACompressor,
+                          format=lzma.FORMAT_ALONE, block_size=1 << 20)
+        self.assertRaises(ValueError, LZMACompressor,
+                          format=lzma.FORMAT_ALONE, threads=2)
+        self.assertRaises(ValueError, LZMACompressor, format=lzma.FORMAT_RAW,
+                          threads=2, filters=FILTERS_RAW_1)
+
+        self.assertRaises(TypeError, LZMADecompressor, threads="4")
+        self.assertRaises(ValueError, LZMADecompressor, threads=-1)
+        self.assertRaises(ValueError, LZMADecompressor,
+                          format=lzma.FORMAT_ALONE, threads=2)
+        self.assertRaises(ValueError, LZMADecompressor,
+                          format=lzma.FORMAT_RAW, threads=2,
+                          filters=FILTERS_RAW_1)
+
     # LZMADecompressor intentionally does not handle concatenated streams.
 
     def test_decompressor_multistream(self):
@@ -218,6 +555,223 @@ class CompressorDecompressorTestCase(unittest.TestCase):
         self._test_decompressor(lzd, COMPRESSED_XZ + COMPRESSED_ALONE,
                                 lzma.CHECK_CRC64, unused_data=COMPRESSED_ALONE)
 
+    # Test reusing compressor and decompressor objects.
+
+    def test_compressor_reset(self):
+        lzc = LZMACompressor(check=lzma.CHECK_SHA256, preset=1)
+        expected = lzma.compress(INPUT, check=lzma.CHECK_SHA256, preset=1)
+        self.assertEqual(lzc.compress(INPUT) + lzc.flush(), expected)
+        lzc.reset()
+        self.assertEqual(lzc.compress(INPUT) + lzc.flush(), expected)
+        self.assertRaises(ValueError, lzc.compress, INPUT)
+        # Resetting part-way through a stream discards what came before.
+        lzc.reset()
+        lzc.compress(b"discarded")
+        lzc.reset()
+        self.assertEqual(lzc.compress(INPUT) + lzc.flush(), expected)
+
+        lzc = LZMACompressor(lzma.FORMAT_RAW, filters=FILTERS_RAW_4)
+        cdata = lzc.compress(INPUT) + lzc.flush()
+        lzc.reset()
+        self.assertEqual(lzc.compress(INPUT) + lzc.flush(), cdata)
+
+    # Test flushing part-way through a stream.
+
+    def _test_flush_modes(self, lzc, lzd, modes):
+        # Every flush makes all the data so far decodable.
+        out = []
+        for i, mode in enumerate(modes):
+            piece = INPUT[i * 100:(i + 1) * 100]
+            cdata = lzc.compress(piece) + lzc.flush(mode)
+            out.append(lzd.decompress(cdata))
+            self.assertEqual(out[-1], piece)
+        self.assertFalse(lzd.eof)
+        out.append(lzd.decompress(lzc.compress(INPUT[len(modes) * 100:]) +
+                                  lzc.flush()))
+        self.assertTrue(lzd.eof)
+        self.assertEqual(b"".join(out), INPUT)
+
+    def test_compressor_flush_modes(self):
+        modes = [lzma.FLUSH_SYNC, lzma.FLUSH_FULL, lzma.FLUSH_BLOCK,
+                 lzma.FLUSH_SYNC]
+        self._test_flush_modes(LZMACompressor(), LZMADecompressor(), modes)
+        self._test_flush_modes(
+            LZMACompressor(lzma.FORMAT_RAW, filters=FILTERS_RAW_1),
+            LZMADecompressor(lzma.FORMAT_RAW, filters=FILTERS_RAW_1),
+            [lzma.FLUSH_SYNC] * 3)
+
+        # Only full flushes start new blocks.
+        lzc = LZMACompressor()
+        cdata = lzc.compress(INPUT[:100]) + lzc.flush(lzma.FLUSH_SYNC)
+        cdata += lzc.compress(INPUT[100:200]) + lzc.flush(lzma.FLUSH_FULL)
+        cdata += lzc.compress(INPUT[200:]) + lzc.flush(lzma.FLUSH_FINISH)
+        self.assertEqual(lzma.read_index(BytesIO(cdata)).block_count, 2)
+        self.assertRaises(ValueError, lzc.flush, lzma.FLUSH_SYNC)
+
+    @requires_mt_encoder
+    def test_compressor_flush_modes_threads(self):
+        lzc = LZMACompressor(threads=2, block_size=4096)
+        self.assertRaises(ValueError, lzc.flush, lzma.FLUSH_SYNC)
+        self._test_flush_modes(lzc, LZMADecompressor(), [lzma.FLUSH_FULL] * 2)
+        # FLUSH_BLOCK only guarantees a block boundary.
+        lzc.reset()
+        cdata = lzc.compress(INPUT[:100]) + lzc.flush(lzma.FLUSH_BLOCK)
+        cdata += lzc.compress(INPUT[100:]) + lzc.flush()
+        self.assertEqual(lzma.decompress(cdata), INPUT)
+        index = lzma.read_index(BytesIO(cdata))
+        self.assertEqual(index.block_uncompressed_sizes[0], 100)
+
+    def test_compressor_flush_bad_args(self):
+        lzc = LZMACompressor()
+        self.assertRaises(ValueError, lzc.flush, 42)
+        self.assertRaises(TypeError, lzc.flush, "sync")
+        lzc = LZMACompressor(lzma.FORMAT_ALONE)
+        for mode in (lzma.FLUSH_SYNC, lzma.FLUSH_FULL, lzma.FLUSH_BLOCK):
+            self.assertRaises(ValueError, lzc.flush, mode)
+        lzc = LZMACompressor(lzma.FORMAT_RAW, filters=FILTERS_RAW_1)
+        self.assertRaises(ValueError, lzc.flush, lzma.FLUSH_FULL)
+        # The compressor is still usable after a rejected flush mode.
+        cdata = lzc.compress(INPUT) + lzc.flush()
+        self.assertEqual(lzma.decompress(cdata, lzma.FORMAT_RAW,
+                                         filters=FILTERS_RAW_1), INPUT)
+
+    def test_compressor_flush_sync_filters(self):
+        # The BCJ filters and LZMA1 do not support FLUSH_SYNC, but delta
+        # does.
+        filters_lzma1 = [{"id": lzma.FILTER_LZMA1}]
+        for format, filters, ok in [
+                (lzma.FORMAT_XZ, FILTERS_RAW_2, True),
+                (lzma.FORMAT_XZ, FILTERS_RAW_3, False),
+                (lzma.FORMAT_XZ, FILTERS_RAW_4, False),
+                (lzma.FORMAT_XZ, lzma.FilterChain(FILTERS_RAW_4), False),
+                (lzma.FORMAT_RAW, FILTERS_RAW_2, True),
+                (lzma.FORMAT_RAW, FILTERS_RAW_4, False),
+                (lzma.FORMAT_RAW, filters_lzma1, False)]:
+            lzc = LZMACompressor(format, filters=filters)
+            cdata = lzc.compress(INPUT[:100])
+            if ok:
+                cdata += lzc.flush(lzma.FLUSH_SYNC)
+            else:
+                self.assertRaises(ValueError, lzc.flush, lzma.FLUSH_SYNC)
+            cdata += lzc.compress(INPUT[100:]) + lzc.flush()
+            self.assertEqual(lzma.decompress(cdata, format, filters=(
+                filters if format == lzma.FORMAT_RAW else None)), INPUT)
+            # Full flushes end the block, so any filter chain can do them.
+            if format == lzma.FORMAT_XZ:
+                lzc.reset()
+                cdata = (lzc.compress(INPUT[:100]) +
+                         lzc.flush(lzma.FLUSH_FULL) +
+                         lzc.compress(INPUT[100:]) + lzc.flush())
+                self.assertEqual(lzma.decompress(cdata), INPUT)
+
+    def test_decompressor_reset(self):
+        lzd = LZMADecompressor()
+        self._test_decompressor(lzd, COMPRESSED_XZ + b"extra",
+                                lzma.CHECK_CRC64, unused_data=b"extra")
+        lzd.reset()
+        self.assertFalse(lzd.eof)
+        self.assertTrue(lzd.needs_input)
+        self.assertEqual(lzd.unused_data, b"")
+        self.assertEqual(lzd.check, lzma.CHECK_UNKNOWN)
+        self._test_decompressor(lzd, COMPRESSED_ALONE, lzma.CHECK_NONE)
+
+        # Resetting discards buffered input and recovers from errors.
+        lzd.reset()
+        self.assertEqual(lzd.decompress(COMPRESSED_XZ, 10), INPUT[:10])
+        lzd.reset()
+        self.assertRaises(LZMAError, lzd.decompress, COMPRESSED_RAW_1)
+        lzd.reset()
+        self._test_decompressor(lzd, COMPRESSED_XZ, lzma.CHECK_CRC64)
+
+        lzd = LZMADecompressor(lzma.FORMAT_RAW, filters=FILTERS_RAW_1)
+        self._test_decompressor(lzd, COMPRESSED_RAW_1, lzma.CHECK_NONE)
+        lzd.reset()
+        self._test_decompressor(lzd, COMPRESSED_RAW_1, lzma.CHECK_NONE)
+
+    @requires_mt_decoder
+    def test_decompressor_reset_threads(self):
+        lzd = LZMADecompressor(threads=2)
+        self._test_decompressor(lzd, COMPRESSED_XZ, lzma.CHECK_CRC64)
+        lzd.reset()
+        self._test_decompressor(lzd, COMPRESSED_ALONE, lzma.CHECK_NONE)
+        lzd.reset()
+        self._test_decompressor(lzd, COMPRESSED_XZ, lzma.CHECK_CRC64)
+
+    def test_decompressor_concatenated(self):
+        data = COMPRESSED_XZ + COMPRESSED_ALONE + lzma.compress(b"")
+        lzd = LZMADecompressor(concatenated=True)
+        self.assertEqual(lzd.decompress(data), INPUT * 2)
+        self.assertTrue(lzd.eof)
+        self.assertTrue(lzd.needs_input)
+        self.assertEqual(lzd.unused_data, b"")
+        # At a stream boundary, more input starts another stream.
+        self.assertEqual(lzd.decompress(b""), b"")
+        self.assertEqual(lzd.decompress(COMPRESSED_XZ), INPUT)
+        self.assertEqual(lzd.check, lzma.CHECK_CRC64)
+
+        lzd = LZMADecompressor(concatenated=True)
+        out = [lzd.decompress(data, 1000)]
+        while not lzd.needs_input:
+            out.append(lzd.decompress(b"", 1000))
+        self.assertEqual(b"".join(out), INPUT * 2)
+        self.assertTrue(lzd.eof)
+
+    def test_decompressor_concatenated_trailing_junk(self):
+        lzd = LZMADecompressor(concatenated=True)
+        self.assertEqual(lzd.decompress(COMPRESSED_XZ * 2 + COMPRESSED_BOGUS),
+                         INPUT * 2)
+        self.assertTrue(lzd.eof)
+        self.assertEqual(lzd.unused_data, COMPRESSED_BOGUS)
+        self.assertRaises(EOFError, lzd.decompress, COMPRESSED_XZ)
+
+        # Junk arriving a byte at a time is saved from its first byte.
+        data = COMPRESSED_XZ + b"\xfd7zXZ" + COMPRESSED_BOGUS
+        lzd = LZMADecompressor(concatenated=True)
+        out = []
+        for i in range(len(data)):
+            if lzd.unused_data:
+                break
+            out.append(lzd.decompress(data[i:i + 1]))
+        self.assertEqual(b"".join(out), INPUT)
+        self.assertEqual(lzd.unused_data, data[len(COMPRESSED_XZ):i])
+        self.assertGreater(len(lzd.unused_data), 6)
+
+        # An error in the first stream is still raised.
+        lzd = LZMADecompressor(concatenated=True)
+        self.assertRaises(LZMAError, lzd.decompress, COMPRESSED_BOGUS)
+
+    def test_decompressor_concatenated_corrupt_stream(self):
+        # A following stream that fails after producing some output, in
+        # the same call, is dropped along with that output.
+        corrupt = bytearray(COMPRESSED_XZ)
+        corrupt[1000] ^= 0xff
+        corrupt = bytes(corrupt)
+        data = COMPRESSED_XZ + corrupt
+        for bufsize in (0, 1 << 20):
+            lzd = LZMADecompressor(concatenated=True)
+            self.assertEqual(lzd.decompress(data, bufsize=bufsize), INPUT)
+            self.assertTrue(lzd.eof)
+            self.assertEqual(lzd.unused_data, corrupt)
+        lzd = LZMADecompressor(concatenated=True)
+        buf = bytearray(1 << 20)
+        self.assertEqual(lzd.decompress_into(data, buf), len(INPUT))
+        self.assertEqual(lzd.unused_data, corrupt)
+        self.assertEqual(lzma.decompress(data), INPUT)
+        with LZMAFile(BytesIO(data)) as f:
+            self.assertEqual(f.read(), INPUT)
+
+    def test_decompressor_concatenated_bad_args(self):
+        with self.assertRaises(ValueError):
+            LZMADecompressor(lzma.FORMAT_RAW, filters=FILTERS_RAW_1,
+                             concatenated=True)
+
+    @requires_mt_decoder
+    def test_decompressor_concatenated_threads(self):
+        lzd = LZMADecompressor(threads=2, concatenated=True)
+        data = COMPRESSED_XZ + COMPRESSED_ALONE + COMPRESSED_XZ
+        self.assertEqual(lzd.decompress(data + COMPRESSED_BOGUS), INPUT * 3)
+        self.assertEqual(lzd.unused_data, COMPRESSED_BOGUS)
+
     # Test with inputs larger than 4GiB.
 
     @bigmemtest(size=_4G + 100, memuse=2)
@@ -346,6 +900,19 @@ class CompressDecompressFunctionTestCase(unittest.TestCase):
                           COMPRESSED_XZ, format=lzma.FORMAT_RAW,
                           filters=FILTERS_RAW_1)
 
+    def test_decompress_forged_index(self):
+        # The sizes in the index are not trusted to size the output.
+        forged = _forge_xz_size(1 << 55)
+        self.assertEqual(lzma._size_hint(forged, lzma.FORMAT_XZ), 0)
+        self.assertEqual(lzma._size_hint(COMPRESSED_XZ, lzma.FORMAT_XZ),
+                         len(INPUT))
+        self.assertEqual(lzma._size_hint(COMPRESSED_XZ, lzma.FORMAT_XZ,
+                                         memlimit=100), 0)
+        pool = lzma.CompressorPool()
+        for memlimit in (None, 1 << 20):
+            self.assertRaises(LZMAError, pool.decompress, forged,
+                              memlimit=memlimit)
+
     # Test that compress()->decompress() preserves the input data.
 
     def test_roundtrip(self):
@@ -365,12 +932,142 @@ class CompressDecompressFunctionTestCase(unittest.TestCase):
         ddata = lzma.decompress(cdata, lzma.FORMAT_RAW, filters=FILTERS_RAW_4)
         self.assertEqual(ddata, INPUT)
 
+    @requires_mt_encoder
+    def test_roundtrip_threads(self):
+        cdata = lzma.compress(INPUT, threads=2, block_size=1024)
+        self.assertEqual(lzma.decompress(cdata), INPUT)
+        cdata = lzma.compress(INPUT, threads=0, preset=1)
+        self.assertEqual(lzma.decompress(cdata), INPUT)
+
+    @requires_mt_decoder
+    def test_decompress_threads(self):
+        ddata = lzma.decompress(COMPRESSED_XZ + COMPRESSED_ALONE, threads=2)
+        self.assertEqual(ddata, INPUT * 2)
+        ddata = lzma.decompress(COMPRESSED_XZ, lzma.FORMAT_XZ, threads=0)
+        self.assertEqual(ddata, INPUT)
+
     # Unlike LZMADecompressor, decompress() *does* handle concatenated streams.
 
     def test_decompress_multistream(self):
         ddata = lzma.decompress(COMPRESSED_XZ + COMPRESSED_ALONE)
         self.assertEqual(ddata, INPUT * 2)
 
+    def test_decompress_multistream_xz(self):
+        # The stream sizes recorded in the indexes are used as size hints.
+        empty = lzma.compress(b"")
+        ddata = lzma.decompress(COMPRESSED_XZ + empty + COMPRESSED_XZ)
+        self.assertEqual(ddata, INPUT * 2)
+        ddata = lzma.decompress(bytearray(COMPRESSED_XZ * 2))
+        self.assertEqual(ddata, INPUT * 2)
+        ddata = lzma.decompress(COMPRESSED_XZ + b"\0" * 4 + COMPRESSED_XZ)
+        self.assertEqual(ddata, INPUT)
+
+    def test_decompress_bytearray_memoryview(self):
+        ddata = lzma.decompress(bytearray(COMPRESSED_XZ))
+        self.assertEqual(ddata, INPUT)
+        ddata = lzma.decompress(memoryview(COMPRESSED_XZ * 2))
+        self.assertEqual(ddata, INPUT * 2)
+
+    def test__compress_buffer(self):
+        # The single-call compressor gives the same output as LZMACompressor.
+        for kwargs in ({}, {"check": lzma.CHECK_NONE, "preset": 1},
+                       {"format": lzma.FORMAT_ALONE},
+                       {"format": lzma.FORMAT_RAW, "filters": FILTERS_RAW_4}):
+            lzc = LZMACompressor(**kwargs)
+            expected = lzc.compress(INPUT) + lzc.flush()
+            self.assertEqual(lzma._compress_buffer(INPUT, **kwargs), expected)
+        self.assertEqual(lzma._compress_buffer(b""), lzma.compress(b""))
+        self.assertRaises(ValueError, lzma._compress_buffer, INPUT,
+                          format=lzma.FORMAT_RAW)
+        self.assertRaises(ValueError, lzma._compress_buffer, INPUT,
+                          format=lzma.FORMAT_ALONE, threads=2)
+
+    def test__decompress_buffer(self):
+        empty = lzma.compress(b"")
+        self.assertEqual(lzma._decompress_buffer(COMPRESSED_XZ), INPUT)
+        self.assertEqual(lzma._decompress_buffer(COMPRESSED_XZ + empty +
+                                                 COMPRESSED_XZ), INPUT * 2)
+        self.assertEqual(lzma._decompress_buffer(empty), b"")
+        # Anything but a plain series of .xz streams is left to the caller.
+        for data in (b"", COMPRESSED_ALONE, COMPRESSED_XZ[:-1],
+                     COMPRESSED_XZ + COMPRESSED_BOGUS,
+                     COMPRESSED_XZ + b"\0" * 4 + COMPRESSED_XZ):
+            self.assertIsNone(lzma._decompress_buffer(data))
+        # Output larger than memlimit is left to the caller, whose
+        # decompressor enforces the limit.
+        self.assertIsNone(lzma._decompress_buffer(COMPRESSED_XZ,
+                                                  memlimit=1024))
+        self.assertRaises(LZMAError, lzma.decompress, COMPRESSED_XZ,
+                          memlimit=1024)
+        # So is data whose index gives an implausible size.
+        forged = _forge_xz_size(1 << 55)
+        self.assertIsNone(lzma._decompress_buffer(forged))
+        for memlimit in (None, 1 << 20):
+            self.assertRaises(LZMAError, lzma.decompress, forged,
+                              memlimit=memlimit)
+        corrupt = bytearray(COMPRESSED_XZ)
+        corrupt[100] ^= 0xff
+        self.assertRaises(LZMAError, lzma._decompress_buffer, bytes(corrupt))
+
+    def test_compress_many(self):
+        items = [INPUT, b"", INPUT[:100], bytearray(INPUT[:10]),
+                 memoryview(INPUT)[5:500]]
+        for kwargs in ({}, {"preset": 1, "check": lzma.CHECK_SHA256},
+                       {"format": lzma.FORMAT_ALONE},
+                       {"format": lzma.FORMAT_RAW, "filters": FILTERS_RAW_1}):
+            expected = [lzma.compress(x, **kwargs) for x in items]
+            self.assertEqual(lzma.compress_many(items, **kwargs), expected)
+            self.assertEqual(lzma.compress_many(items, threads=3, **kwargs),
+                             expected)
+        self.assertEqual(lzma.compress_many([]), [])
+        self.assertEqual(lzma.compress_many(iter([INPUT]), threads=0),
+                         [COMPRESSED_XZ])
+
+    def test_compress_many_bad_args(self):
+        self.assertRaises(TypeError, lzma.compress_many, 42)
+        self.assertRaises(TypeError, lzma.compress_many, [INPUT, 42])
+        self.assertRaises(ValueError, lzma.compress_many, [INPUT], threads=-1)
+        self.assertRaises(ValueError, lzma.compress_many, [INPUT],
+                          format=lzma.FORMAT_RAW)
+        self.assertRaises(ValueError, lzma.compress_many, [INPUT],
+                          preset=1, filters=FILTERS_RAW_1)
+        self.assertRaises(LZMAError, lzma.compress_many, [INPUT], preset=10)
+
+    def test_decompress_many(self):
+        items = [COMPRESSED_XZ, COMPRESSED_ALONE, lzma.compress(b""),
+                 bytearray(COMPRESSED_XZ)]
+        for threads in (1, 2, 0):
+            self.assertEqual(lzma.decompress_many(items, threads=threads),
+                             [INPUT, INPUT, b"", INPUT])
+        self.assertEqual(lzma.decompress_many([COMPRESSED_RAW_1],
+                                              lzma.FORMAT_RAW,
+                                              filters=FILTERS_RAW_1),
+                         [INPUT])
+        self.assertEqual(lzma.decompress_many([]), [])
+
+    def test_decompress_many_multistream(self):
+        # Items that decompress() handles specially give the same results.
+        items = [COMPRESSED_XZ + COMPRESSED_ALONE,
+                 COMPRESSED_XZ + COMPRESSED_BOGUS, COMPRESSED_XZ]
+        self.assertEqual(lzma.decompress_many(items, threads=2),
+                         [INPUT * 2, INPUT, INPUT])
+
+    def test_decompress_many_bad_input(self):
+        self.assertRaises(LZMAError, lzma.decompress_many,
+                          [COMPRESSED_XZ, COMPRESSED_BOGUS])
+        self.assertRaises(LZMAError, lzma.decompress_many,
+                          [COMPRESSED_XZ[:128]])
+        self.assertRaises(LZMAError, lzma.decompress_many, [COMPRESSED_XZ],
+                          lzma.FORMAT_ALONE)
+        self.assertRaises(LZMAError, lzma.decompress_many, [COMPRESSED_XZ],
+                          memlimit=1024)
+        self.assertRaises(ValueError, lzma.decompress_many, [COMPRESSED_XZ],
+                          threads=-1)
+        self.assertRaises(ValueError, lzma.decompress_many, [COMPRESSED_XZ],
+                          lzma.FORMAT_RAW)
+        self.assertRaises(ValueError, lzma.decompress_many, [COMPRESSED_XZ],
+                          format=42)
+
     # Test robust handling of non-LZMA data following the compressed stream(s).
 
     def test_decompress_trailing_junk(self):
@@ -381,6 +1078,22 @@ class CompressDecompressFunctionTestCase(unittest.TestCase):
         ddata = lzma.decompress(COMPRESSED_XZ * 3 + COMPRESSED_BOGUS)
         self.assertEqual(ddata, INPUT * 3)
 
+class CountingBytesIO(BytesIO):
+    """BytesIO that records how many bytes have been read from it."""
+
+    bytes_read = 0
+
+    def __init__(self, *args):
+        BytesIO.__init__(self, *args)
+        self.read_sizes = []
+
+    def read(self, size=-1):
+        data = BytesIO.read(self, size)
+        self.bytes_read += len(data)
+        self.read_sizes.append(size)
+        return data
+
+
 class TempFile:
     """Context manager - creates a file, and deletes it on __exit__."""
 
@@ -693,6 +1406,17 @@ class FileTestCase(unittest.TestCase):
         with LZMAFile(BytesIO(COMPRESSED_RAW_3 * 4),
                       format=lzma.FORMAT_RAW, filters=FILTERS_RAW_3) as f:
             self.assertEqual(f.read(), INPUT * 4)
+        with LZMAFile(BytesIO(COMPRESSED_RAW_3 * 4), format=lzma.FORMAT_RAW,
+                      filters=lzma.FilterChain(FILTERS_RAW_3)) as f:
+            self.assertEqual(f.read(), INPUT * 4)
+
+    def test_read_bounded_output(self):
+        # Highly compressible input must not be decompressed in one go.
+        data = b"\0" * (4 * 1024 * 1024)
+        with LZMAFile(BytesIO(lzma.compress(data))) as f:
+            chunk = f.read1()
+            self.assertTrue(0 < len(chunk) <= 1024 * 1024)
+            self.assertEqual(len(f.read()) + len(chunk), len(data))
 
     def test_read_multistream_buffer_size_aligned(self):
         # Test the case where a stream boundary coincides with the end
@@ -719,6 +1443,308 @@ class FileTestCase(unittest.TestCase):
                 self.assertEqual(f.read(), INPUT)
                 self.assertEqual(f.read(), b"")
 
+    def test_read_mmap(self):
+        data = COMPRESSED_XZ * 2 + COMPRESSED_ALONE + COMPRESSED_BOGUS
+        with TempFile(TESTFN, data):
+            with LZMAFile(TESTFN, mmap=True) as f:
+                self.assertEqual(f.read(), INPUT * 3)
+                self.assertEqual(f.read(), b"")
+            with LZMAFile(TESTFN, mmap=True, buffer_size=100,
+                          prefetch=True) as f:
+                self.assertEqual(f.read(10), INPUT[:10])
+                f.seek(len(INPUT) + 5)
+                self.assertEqual(f.read(10), INPUT[5:15])
+                self.assertEqual(f.read(), INPUT[15:] + INPUT)
+            with open(TESTFN, "rb") as raw:
+                raw.seek(len(COMPRESSED_XZ))
+                with lzma.open(raw, "rt", mmap=True,
+                               encoding="ascii") as f:
+                    self.assertEqual(f.read(), INPUT.decode("ascii") * 2)
+                self.assertFalse(raw.closed)
+        with TempFile(TESTFN, COMPRESSED_XZ * 3):
+            with LZMAFile(TESTFN, mmap=True) as f:
+                f.seek(len(INPUT) * 2 + 10)
+                self.assertEqual(f.read(10), INPUT[10:20])
+                f.seek(-10, 2)
+                self.assertEqual(f.read(), INPUT[-10:])
+        for data in (b"", COMPRESSED_XZ[:128]):
+            with TempFile(TESTFN, data):
+                with LZMAFile(TESTFN, mmap=True) as f:
+                    self.assertRaises(EOFError, f.read)
+
+    def test_read_mmap_bad_args(self):
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w", mmap=True)
+        self.assertRaises(UnsupportedOperation, LZMAFile,
+                          BytesIO(COMPRESSED_XZ), mmap=True)
+
+    @requires_mt_encoder
+    def test_read_block_cache(self):
+        data = INPUT * 4
+        cdata = lzma.compress(data, block_size=1000) + COMPRESSED_XZ
+        cache = lzma.BlockCache()
+        with LZMAFile(BytesIO(cdata), block_cache=cache) as f:
+            f.seek(2500)
+            self.assertEqual(f.read(100), data[2500:2600])
+            self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 1, 1))
+            self.assertEqual(cache.size, 1000)
+            f.seek(2100)
+            self.assertEqual(f.read(10), data[2100:2110])
+            self.assertEqual(cache.hits, 1)
+            # Reading carries on past the cached block, and into the
+            # next stream.
+            self.assertEqual(f.read(), data[2110:] + INPUT)
+            f.seek(len(data) - 5)
+            self.assertEqual(f.read(), data[-5:] + INPUT)
+            f.seek(len(data) + 5)
+            self.assertEqual(f.read(5), INPUT[5:10])
+            f.seek(-5, 2)
+            self.assertEqual(f.read(), INPUT[-5:])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        # Files opened from the same path share their cached blocks.
+        cache = lzma.BlockCache()
+        with TempFile(TESTFN, cdata):
+            with LZMAFile(TESTFN, block_cache=cache) as f:
+                f.seek(3000)
+                self.assertEqual(f.read(10), data[3000:3010])
+            with lzma.open(TESTFN, block_cache=cache, mmap=True) as f:
+                f.seek(3500)
+                self.assertEqual(f.read(10), data[3500:3510])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        with LZMAFile(BytesIO(cdata), block_cache=cache) as f:
+            f.seek(3000)
+            self.assertEqual(f.read(10), data[3000:3010])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    @requires_mt_encoder
+    def test_read_block_cache_corrupt(self):
+        cdata = bytearray(lzma.compress(INPUT * 4, block_size=1000))
+        index = lzma.read_index(BytesIO(bytes(cdata)))
+        cdata[index.block_compressed_offsets[1] + 20] ^= 0xff
+        with LZMAFile(BytesIO(bytes(cdata)),
+                      block_cache=lzma.BlockCache()) as f:
+            self.assertRaises(LZMAError, f.seek, 1500)
+
+    @requires_mt_encoder
+    def test_read_block_cache_rewritten_file(self):
+        # A file rewritten with the same size is told apart by its
+        # modification time, to the nanosecond where the OS records it.
+        rng = random.Random(0)
+        old, new = [bytes(bytearray(rng.getrandbits(8) for i in range(3000)))
+                    for j in range(2)]
+        cold = lzma.compress(old, block_size=1000)
+        cnew = lzma.compress(new, block_size=1000)
+        self.assertEqual(len(cold), len(cnew))
+        cache = lzma.BlockCache()
+        with TempFile(TESTFN, cold):
+            with LZMAFile(TESTFN, block_cache=cache) as f:
+                f.seek(1500)
+                self.assertEqual(f.read(10), old[1500:1510])
+            st = os.stat(TESTFN)
+            with open(TESTFN, "r+b") as raw:
+                raw.write(cnew)
+            if hasattr(st, "st_mtime_ns"):
+                os.utime(TESTFN, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+            else:
+                os.utime(TESTFN, (st.st_atime, st.st_mtime + 1))
+            with LZMAFile(TESTFN, block_cache=cache) as f:
+                f.seek(1500)
+                self.assertEqual(f.read(10), new[1500:1510])
+        self.assertEqual(cache.hits, 0)
+
+    @requires_mt_encoder
+    def test_read_block_cache_large_blocks(self):
+        # Blocks larger than the cache are not decompressed whole.
+        data = INPUT * 4
+        cdata = lzma.compress(data, block_size=1000)
+        cache = lzma.BlockCache(999)
+        with LZMAFile(BytesIO(cdata), block_cache=cache) as f:
+            f.seek(2500)
+            self.assertEqual(f.read(100), data[2500:2600])
+            f.seek(1500)
+            self.assertEqual(f.read(10), data[1500:1510])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 0, 0))
+
+    def test_read_block_cache_bad_args(self):
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w",
+                          block_cache=lzma.BlockCache())
+
+    @requires_mt_encoder
+    def test_read_at(self):
+        data = INPUT * 4
+        cdata = lzma.compress(data, block_size=1000) + COMPRESSED_XZ
+        whole = data + INPUT
+        with TempFile(TESTFN, cdata):
+            for kwargs in [{}, {"mmap": True},
+                           {"block_cache": lzma.BlockCache()}]:
+                with LZMAFile(TESTFN, **kwargs) as f:
+                    self.assertEqual(f.read(10), whole[:10])
+                    for offset, size in [(0, 10), (990, 20), (500, 2500),
+                                         (len(data) - 5, 10),
+                                         (len(whole) - 5, 100),
+                                         (len(whole), 10), (100, 0)]:
+                        self.assertEqual(f.read_at(offset, size),
+                                         whole[offset:offset + size])
+                    # The file position is left alone.
+                    self.assertEqual(f.tell(), 10)
+                    self.assertEqual(f.read(10), whole[10:20])
+        with LZMAFile(BytesIO(cdata)) as f:
+            f.seek(1234)
+            self.assertEqual(f.read_at(2900, 200), whole[2900:3100])
+            self.assertEqual(f.read(10), whole[1234:1244])
+
+    @requires_mt_encoder
+    def test_read_at_threads(self):
+        import threading
+        data = bytes(bytearray(random.getrandbits(8) for i in range(5000)))
+        cdata = lzma.compress(data * 4, block_size=2000)
+        errors = []
+        with TempFile(TESTFN, cdata):
+            with LZMAFile(TESTFN) as f:
+                def run(n):
+                    rng = random.Random(n)
+                    try:
+                        for i in range(50):
+                            offset = rng.randrange(20000)
+                            size = rng.randrange(3000)
+                            expected = (data * 4)[offset:offset + size]
+                            if f.read_at(offset, size) != expected:
+                                errors.append((offset, size))
+                    except Exception as e:
+                        errors.append(e)
+                threads = [threading.Thread(target=run, args=(n,))
+                           for n in range(4)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+        self.assertEqual(errors, [])
+
+    @requires_mt_encoder
+    def test_read_at_corrupt(self):
+        cdata = bytearray(lzma.compress(INPUT * 4, block_size=1000))
+        index = lzma.read_index(BytesIO(bytes(cdata)))
+        cdata[index.block_compressed_offsets[1] + 20] ^= 0xff
+        with LZMAFile(BytesIO(bytes(cdata))) as f:
+            self.assertEqual(f.read_at(0, 100), (INPUT * 4)[:100])
+            # The check is verified when the data reaches the block's end.
+            self.assertRaises(LZMAError, f.read_at, 1500, 500)
+            self.assertRaises(LZMAError, f.read_at, 1500, 2000)
+
+    @requires_mt_encoder
+    def test_read_range(self):
+        data = bytes(bytearray(random.getrandbits(8) for i in range(3000)))
+        data = data * 4 + INPUT * 4
+        cdata = lzma.compress(data, block_size=1000) + COMPRESSED_XZ
+        whole = data + INPUT
+        with TempFile(TESTFN, cdata):
+            for kwargs in [{}, {"mmap": True},
+                           {"block_cache": lzma.BlockCache()}]:
+                with LZMAFile(TESTFN, **kwargs) as f:
+                    self.assertEqual(f.read(10), whole[:10])
+                    for offset, size in [(0, len(whole)), (1000, 3000),
+                                         (990, 20), (1500, 10000),
+                                         (len(whole) - 5, 100),
+                                         (len(whole), 10), (100, 0)]:
+                        for threads in (0, 1, 3):
+                            result = f.read_range(offset, size, threads)
+                            self.assertIsInstance(result, bytearray)
+                            self.assertEqual(result,
+                                             whole[offset:offset + size])
+                    self.assertEqual(f.tell(), 10)
+                    self.assertEqual(f.read(10), whole[10:20])
+            self.assertEqual(lzma.decompress_range(TESTFN, 2500, 5000, 2),
+                             whole[2500:7500])
+        self.assertEqual(lzma.decompress_range(BytesIO(cdata), 0, 100),
+                         whole[:100])
+
+    @requires_mt_encoder
+    def test_read_range_corrupt(self):
+        cdata = bytearray(lzma.compress(INPUT * 8, block_size=1000))
+        index = lzma.read_index(BytesIO(bytes(cdata)))
+        cdata[index.block_compressed_offsets[3] + 20] ^= 0xff
+        with LZMAFile(BytesIO(bytes(cdata))) as f:
+            self.assertEqual(f.read_range(0, 2000, 2), (INPUT * 8)[:2000])
+            for threads in (1, 2):
+                self.assertRaises(LZMAError, f.read_range, 0, 8000, threads)
+                self.assertRaises(LZMAError, f.read_range, 3500, 500, threads)
+
+    def test_read_range_bad_args(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            self.assertRaises(ValueError, f.read_range, 0, 10, -1)
+            self.assertRaises(ValueError, f.read_range, -1, 10)
+        with LZMAFile(BytesIO(COMPRESSED_ALONE)) as f:
+            self.assertRaises(UnsupportedOperation, f.read_range, 0, 10)
+        self.assertRaises(UnsupportedOperation, lzma.decompress_range,
+                          BytesIO(COMPRESSED_ALONE), 0, 10)
+
+    @requires_mt_encoder
+    def test_read_at_block_end(self):
+        # When the data ends on the last byte of a block, the rest of the
+        # block is still decoded, and its integrity check verified.
+        data = INPUT * 4
+        cdata = lzma.compress(data, block_size=1000)
+        index = lzma.read_index(BytesIO(cdata))
+        for kwargs in [{}, {"buffer_size": 1 << 20},
+                       {"block_cache": lzma.BlockCache()}]:
+            with LZMAFile(BytesIO(cdata), **kwargs) as f:
+                self.assertEqual(f.read_at(500, 500), data[500:1000])
+                self.assertEqual(f.read_range(0, 3000, 2), data[:3000])
+        # Corrupt the CRC64 at the end of block 1.
+        corrupt = bytearray(cdata)
+        corrupt[index.block_compressed_offsets[1] +
+                index.block_unpadded_sizes[1] - 1] ^= 0xff
+        for kwargs in [{}, {"buffer_size": 1 << 20},
+                       {"block_cache": lzma.BlockCache()}]:
+            with LZMAFile(BytesIO(bytes(corrupt)), **kwargs) as f:
+                if "block_cache" not in kwargs:
+                    # Cached blocks are always decoded whole.
+                    self.assertEqual(f.read_at(1500, 499), data[1500:1999])
+                self.assertRaises(LZMAError, f.read_at, 1500, 500)
+                self.assertRaises(LZMAError, f.read_range, 0, 3000, 2)
+
+    @requires_mt_encoder
+    def test_read_at_partial_block(self):
+        # Only the part of a large block up to the end of the data is
+        # decompressed, a chunk of compressed data at a time.
+        data = bytes(bytearray(random.getrandbits(8) for i in range(3000)))
+        data = data * 100
+        cdata = lzma.compress(data, block_size=len(data) // 2)
+        with LZMAFile(BytesIO(cdata), buffer_size=100,
+                      block_cache=lzma.BlockCache(1000)) as f:
+            for offset, size in [(5, 3), (1000, 100000), (149000, 2000),
+                                 (len(data) - 10, 10)]:
+                self.assertEqual(f.read_at(offset, size),
+                                 data[offset:offset + size])
+            self.assertEqual(f._block_cache.misses, 0)
+
+    def test_read_at_bad_args(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            self.assertRaises(ValueError, f.read_at, -1, 10)
+            self.assertRaises(ValueError, f.read_at, 0, -1)
+        for cdata in [COMPRESSED_ALONE, COMPRESSED_XZ + b"\0" * 4]:
+            with LZMAFile(BytesIO(cdata)) as f:
+                self.assertRaises(UnsupportedOperation, f.read_at, 0, 10)
+        with LZMAFile(BytesIO(), "w") as f:
+            self.assertRaises(UnsupportedOperation, f.read_at, 0, 10)
+        f = LZMAFile(BytesIO(COMPRESSED_XZ))
+        f.close()
+        self.assertRaises(ValueError, f.read_at, 0, 10)
+
+    def test_decompress_file(self):
+        with TempFile(TESTFN, COMPRESSED_XZ * 2 + COMPRESSED_ALONE):
+            self.assertEqual(lzma.decompress_file(TESTFN), INPUT * 3)
+            with open(TESTFN, "rb") as raw:
+                raw.seek(len(COMPRESSED_XZ) * 2)
+                self.assertEqual(lzma.decompress_file(raw), INPUT)
+                self.assertRaises(LZMAError, lzma.decompress_file, raw,
+                                  lzma.FORMAT_XZ)
+        with TempFile(TESTFN, COMPRESSED_RAW_1):
+            self.assertEqual(lzma.decompress_file(
+                TESTFN, lzma.FORMAT_RAW, filters=FILTERS_RAW_1), INPUT)
+        with TempFile(TESTFN, COMPRESSED_XZ[:128]):
+            self.assertRaises(LZMAError, lzma.decompress_file, TESTFN)
+
     def test_read_from_file_with_bytes_filename(self):
         try:
             bytes_filename = TESTFN.encode("ascii")
@@ -792,6 +1818,76 @@ class FileTestCase(unittest.TestCase):
         with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
             self.assertRaises(TypeError, f.read1, None)
 
+    def test_read_mixed_small_reads(self):
+        # Interleave the different ways of consuming buffered data.
+        with LZMAFile(BytesIO(COMPRESSED_XZ * 2)) as f:
+            blocks = []
+            buf = bytearray(7)
+            while True:
+                peeked = f.peek()
+                data = f.read(3)
+                if not data:
+                    break
+                self.assertEqual(peeked[:3], data[:len(peeked)])
+                blocks.append(data)
+                blocks.append(f.read1(5))
+                n = f.readinto(buf)
+                blocks.append(bytes(buf[:n]))
+            self.assertEqual(b"".join(blocks), INPUT * 2)
+            self.assertEqual(f.tell(), len(INPUT) * 2)
+
+    def test_readinto(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            buf = bytearray(len(INPUT) + 10)
+            self.assertEqual(f.readinto(buf), len(INPUT))
+            self.assertEqual(bytes(buf[:len(INPUT)]), INPUT)
+            self.assertEqual(f.readinto(buf), 0)
+        with LZMAFile(BytesIO(COMPRESSED_XZ * 5)) as f:
+            buf = bytearray(100)
+            blocks = []
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                blocks.append(bytes(buf[:n]))
+            self.assertEqual(b"".join(blocks), INPUT * 5)
+            self.assertEqual(f.tell(), len(INPUT) * 5)
+
+    def test_readinto_after_peek(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            f.peek()
+            buf = bytearray(len(INPUT))
+            self.assertEqual(f.readinto(buf), len(INPUT))
+            self.assertEqual(bytes(buf), INPUT)
+
+    def test_readinto_seek(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            buf = bytearray(20)
+            f.seek(100)
+            self.assertEqual(f.readinto(buf), 20)
+            self.assertEqual(bytes(buf), INPUT[100:120])
+            self.assertEqual(f.tell(), 120)
+
+    def test_readinto1(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ * 5)) as f:
+            buf = bytearray(len(INPUT) * 5)
+            blocks = []
+            while True:
+                n = f.readinto1(buf)
+                if not n:
+                    break
+                blocks.append(bytes(buf[:n]))
+            self.assertEqual(b"".join(blocks), INPUT * 5)
+
+    def test_readinto_bad_args(self):
+        f = LZMAFile(BytesIO(COMPRESSED_XZ))
+        f.close()
+        self.assertRaises(ValueError, f.readinto, bytearray(10))
+        with LZMAFile(BytesIO(), "w") as f:
+            self.assertRaises(ValueError, f.readinto, bytearray(10))
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            self.assertRaises(TypeError, f.readinto, b"read-only")
+
     def test_peek(self):
         with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
             result = f.peek()
@@ -868,6 +1964,243 @@ class FileTestCase(unittest.TestCase):
             expected = lzma.compress(INPUT)
             self.assertEqual(dst.getvalue(), expected)
 
+    @requires_mt_encoder
+    def test_write_threads(self):
+        with BytesIO() as dst:
+            with LZMAFile(dst, "w", threads=2, block_size=1024) as f:
+                f.write(INPUT)
+            self.assertEqual(lzma.decompress(dst.getvalue()), INPUT)
+
+    @requires_mt_encoder
+    def test_write_block_size(self):
+        data = INPUT * 10
+        with BytesIO() as dst:
+            with LZMAFile(dst, "w", block_size=1000) as f:
+                for start in range(0, len(data), 300):
+                    f.write(data[start:start+300])
+            cdata = dst.getvalue()
+        self.assertEqual(lzma.read_index(BytesIO(cdata)).block_count,
+                         -(-len(data) // 1000))
+        src = CountingBytesIO(cdata)
+        with LZMAFile(src, buffer_size=256) as f:
+            f.seek(len(data) - 10)
+            self.assertEqual(f.read(), data[-10:])
+        # Most of the blocks were skipped.
+        self.assertLess(src.bytes_read, len(cdata) // 2)
+        with lzma.open(BytesIO(), "wb", block_size=1000) as f:
+            f.write(data)
+
+    def test_write_flush(self):
+        with BytesIO() as dst:
+            with LZMAFile(dst, "w") as f:
+                f.write(INPUT[:100])
+                f.flush()
+                lzd = LZMADecompressor()
+                self.assertEqual(lzd.decompress(dst.getvalue()), b"")
+                f.flush(lzma.FLUSH_SYNC)
+                lzd = LZMADecompressor()
+                self.assertEqual(lzd.decompress(dst.getvalue()), INPUT[:100])
+                f.write(INPUT[100:200])
+                f.flush(lzma.FLUSH_FULL)
+                f.write(INPUT[200:])
+            self.assertEqual(lzma.decompress(dst.getvalue()), INPUT)
+
+        # FLUSH_FINISH ends the stream; writing more starts another.
+        with BytesIO() as dst:
+            with LZMAFile(dst, "w") as f:
+                f.write(INPUT)
+                f.flush(lzma.FLUSH_FINISH)
+                self.assertEqual(dst.getvalue(), lzma.compress(INPUT))
+                f.flush(lzma.FLUSH_FINISH)
+            self.assertEqual(dst.getvalue(), lzma.compress(INPUT))
+        with BytesIO() as dst:
+            with LZMAFile(dst, "w") as f:
+                f.write(INPUT)
+                f.flush(lzma.FLUSH_FINISH)
+                f.write(INPUT)
+            self.assertEqual(dst.getvalue(), lzma.compress(INPUT) * 2)
+
+    def test_write_flush_bad_args(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
+            f.flush()
+            self.assertRaises(UnsupportedOperation, f.flush,
+                              lzma.FLUSH_SYNC)
+        with LZMAFile(BytesIO(), "w", format=lzma.FORMAT_ALONE) as f:
+            self.assertRaises(ValueError, f.flush, lzma.FLUSH_SYNC)
+        # A rejected flush leaves the file intact.
+        with BytesIO() as dst:
+            with LZMAFile(dst, "w", filters=FILTERS_RAW_4) as f:
+                f.write(INPUT[:100])
+                self.assertRaises(ValueError, f.flush, lzma.FLUSH_SYNC)
+                f.write(INPUT[100:])
+            self.assertEqual(lzma.decompress(dst.getvalue()), INPUT)
+        with LZMAFile(BytesIO(), "w", pipeline=True) as f:
+            self.assertRaises(UnsupportedOperation, f.flush,
+                              lzma.FLUSH_SYNC)
+        f = LZMAFile(BytesIO(), "w")
+        f.close()
+        self.assertRaises(ValueError, f.flush, lzma.FLUSH_SYNC)
+
+    def test_write_pipeline(self):
+        # With a single block, the output is the same as usual.
+        for data in (INPUT, b""):
+            with BytesIO() as dst:
+                with LZMAFile(dst, "w", pipeline=True) as f:
+                    f.write(data)
+                self.assertEqual(dst.getvalue(), lzma.compress(data))
+
+        with BytesIO() as dst:
+            with LZMAFile(dst, "w", pipeline=True, threads=3, block_size=1000,
+                          check=lzma.CHECK_SHA256, preset=1) as f:
+                for start in range(0, len(INPUT), 300):
+                    f.write(INPUT[start:start+300])
+                f.write(bytearray(INPUT))
+                f.write(memoryview(INPUT))
+                self.assertEqual(f.tell(), len(INPUT) * 3)
+            cdata = dst.getvalue()
+        self.assertEqual(lzma.decompress(cdata), INPUT * 3)
+        index = lzma.read_index(BytesIO(cdata))
+        self.assertEqual(index.stream_count, 1)
+        self.assertEqual(index.streams[0].check, lzma.CHECK_SHA256)
+        self.assertEqual(index.block_count, -(-len(INPUT) * 3 // 1000))
+        self.assertEqual(set(index.block_uncompressed_sizes[:-1]),
+                         set([1000]))
+        with LZMAFile(BytesIO(cdata)) as f:
+            f.seek(len(INPUT) + 1500)
+            self.assertEqual(f.read(100), INPUT[1500:1600])
+
+        with BytesIO() as dst:
+            with LZMAFile(dst, "w", pipeline=True, threads=0,
+                          filters=FILTERS_RAW_4) as f:
+                f.write(INPUT)
+            self.assertEqual(lzma.decompress(dst.getvalue()), INPUT)
+
+    def test_write_pipeline_append(self):
+        with BytesIO() as dst:
+            with LZMAFile(dst, "w", pipeline=True, block_size=512) as f:
+                f.write(INPUT)
+            with LZMAFile(dst, "a", pipeline=True, block_size=512) as f:
+                f.write(INPUT)
+            self.assertEqual(lzma.decompress(dst.getvalue()), INPUT * 2)
+
+    def test_write_pipeline_errors(self):
+        self.assertRaises(ValueError, LZMAFile, BytesIO(COMPRESSED_XZ),
+                          pipeline=True)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w",
+                          format=lzma.FORMAT_ALONE, pipeline=True)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w",
+                          threads=-1, pipeline=True)
+        self.assertRaises(LZMAError, LZMAFile, BytesIO(), "w",
+                          preset=10, pipeline=True)
+        with LZMAFile(BytesIO(), "w", pipeline=True) as f:
+            self.assertRaises(TypeError, f.write, None)
+            self.assertRaises(TypeError, f.write, 789)
+
+        class BrokenFile(BytesIO):
+            def write(self, data):
+                raise IOError("disk full")
+        f = LZMAFile(BrokenFile(), "w", pipeline=True, block_size=100)
+        try:
+            f.write(INPUT)
+        except IOError:
+            pass  # The writer thread may have failed already.
+        self.assertRaises(IOError, f.close)
+        self.assertTrue(f.closed)
+
+    def test_read_prefetch(self):
+        data = COMPRESSED_XZ * 2 + COMPRESSED_ALONE + COMPRESSED_BOGUS
+        with LZMAFile(BytesIO(data), prefetch=True) as f:
+            self.assertEqual(f.read(), INPUT * 3)
+            self.assertEqual(f.read(), b"")
+        with LZMAFile(BytesIO(data), prefetch=2) as f:
+            chunks = []
+            while True:
+                chunk = f.read(100)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            self.assertEqual(b"".join(chunks), INPUT * 3)
+            self.assertEqual(f.tell(), len(INPUT) * 3)
+        with LZMAFile(BytesIO(data), prefetch=1) as f:
+            b = bytearray(len(INPUT) + 10)
+            self.assertEqual(f.readinto(b), len(b))
+            self.assertEqual(bytes(b), INPUT + INPUT[:10])
+            self.assertEqual(f.peek()[:10], INPUT[10:20])
+            self.assertEqual(f.readline(), INPUT[10:].split(b"\n")[0] + b"\n")
+        with LZMAFile(BytesIO(COMPRESSED_RAW_2), format=lzma.FORMAT_RAW,
+                      filters=FILTERS_RAW_2, prefetch=4) as f:
+            self.assertEqual(f.read(), INPUT)
+
+    def test_read_prefetch_seek(self):
+        for data in (COMPRESSED_XZ * 3, COMPRESSED_ALONE * 3):
+            with LZMAFile(BytesIO(data), prefetch=1) as f:
+                self.assertEqual(f.read(10), INPUT[:10])
+                f.seek(20)
+                self.assertEqual(f.read(10), INPUT[20:30])
+                f.seek(len(INPUT) + 5)
+                self.assertEqual(f.read(10), INPUT[5:15])
+                f.seek(5)
+                self.assertEqual(f.read(10), INPUT[5:15])
+                f.seek(-10, 2)
+                self.assertEqual(f.read(), INPUT[-10:])
+                f.seek(0)
+                self.assertEqual(f.read(), INPUT * 3)
+
+    def test_read_prefetch_errors(self):
+        self.assertRaises(ValueError, LZMAFile, BytesIO(COMPRESSED_XZ),
+                          prefetch=-1)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w", prefetch=4)
+        with LZMAFile(BytesIO(COMPRESSED_XZ[:128]), prefetch=True) as f:
+            self.assertRaises(EOFError, f.read)
+        with LZMAFile(BytesIO(COMPRESSED_XZ), prefetch=True) as f:
+            f.read(1)
+        self.assertTrue(f.closed)
+
+    @requires_mt_decoder
+    def test_read_threads(self):
+        with LZMAFile(BytesIO(COMPRESSED_XZ + COMPRESSED_ALONE),
+                      threads=2) as f:
+            self.assertEqual(f.read(), INPUT * 2)
+        with LZMAFile(BytesIO(COMPRESSED_XZ * 3), threads=0) as f:
+            f.seek(len(INPUT) + 10)
+            self.assertEqual(f.read(10), INPUT[10:20])
+
+    def test_init_bad_threads(self):
+        with TempFile(TESTFN, COMPRESSED_XZ):
+            self.assertRaises(ValueError, LZMAFile, TESTFN, "r", threads=-1)
+            self.assertRaises(ValueError, LZMAFile, TESTFN, "r",
+                              block_size=1024)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w", threads=-1)
+
+    def test_read_buffer_size(self):
+        src = CountingBytesIO(COMPRESSED_XZ)
+        with LZMAFile(src, buffer_size=100) as f:
+            self.assertEqual(f.read(), INPUT)
+        self.assertEqual(set(src.read_sizes), set([100]))
+
+    def test_read_adaptive_buffer_size(self):
+        data = lzma.compress(INPUT * 50, preset=0)
+        src = CountingBytesIO(data)
+        with LZMAFile(src, buffer_size=64, max_buffer_size=1024) as f:
+            self.assertEqual(f.read(), INPUT * 50)
+            self.assertEqual(src.read_sizes[:6], [64, 128, 256, 512, 1024,
+                                                  1024])
+            # Seeking starts again from buffer_size.
+            f.seek(0)
+            del src.read_sizes[:]
+            self.assertEqual(f.read(10), INPUT[:10])
+            self.assertEqual(src.read_sizes[0], 64)
+
+    def test_init_bad_buffer_size(self):
+        self.assertRaises(ValueError, LZMAFile, BytesIO(COMPRESSED_XZ),
+                          buffer_size=0)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(COMPRESSED_XZ),
+                          buffer_size=1024, max_buffer_size=512)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w",
+                          buffer_size=1024)
+        self.assertRaises(ValueError, LZMAFile, BytesIO(), "w",
+                          max_buffer_size=1024)
+
     def test_write_append(self):
         part1 = INPUT[:1024]
         part2 = INPUT[1024:1536]
@@ -991,6 +2324,39 @@ class FileTestCase(unittest.TestCase):
             self.assertEqual(f.tell(), len(INPUT))
             self.assertEqual(f.read(), b"")
 
+    def test_seek_backward_uses_index(self):
+        fp = CountingBytesIO(COMPRESSED_XZ * 20)
+        with LZMAFile(fp) as f:
+            f.seek(len(INPUT) * 19 + 100)
+            self.assertEqual(f.read(50), INPUT[100:150])
+            fp.bytes_read = 0
+            f.seek(len(INPUT) * 18 + 30)
+            self.assertEqual(f.read(50), INPUT[30:80])
+            # Only the index and the stream holding the target were read.
+            self.assertLess(fp.bytes_read, len(COMPRESSED_XZ) * 3)
+            self.assertEqual(f.read(), INPUT[80:] + INPUT)
+
+    def test_seek_within_multistream(self):
+        data = COMPRESSED_XZ + lzma.compress(b"") + COMPRESSED_XZ * 2
+        with LZMAFile(BytesIO(data)) as f:
+            for offset in (len(INPUT) * 2 + 7, 5, len(INPUT), len(INPUT) - 1,
+                           len(INPUT) * 3 - 1, len(INPUT) + 500):
+                f.seek(offset)
+                self.assertEqual(f.tell(), offset)
+                self.assertEqual(f.read(20), (INPUT * 3)[offset:offset+20])
+            f.seek(len(INPUT) * 2 - 10)
+            self.assertEqual(f.read(), INPUT[-10:] + INPUT)
+            self.assertEqual(f.tell(), len(INPUT) * 3)
+
+    def test_seek_trailing_junk(self):
+        # Without a valid index at the end, seeking falls back to
+        # decompressing from the start of the file.
+        with LZMAFile(BytesIO(COMPRESSED_XZ * 2 + COMPRESSED_BOGUS)) as f:
+            f.seek(len(INPUT) + 20)
+            self.assertEqual(f.read(10), INPUT[20:30])
+            f.seek(10)
+            self.assertEqual(f.read(), INPUT[10:] + INPUT)
+
     def test_seek_past_start(self):
         with LZMAFile(BytesIO(COMPRESSED_XZ)) as f:
             f.seek(-88)
@@ -1037,6 +2403,240 @@ class FileTestCase(unittest.TestCase):
         self.assertEqual(len(entire), 13160)
         self.assertTrue(d.eof)
 
+        # The input is all consumed before the output is, so needs_input
+        # must stay false until the rest of the output has been returned.
+        d = LZMADecompressor()
+        out = d.decompress(ISSUE_21872_DAT, max_length=13149)
+        self.assertEqual(len(out), 13149)
+        self.assertFalse(d.needs_input)
+        self.assertFalse(d.eof)
+        out += d.decompress(b"")
+        self.assertEqual(out, entire)
+        self.assertTrue(d.eof)
+
+        d = LZMADecompressor()
+        buf = bytearray(13149)
+        self.assertEqual(d.decompress_into(ISSUE_21872_DAT, buf), 13149)
+        self.assertFalse(d.needs_input)
+        self.assertEqual(d.decompress(b""), entire[13149:])
+        self.assertTrue(d.eof)
+
+        with LZMAFile(BytesIO(ISSUE_21872_DAT), buffer_size=1 << 20) as f:
+            buf = bytearray(13149)
+            self.assertEqual(f.readinto(buf), 13149)
+            self.assertEqual(bytes(buf) + f.read(), entire)
+
+
+class IndexTestCase(unittest.TestCase):
+
+    def test_read_index(self):
+        index = lzma.read_index(BytesIO(COMPRESSED_XZ))
+        self.assertEqual(index.stream_count, 1)
+        self.assertEqual(index.block_count, 1)
+        self.assertEqual(index.compressed_size, len(COMPRESSED_XZ))
+        self.assertEqual(index.uncompressed_size, len(INPUT))
+        self.assertEqual(list(index.block_compressed_offsets), [12])
+        self.assertEqual(list(index.block_uncompressed_offsets), [0])
+        self.assertEqual(list(index.block_uncompressed_sizes), [len(INPUT)])
+        self.assertEqual(index.streams[0].check, lzma.CHECK_CRC64)
+        self.assertEqual(index.streams[0].size, len(COMPRESSED_XZ))
+
+    def test_read_index_multistream(self):
+        empty = lzma.compress(b"", check=lzma.CHECK_NONE)
+        data = COMPRESSED_XZ + b"\0" * 8 + empty + COMPRESSED_XZ
+        index = lzma.read_index(BytesIO(data))
+        self.assertEqual(index.stream_count, 3)
+        self.assertEqual(index.block_count, 2)
+        self.assertEqual(index.uncompressed_size, len(INPUT) * 2)
+        self.assertEqual([s.padding for s in index.streams], [8, 0, 0])
+        self.assertEqual([s.block_count for s in index.streams], [1, 0, 1])
+        self.assertEqual([s.uncompressed_size for s in index.streams],
+                         [len(INPUT), 0, len(INPUT)])
+        self.assertEqual(index.streams[1].check, lzma.CHECK_NONE)
+        self.assertEqual(index.streams[2].offset,
+                         len(COMPRESSED_XZ) + 8 + len(empty))
+        self.assertEqual(list(index.block_uncompressed_offsets),
+                         [0, len(INPUT)])
+        self.assertEqual(list(index.block_streams), [0, 2])
+        self.assertEqual(index.find_block(len(INPUT) - 1), 0)
+        self.assertEqual(index.find_block(len(INPUT)), 1)
+        self.assertIsNone(index.find_block(len(INPUT) * 2))
+
+    def test_read_index_filename(self):
+        with TempFile(TESTFN, COMPRESSED_XZ * 2):
+            index = lzma.read_index(TESTFN)
+        self.assertEqual(index.uncompressed_size, len(INPUT) * 2)
+
+    def test_read_index_keeps_position(self):
+        fp = BytesIO(COMPRESSED_XZ)
+        fp.seek(17)
+        lzma.read_index(fp)
+        self.assertEqual(fp.tell(), 17)
+
+    def test_read_index_bad_input(self):
+        for data in (b"", COMPRESSED_ALONE, COMPRESSED_XZ + COMPRESSED_BOGUS,
+                     COMPRESSED_XZ + b"\0" * 3, COMPRESSED_XZ[1:],
+                     COMPRESSED_XZ[:-23] + b"\x02" + COMPRESSED_XZ[-22:]):
+            self.assertRaises(LZMAError, lzma.read_index, BytesIO(data))
+
+    def test_read_index_huge_count(self):
+        # A record count larger than the index could hold must be
+        # rejected before it is used as a loop bound.
+        from backports.lzma import _index
+        body = b"\x00" + _index._encode_vli(2 ** 62)
+        body += b"\x00" * (_index._round_up4(len(body)) - len(body))
+        index = body + struct.pack("<I", _index._crc32(body))
+        self.assertRaises(LZMAError, _index._decode_index, index)
+        data = (_index._stream_header(lzma.CHECK_CRC64) + index +
+                _index._stream_footer(lzma.CHECK_CRC64, len(index)))
+        self.assertRaises(LZMAError, lzma.read_index, BytesIO(data))
+
+    def test_seek_end_uses_index(self):
+        fp = CountingBytesIO(COMPRESSED_XZ * 20)
+        with LZMAFile(fp) as f:
+            self.assertEqual(f.seek(0, 2), len(INPUT) * 20)
+            self.assertLess(fp.bytes_read, len(COMPRESSED_XZ))
+            f.seek(-10, 2)
+            self.assertEqual(f.read(), INPUT[-10:])
+
+
+class AsyncBytesIO(BytesIO):
+    """BytesIO whose read() and write() return awaitables, like aiofiles."""
+
+    def __init__(self, loop, data=b""):
+        BytesIO.__init__(self, data)
+        self.loop = loop
+
+    def _done(self, result):
+        fut = self.loop.create_future()
+        fut.set_result(result)
+        return fut
+
+    def read(self, size=-1):
+        return self._done(BytesIO.read(self, size))
+
+    def write(self, data):
+        return self._done(BytesIO.write(self, data))
+
+
+class FakeStreamWriter:
+    """Minimal stand-in for asyncio.StreamWriter."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.data = []
+        self.drained = 0
+
+    def write(self, data):
+        self.data.append(data)
+
+    def drain(self):
+        self.drained += 1
+        fut = self.loop.create_future()
+        fut.set_result(None)
+        return fut
+
+
+@unittest.skipUnless(hasattr(lzma, "AsyncLZMAFile"), "requires asyncio")
+class AsyncFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def read_all(self, f):
+        # Equivalent to "async for chunk in f", without the syntax.
+        chunks = []
+        while True:
+            try:
+                chunks.append(self.run_coro(f.__anext__()))
+            except StopAsyncIteration:
+                return chunks
+
+    def stream_reader(self, data):
+        import asyncio
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(data)
+        reader.feed_eof()
+        return reader
+
+    def test_bad_args(self):
+        self.assertRaises(ValueError, lzma.AsyncLZMAFile, BytesIO(), "x")
+        self.assertRaises(ValueError, lzma.AsyncLZMAFile, BytesIO(),
+                          check=lzma.CHECK_CRC32)
+        self.assertRaises(ValueError, lzma.AsyncLZMAFile, BytesIO(),
+                          chunk_size=0)
+        self.assertRaises(TypeError, lzma.AsyncLZMAFile, 42)
+        f = lzma.AsyncLZMAFile(BytesIO(), "w")
+        self.assertRaises(UnsupportedOperation, self.run_coro, f.read())
+        self.run_coro(f.close())
+        self.assertTrue(f.closed)
+        self.assertRaises(ValueError, self.run_coro, f.write(b"x"))
+        self.run_coro(f.close())
+
+    def test_read_stream_reader(self):
+        reader = self.stream_reader(COMPRESSED_XZ + COMPRESSED_ALONE)
+        f = lzma.aopen(reader, chunk_size=100)
+        chunks = self.read_all(f)
+        self.assertTrue(all(0 < len(c) <= 100 for c in chunks))
+        self.assertEqual(b"".join(chunks), INPUT * 2)
+        self.assertEqual(f.tell(), len(INPUT) * 2)
+        self.assertEqual(self.run_coro(f.read()), b"")
+        self.run_coro(f.close())
+
+    def test_read(self):
+        f = lzma.AsyncLZMAFile(AsyncBytesIO(self.loop, COMPRESSED_XZ * 2 +
+                                            COMPRESSED_BOGUS))
+        self.assertEqual(self.run_coro(f.read(10)), INPUT[:10])
+        self.assertEqual(self.run_coro(f.read(0)), b"")
+        self.assertEqual(self.run_coro(f.read()), INPUT[10:] + INPUT)
+        self.run_coro(f.close())
+
+        f = lzma.AsyncLZMAFile(self.stream_reader(COMPRESSED_RAW_1),
+                               format=lzma.FORMAT_RAW, filters=FILTERS_RAW_1)
+        self.assertEqual(self.run_coro(f.read()), INPUT)
+
+        f = lzma.AsyncLZMAFile(self.stream_reader(COMPRESSED_XZ[:100]))
+        self.assertRaises(EOFError, self.run_coro, f.read())
+
+    def test_write_stream_writer(self):
+        writer = FakeStreamWriter(self.loop)
+        f = lzma.aopen(writer, "wb", preset=1)
+        self.assertTrue(f.writable())
+        for i in range(0, len(INPUT), 1000):
+            self.run_coro(f.write(INPUT[i:i+1000]))
+        self.run_coro(f.write(INPUT * 2))
+        self.run_coro(f.close())
+        self.assertGreater(writer.drained, 0)
+        self.assertEqual(lzma.decompress(b"".join(writer.data)), INPUT * 3)
+
+    def test_write_async_file(self):
+        dst = AsyncBytesIO(self.loop)
+        f = lzma.AsyncLZMAFile(dst, "w", format=lzma.FORMAT_ALONE)
+        self.assertEqual(self.run_coro(f.write(INPUT)), len(INPUT))
+        self.run_coro(f.close())
+        self.assertFalse(dst.closed)
+        self.assertEqual(lzma.decompress(dst.getvalue()), INPUT)
+
+    def test_filename(self):
+        try:
+            f = lzma.aopen(TESTFN, "w")
+            self.run_coro(f.__aenter__())
+            self.run_coro(f.write(INPUT))
+            self.run_coro(f.__aexit__(None, None, None))
+            self.assertTrue(f.closed)
+            f = lzma.aopen(TESTFN)
+            self.assertEqual(self.run_coro(f.read()), INPUT)
+            self.run_coro(f.close())
+        finally:
+            unlink(TESTFN)
+
 
 class OpenTestCase(unittest.TestCase):
 
@@ -1148,6 +2748,173 @@ class OpenTestCase(unittest.TestCase):
                 self.assertEqual(f.readlines(), [text])
 
 
+    def test_buffer_size(self):
+        src = CountingBytesIO(COMPRESSED_XZ)
+        with lzma.open(src, "rt", buffer_size=64,
+                       max_buffer_size=4096) as f:
+            self.assertEqual(f.read(), INPUT.decode("ascii"))
+        self.assertEqual(src.read_sizes[:3], [64, 128, 256])
+
+class CompressorPoolTestCase(unittest.TestCase):
+
+    def test_bad_args(self):
+        self.assertRaises(ValueError, lzma.CompressorPool, -1)
+        pool = lzma.CompressorPool()
+        self.assertRaises(LZMAError, pool.compress, INPUT, preset=42)
+        self.assertRaises(ValueError, pool.decompress, COMPRESSED_XZ,
+                          format=lzma.FORMAT_RAW)
+        self.assertEqual(len(pool), 0)
+
+    def test_roundtrip(self):
+        pool = lzma.CompressorPool()
+        for i in range(3):
+            cdata = pool.compress(INPUT, preset=1)
+            self.assertEqual(cdata, lzma.compress(INPUT, preset=1))
+            self.assertEqual(pool.decompress(cdata), INPUT)
+        self.assertEqual(pool.misses, 2)
+        self.assertEqual(pool.hits, 4)
+        self.assertEqual(len(pool), 2)
+
+        cdata = pool.compress(INPUT, lzma.FORMAT_RAW, filters=FILTERS_RAW_4)
+        self.assertEqual(pool.decompress(cdata, lzma.FORMAT_RAW,
+                                         filters=FILTERS_RAW_4), INPUT)
+        self.assertEqual(pool.decompress(COMPRESSED_XZ + COMPRESSED_ALONE),
+                         INPUT * 2)
+
+    def test_settings_key(self):
+        pool = lzma.CompressorPool()
+        pool.compress(INPUT, filters=[{"id": lzma.FILTER_LZMA2,
+                                       "preset": 1}])
+        pool.compress(INPUT, filters=[{"preset": 1,
+                                       "id": lzma.FILTER_LZMA2}])
+        self.assertEqual((pool.hits, pool.misses), (1, 1))
+        pool.compress(INPUT, filters=FILTERS_RAW_4)
+        pool.compress(INPUT, preset=1)
+        pool.compress(INPUT, check=lzma.CHECK_NONE, preset=1)
+        self.assertEqual((pool.hits, pool.misses), (1, 4))
+
+    def test_borrow(self):
+        pool = lzma.CompressorPool()
+        with pool.compressor() as comp:
+            comp.compress(b"discarded")
+            with pool.compressor() as comp2:
+                self.assertIsNot(comp2, comp)
+        self.assertEqual(len(pool), 2)
+        with pool.compressor() as comp3:
+            self.assertIs(comp3, comp)
+            cdata = comp3.compress(INPUT) + comp3.flush()
+        self.assertEqual(cdata, lzma.compress(INPUT))
+
+        with pool.decompressor(concatenated=True) as decomp:
+            decomp.decompress(COMPRESSED_XZ[:100])
+        with pool.decompressor(concatenated=True) as decomp2:
+            self.assertIs(decomp2, decomp)
+            self.assertEqual(decomp2.decompress(COMPRESSED_XZ), INPUT)
+
+        # Objects are returned to the pool even if an error occurs.
+        try:
+            with pool.decompressor(concatenated=True) as decomp3:
+                self.assertIs(decomp3, decomp)
+                decomp3.decompress(COMPRESSED_RAW_1)
+        except LZMAError:
+            pass
+        else:
+            self.fail("LZMAError not raised")
+        self.assertEqual(pool.decompress(COMPRESSED_XZ), INPUT)
+        self.assertEqual(pool.hits, 4)
+
+    def test_eviction(self):
+        pool = lzma.CompressorPool(2)
+        pool.compress(INPUT, preset=0)
+        pool.compress(INPUT, preset=1)
+        pool.compress(INPUT, preset=0)
+        pool.compress(INPUT, preset=2)  # Evicts preset=1.
+        self.assertEqual(len(pool), 2)
+        pool.compress(INPUT, preset=0)
+        pool.compress(INPUT, preset=1)
+        self.assertEqual((pool.hits, pool.misses), (2, 4))
+
+        pool.clear()
+        self.assertEqual(len(pool), 0)
+        pool = lzma.CompressorPool(0)
+        pool.compress(INPUT)
+        pool.compress(INPUT)
+        self.assertEqual((pool.hits, pool.misses), (0, 2))
+        self.assertEqual(len(pool), 0)
+
+    def test_threads(self):
+        import threading
+        pool = lzma.CompressorPool(4)
+        errors = []
+        def run():
+            try:
+                for i in range(20):
+                    cdata = pool.compress(INPUT, preset=0)
+                    if pool.decompress(cdata) != INPUT:
+                        errors.append(i)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(pool.hits + pool.misses, 160)
+        self.assertLessEqual(len(pool), 4)
+
+
+class BlockCacheTestCase(unittest.TestCase):
+
+    def test_bad_args(self):
+        self.assertRaises(ValueError, lzma.BlockCache, -1)
+
+    def test_lru(self):
+        cache = lzma.BlockCache(100)
+        cache._put("a", b"a" * 40)
+        cache._put("b", b"b" * 40)
+        self.assertEqual(cache._get("a"), b"a" * 40)
+        cache._put("c", b"c" * 40)  # Evicts "b".
+        self.assertEqual((len(cache), cache.size, cache.evictions),
+                         (2, 80, 1))
+        self.assertIsNone(cache._get("b"))
+        self.assertEqual(cache._get("c"), b"c" * 40)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        # Replacing a block updates the size.
+        cache._put("c", b"c" * 10)
+        self.assertEqual(cache.size, 50)
+        # Blocks larger than the cache are not kept.
+        cache._put("d", b"d" * 101)
+        self.assertIsNone(cache._get("d"))
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+    def test_threads(self):
+        import threading
+        cache = lzma.BlockCache(1000)
+        errors = []
+        def run(n):
+            try:
+                for i in range(200):
+                    key = (n, i % 7)
+                    data = cache._get(key)
+                    if data is None:
+                        cache._put(key, b"x" * (i % 7 * 10))
+                    elif data != b"x" * (i % 7 * 10):
+                        errors.append(key)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(cache.hits + cache.misses, 800)
+        self.assertLessEqual(cache.size, 1000)
+
+
 class MiscellaneousTestCase(unittest.TestCase):
 
     def test_is_check_supported(self):
@@ -1732,7 +3499,11 @@ def test_main():
         CompressorDecompressorTestCase,
         CompressDecompressFunctionTestCase,
         FileTestCase,
+        IndexTestCase,
         OpenTestCase,
+        AsyncFileTestCase,
+        CompressorPoolTestCase,
+        BlockCacheTestCase,
         MiscellaneousTestCase,
     )
 